@@ -0,0 +1,97 @@
+"""
+Character-trigram inverted index over person aliases.
+
+The index is a table of postings (trigram, alias, gramcount), one row per distinct trigram of every distinct alias,
+indexed on trigram and on alias, plus a table with the number of postings of every trigram. For a name with q trigrams
+and a minimum similarity t:
+
+    - length filtering: an alias with fewer than t * q or more than q / t trigrams cannot reach similarity t
+    - count filtering: an alias has to share at least s = ceil(t * q) of the q query trigrams, so it contains at least one
+      of any q - s + 1 of them. Only the posting lists of the q - s + 1 rarest query trigrams are read to find candidates.
+    - scoring: the candidates are ranked by trigram Jaccard similarity (the ngram_jaccard of string_similarity), top k
+
+tests/test_alias_index.py checks the scores, benchmarks/alias_index.py builds the index for synthetic persons at a few sizes and
+reports the lookup latency.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+import math
+from sqlalchemy import Float, cast, column, func, select, table
+from string_similarity import ngrams
+
+
+TRIGRAM_SIZE = 3
+
+
+def alias_postings(aliases: pd.Series):
+    # (trigram, alias, gramcount) for every distinct trigram of every distinct alias
+    aliases = pd.Series(pd.unique(aliases.dropna().astype(str)), dtype=object)
+    grams = aliases.map(lambda alias: sorted(ngrams(alias, TRIGRAM_SIZE)))
+    postings = pd.DataFrame({'alias': aliases, 'trigram': grams, 'gramcount': grams.map(len)}).explode('trigram', ignore_index=True)
+    return postings[['trigram', 'alias', 'gramcount']]
+
+
+def trigram_counts(postings: pd.DataFrame):
+    return postings.groupby('trigram').size().rename('postings').reset_index()
+
+
+def write_alias_index(db_connector, table_name: str, counts_table_name: str, aliases: pd.Series, rebuild: bool = False):
+    # Full runs rewrite the index, incremental runs add the postings of aliases it does not hold yet and bump their trigram counts
+    postings = alias_postings(aliases)
+    if not rebuild and db_connector.get_table_columns(table_name=table_name):
+        indexed = db_connector.query_table_by_keys(table_name=table_name, selected_columns=['alias'], key_column='alias', keys=postings['alias'])
+        postings = postings[~postings['alias'].isin(indexed['alias'])]
+        counts = trigram_counts(postings)
+        existing_counts = db_connector.query_table_by_keys(table_name=counts_table_name, selected_columns=['trigram', 'postings'], key_column='trigram',
+                                                           keys=counts['trigram'])
+        counts['postings'] += counts['trigram'].map(existing_counts.set_index('trigram')['postings']).fillna(0).astype(int)
+        db_connector.bulk_write(postings, table_name, mode='append')
+        db_connector.bulk_write(counts, counts_table_name, mode='upsert', key_columns=['trigram'])
+    else:
+        db_connector.bulk_write(postings, table_name, mode='replace')
+        db_connector.bulk_write(trigram_counts(postings), counts_table_name, mode='replace')
+    db_connector.create_index(table_name, ['trigram'])
+    db_connector.create_index(table_name, ['alias'])
+    db_connector.create_index(counts_table_name, ['trigram'])
+    return len(postings)
+
+
+def similar_aliases(db_connector, table_name: str, counts_table_name: str, alias: str, k: int = 10, min_similarity: float = 0.3):
+    """
+    The k indexed aliases most similar to alias with a trigram Jaccard similarity of at least min_similarity, best first.
+    """
+    grams = sorted(ngrams(str(alias).strip().lower(), TRIGRAM_SIZE))
+    query_grams = len(grams)
+    min_shared = max(math.ceil(min_similarity * query_grams), 1)
+
+    # Trigrams nobody has are the rarest of all, they cost nothing to probe and rule nothing out
+    counts = db_connector.query_table(table_name=counts_table_name, selected_columns=['trigram', 'postings'], filters=[('trigram', 'in', grams)])
+    frequency = dict(zip(counts['trigram'], counts['postings']))
+    probe_grams = sorted(grams, key=lambda gram: (frequency.get(gram, 0), gram))[:query_grams - min_shared + 1]
+    length_range = column('gramcount').between(min_shared, math.floor(query_grams / min_similarity))
+    candidates = select(column('alias')).select_from(table(table_name)).where(column('trigram').in_(probe_grams)).where(length_range)
+
+    shared = func.count()
+    similarity = cast(shared, Float) / (query_grams + column('gramcount') - shared)
+    query = (
+        select(column('alias'), column('gramcount'), shared.label('shared'), similarity.label('similarity'))
+        .select_from(table(table_name))
+        .where(column('alias').in_(candidates))
+        .where(column('trigram').in_(grams))
+        .group_by(column('alias'), column('gramcount'))
+        .having(shared >= min_shared)
+        .having(similarity >= min_similarity)
+        .order_by(similarity.desc(), column('alias'))
+        .limit(k)
+    )
+    result = db_connector.connection.execute(query)
+    return db_connector.data_to_pandas_df(result.fetchall(), list(result.keys()))
+
+
+def similar_persons(db_connector, table_name: str, counts_table_name: str, person_table_name: str, alias: str, k: int = 10,
+                    min_similarity: float = 0.3):
+    # similar_aliases with the personids currently holding each alias
+    df_aliases = similar_aliases(db_connector, table_name, counts_table_name, alias, k=k, min_similarity=min_similarity)
+    df_persons = db_connector.query_table_by_keys(table_name=person_table_name, selected_columns=['alias', 'personid'], key_column='alias', keys=df_aliases['alias'])
+    return df_aliases.merge(df_persons.drop_duplicates(), on='alias', how='left')
@@ -0,0 +1,26 @@
+"""
+Build time and top-10 lookup latency of the trigram alias index for synthetic persons at a few sizes, on an in-memory
+SQLite database. The scores are checked in tests/test_alias_index.py.
+
+Run from the repository root: python -m benchmarks.alias_index
+"""
+import time
+from alias_index import similar_aliases, write_alias_index
+from main import Database_Connector
+from record_linkage import generate_person_corpus
+
+
+if __name__ == "__main__":
+    with Database_Connector(database_url='sqlite://') as db_connector:
+        for persons in [5000, 20000, 80000]:
+            aliases = generate_person_corpus(persons, records_per_person=1)['alias']
+            start = time.perf_counter()
+            write_alias_index(db_connector, 'person_alias_trigrams', 'person_alias_trigram_counts', aliases, rebuild=True)
+            build_seconds = time.perf_counter() - start
+
+            queries = aliases.sample(200, random_state=0).tolist()
+            start = time.perf_counter()
+            for query in queries:
+                similar_aliases(db_connector, 'person_alias_trigrams', 'person_alias_trigram_counts', query, k=10, min_similarity=0.6)
+            lookup_ms = (time.perf_counter() - start) / len(queries) * 1000
+            print(f"{aliases.nunique()} aliases: index built in {build_seconds:.1f}s, top-10 lookup {lookup_ms:.2f} ms")
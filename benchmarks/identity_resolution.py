@@ -0,0 +1,240 @@
+"""
+Quality and speed benchmark for identity resolution.
+
+    - generate_test_transactions: synthetic rows shaped like test_transactions, drawn from persons with several accounts,
+      spelling variants of their names, phones shared within households and typos in phone numbers. Every account number
+      belongs to one known person, which is the ground truth.
+    - run_stage: runs a spark_job script as a subprocess against the benchmark database, with its wall time and peak RSS
+    - stage_timings: the timings identity resolution prints for record linkage (blocking, comparison, scoring, clustering)
+      and for its writes, so the matching time is reported apart from the database round trips
+    - evaluate: precision, recall and F1 of the resolved account owners over all pairs of accounts (record_linkage.pairwise_scores)
+
+Usage:
+    python -m benchmarks.identity_resolution --database-url sqlite:////tmp/identity_benchmark.db --rows 10000 100000 1000000
+                                             --output identity_resolution_benchmark.json [--baseline previous.json]
+
+Every scale rewrites test_transactions and the stage tables of the given database, so it must never be the pipeline database.
+With --baseline, the run fails when a scale's matching got slower by more than --max-slowdown or lost more than --max-f1-drop of F1, and
+with --min-precision when a scale's pairwise precision is below it. The stages run with this process's environment, so
+DATA_FUSION_FUZZY_MATCHING=1 benchmarks fuzzy matching.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+import argparse
+import ast
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from main import Database_Connector
+from record_linkage import ETHIOPIAN_NAMES, pairwise_scores, spelling_variant
+
+
+REPOSITORY_PATH = Path(__file__).resolve().parent.parent
+DEFAULT_ROWS = [10000, 100000, 1000000]
+REGIONS = ['addis ababa', 'oromia', 'amhara', 'tigray', 'sidama', 'somali', 'afar', 'bahir dar amhara', 'hawassa sidama', 'adama oromia']
+OCCUPATIONS = ['trader', 'teacher', 'farmer', 'driver', 'nurse', 'engineer', 'student', 'merchant', None]
+BRANCHES = ['bole', 'piassa', 'merkato', 'kazanchis', 'megenagna', 'adama', 'hawassa', 'bahir dar']
+
+
+def phone_typo(phone: str, rng: np.random.Generator):
+    position = int(rng.integers(2, len(phone)))
+    return phone[:position] + str(rng.integers(10)) + phone[position + 1:]
+
+
+def generate_test_transactions(rows: int, rows_per_person: int = 10, accounts_per_person: int = 3, variant_rate: float = 0.2,
+                               shared_phone_rate: float = 0.1, typo_rate: float = 0.02, seed: int = 0):
+    """
+    (test_transactions rows, ground truth with the person of every accountno). Senders and beneficiaries are drawn from
+    the same accounts, each mention of a person's name gets a spelling variant with probability variant_rate, a
+    shared_phone_rate share of the persons use the phone of another person of their household, and typo_rate of the
+    phone mentions have one digit wrong.
+    """
+    rng = np.random.default_rng(seed)
+    persons = max(rows // rows_per_person, 2)
+    given, father, grandfather = (rng.choice(ETHIOPIAN_NAMES, persons) for _ in range(3))
+    phones = np.char.add('09', rng.integers(10 ** 7, 10 ** 8, persons).astype(str)).astype(object)
+    households = np.flatnonzero(rng.random(persons) < shared_phone_rate)
+    phones[households] = phones[rng.integers(0, persons, len(households))]
+    sexes = rng.choice(['M', 'F'], persons)
+    birthdates = pd.Timestamp('1950-01-01') + pd.to_timedelta(rng.integers(0, 365 * 50, persons), unit='D')
+    occupations = rng.choice(np.array(OCCUPATIONS, dtype=object), persons)
+    regions = rng.choice(REGIONS, persons)
+
+    account_owners = np.repeat(np.arange(persons), rng.integers(1, accounts_per_person + 1, persons))
+    account_numbers = np.char.add('1000', np.char.zfill(rng.permutation(10 ** 7)[:len(account_owners)].astype(str), 9)).astype(object)
+    opened_dates = pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 365 * 15, len(account_owners)), unit='D')
+
+    def names(owners):
+        aliases = []
+        for person in owners.tolist():
+            tokens = [given[person], father[person], grandfather[person]]
+            if rng.random() < variant_rate:
+                token = int(rng.integers(3))
+                tokens[token] = spelling_variant(tokens[token], rng)
+            aliases.append(' '.join(tokens).title())
+        return aliases
+
+    def phone_mentions(owners, present_rate):
+        mentions = [phone_typo(phone, rng) if rng.random() < typo_rate else phone for phone in phones[owners]]
+        return np.where(rng.random(len(owners)) < present_rate, np.array(mentions, dtype=object), None)
+
+    senders, beneficiaries = rng.integers(0, len(account_owners), rows), rng.integers(0, len(account_owners), rows)
+    sender_owners, beneficiary_owners = account_owners[senders], account_owners[beneficiaries]
+    times = rng.integers(0, 24 * 3600, rows)
+    df = pd.DataFrame({
+        'transactionid': [f"FT{seed:02d}{row:010d}" for row in range(rows)],
+        'branchid': rng.integers(1, len(BRANCHES) + 1, rows),
+        'branchname': rng.choice(BRANCHES, rows),
+        'transactiondate': (pd.Timestamp('2024-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 90, rows)), unit='D')).strftime('%Y-%m-%d'),
+        'transactiontime': [f"{value // 3600:02d}:{value // 60 % 60:02d}:{value % 60:02d}" for value in times.tolist()],
+        'transactiontype': rng.choice(['Cash Deposit', 'Cash Withdrawal', 'Transfer', 'Cheque'], rows),
+        'conductingmanner': rng.choice(['Branch', 'Mobile', 'ATM'], rows),
+        'currencytype': rng.choice(['ETB', 'USD'], rows, p=[0.9, 0.1]),
+        'amountinbirr': rng.gamma(2, 5000, rows).round(2),
+        'amountincurrency': rng.gamma(2, 100, rows).round(2),
+        'sex': sexes[sender_owners],
+        'birthdate': np.where(rng.random(rows) < 0.8, birthdates[sender_owners].strftime('%Y-%m-%d'), None),
+        'occupation': occupations[sender_owners],
+        'bussinesstelno': phone_mentions(sender_owners, 0.8),
+        'houseno': regions[sender_owners],
+        'accountno': account_numbers[senders],
+        'accownername': names(sender_owners),
+        'accounttype': rng.choice(['Saving', 'Current'], rows),
+        'openeddate': opened_dates[senders].strftime('%Y-%m-%d'),
+        'closeddate': None,
+        'benfullname': names(beneficiary_owners),
+        'benaccountno': account_numbers[beneficiaries],
+        'bentelno': phone_mentions(beneficiary_owners, 0.5),
+        'benisentity': None,
+        'benworeda': np.where(rng.random(rows) < 0.7, regions[beneficiary_owners], None),
+    })
+    df_truth = pd.DataFrame({'accountno': account_numbers, 'person': account_owners})
+    return df, df_truth
+
+
+def run_stage(script: str, database_url: str, arguments: list = None):
+    """
+    Runs a stage script in a subprocess and returns (wall seconds, peak RSS in MiB, stdout). The child is reaped with
+    wait4 so its own resource usage is read, not the accumulated usage of every child of this process.
+    """
+    environment = dict(os.environ, DATA_FUSION_DATABASE_URL=database_url)
+    with tempfile.TemporaryFile(mode='w+') as output:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, str(REPOSITORY_PATH / script)] + (arguments or []), cwd=REPOSITORY_PATH,
+                                   env=environment, stdout=output, stderr=subprocess.STDOUT, text=True)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        output.seek(0)
+        stdout = output.read()
+    if process.returncode != 0:
+        raise RuntimeError(f"{script} failed with exit code {process.returncode}:\n{stdout[-5000:]}")
+    return seconds, usage.ru_maxrss / 1024, stdout
+
+
+def printed_stats(stdout: str, label: str):
+    # A stats dict a stage printed as "<label>: {...}"
+    for line in stdout.splitlines():
+        if line.startswith(f"{label}:"):
+            return ast.literal_eval(line.split(":", 1)[1].strip())
+    return {}
+
+
+MATCHING_TIMINGS = ['exact_match_seconds', 'blocking_seconds', 'comparison_seconds', 'scoring_seconds', 'sharding_seconds', 'linkage_seconds',
+                    'clustering_seconds']
+
+
+def stage_timings(stdout: str):
+    # (record linkage stats, seconds spent matching and clustering persons, seconds spent writing the stage tables)
+    stats = printed_stats(stdout, "Record linkage")
+    matching_seconds = sum(stats.get(timing, 0) for timing in MATCHING_TIMINGS)
+    return stats, round(matching_seconds, 3), printed_stats(stdout, "Writes").get('write_seconds')
+
+
+def evaluate(database_url: str, df_truth: pd.DataFrame):
+    # Accounts whose owner was not resolved count as entities of their own
+    with Database_Connector(database_url=database_url) as db_connector:
+        df_accounts = db_connector.query_table(table_name='account_entity_table', selected_columns=['accountno', 'ownerentity'])
+    owners = df_accounts.drop_duplicates(subset=['accountno']).set_index('accountno')['ownerentity']
+    df_truth = df_truth[df_truth['accountno'].isin(owners.index)]
+    predicted = owners.reindex(df_truth['accountno']).astype(object).to_numpy(copy=True)
+    unresolved = pd.isna(predicted)
+    predicted[unresolved] = 'UNRESOLVED_' + df_truth['accountno'].to_numpy()[unresolved]
+    return {'accounts': len(df_truth), 'true_entities': int(df_truth['person'].nunique()), 'resolved_entities': int(pd.Series(predicted).nunique()),
+            **pairwise_scores(df_truth['person'].to_numpy(), predicted)}
+
+
+def benchmark(database_url: str, rows: int, seed: int = 0):
+    df, df_truth = generate_test_transactions(rows, seed=seed)
+    with Database_Connector(database_url=database_url) as db_connector:
+        db_connector.bulk_write(df, 'test_transactions', mode='replace')
+
+    cleaning_seconds, _, _ = run_stage('spark_job_data_cleaning.py', database_url, ['--full-rebuild'])
+    resolution_seconds, peak_rss_mb, stdout = run_stage('spark_job_identity_resolution.py', database_url, ['--full-rebuild'])
+    stats, matching_seconds, write_seconds = stage_timings(stdout)
+    return {'rows': rows, 'cleaning_seconds': round(cleaning_seconds, 2), 'resolution_seconds': round(resolution_seconds, 2),
+            'matching_seconds': matching_seconds, 'write_seconds': write_seconds, 'peak_rss_mb': round(peak_rss_mb, 1), 'candidate_pairs': stats.get('candidate_pairs'), 'matched_pairs': stats.get('matched_pairs'),
+            **evaluate(database_url, df_truth), 'linkage': stats}
+
+
+def regressions(results: list, baseline: dict, max_slowdown: float, max_f1_drop: float):
+    baseline_results = {result['rows']: result for result in baseline['results']}
+    found = []
+    for result in results:
+        previous = baseline_results.get(result['rows'])
+        if previous is None:
+            continue
+        # Reports from before the matching time was printed only have the wall time of the whole stage
+        timing = 'matching_seconds' if 'matching_seconds' in previous else 'resolution_seconds'
+        if result[timing] > previous[timing] * (1 + max_slowdown):
+            found.append(f"{result['rows']} rows: {timing} {result[timing]}s, was {previous[timing]}s")
+        if result['f1'] < previous['f1'] - max_f1_drop:
+            found.append(f"{result['rows']} rows: F1 {result['f1']}, was {previous['f1']}")
+    return found
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+"""------------------------------------------------------------------------------------------------------------------------------"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark identity resolution on synthetic transactions with known persons")
+    parser.add_argument('--database-url', required=True, help="scratch database, its stage tables are overwritten")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='identity_resolution_benchmark.json')
+    parser.add_argument('--baseline', help="earlier output to compare against")
+    parser.add_argument('--max-slowdown', type=float, default=0.2)
+    parser.add_argument('--max-f1-drop', type=float, default=0.01)
+    parser.add_argument('--min-precision', type=float, help="fail when the pairwise precision of a scale is below this")
+    arguments = parser.parse_args()
+
+    results = []
+    for rows in arguments.rows:
+        result = benchmark(arguments.database_url, rows, seed=arguments.seed)
+        print(json.dumps({key: value for key, value in result.items() if key != 'linkage'}))
+        results.append(result)
+
+    report = {'created_at': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'seed': arguments.seed, 'results': results}
+    Path(arguments.output).write_text(json.dumps(report, indent=2))
+    print("Done! Benchmark results saved to", arguments.output)
+
+    found = []
+    if arguments.baseline:
+        found += regressions(results, json.loads(Path(arguments.baseline).read_text()), arguments.max_slowdown, arguments.max_f1_drop)
+    if arguments.min_precision is not None:
+        found += [f"{result['rows']} rows: precision {result['precision']}, below {arguments.min_precision}"
+                  for result in results if result['precision'] < arguments.min_precision]
+    for regression in found:
+        print("Regression:", regression)
+    sys.exit(1 if found else 0)
@@ -0,0 +1,29 @@
+"""
+Time and peak memory of the key dictionary lookups against the pandas merges they replace, at 100k and 1M rows. Their
+equivalence is checked in tests/test_key_dictionary.py, which also holds both versions of the join.
+
+Run from the repository root: python -m benchmarks.key_dictionary
+"""
+import time
+import tracemalloc
+from tests.test_key_dictionary import looked_up_owners, merged_owners, synthetic_owners
+
+
+def traced(function):
+    # (seconds, peak MiB above the memory in use when it started)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    peak = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20
+    tracemalloc.stop()
+    return seconds, peak
+
+
+if __name__ == "__main__":
+    for rows in [100000, 1000000]:
+        inputs = synthetic_owners(rows)
+        merge_seconds, merge_peak = traced(lambda: merged_owners(*inputs))
+        code_seconds, code_peak = traced(lambda: looked_up_owners(*inputs))
+        print(f"{rows} rows: merges {merge_seconds:.2f}s / {merge_peak:.0f} MiB peak, key dictionary {code_seconds:.2f}s / {code_peak:.0f} MiB peak")
@@ -0,0 +1,79 @@
+"""
+Throughput of the vectorized normalization rules against the scalar and pandas code they replace, at a million rows.
+Their equivalence is checked in tests/test_normalization.py.
+
+Run from the repository root: python -m benchmarks.normalization
+"""
+import hashlib
+import time
+import numpy as np
+import pandas as pd
+from normalization import (Memoized_Normalizer, TIME_FORMAT, classify_regions, first_occurrences, fixed_width_keys, generate_address_corpus, generate_phone_corpus,
+                           hash_transaction_ids, normalize_phone_numbers, parse_dates, parse_times_of_day, sha256_digests, transform_address,
+                           transform_phone_number)
+
+
+def best_time(function, repeat: int = 3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(reference, vectorized, values: pd.Series, repeat: int = 3):
+    reference_seconds = best_time(lambda: values.apply(lambda x: reference(x)), repeat)
+    vectorized_seconds = best_time(lambda: vectorized(values), repeat)
+    print(f"{vectorized.__name__}: {len(values)} rows, reference {len(values) / reference_seconds:,.0f} rows/s, "
+          f"vectorized {len(values) / vectorized_seconds:,.0f} rows/s, speedup {reference_seconds / vectorized_seconds:.1f}x")
+
+
+def benchmark_transaction_hashing(rows: int = 1000000):
+    transaction_ids = pd.Series([f"ft{number:012d}etb" for number in range(rows)], dtype='string')
+    transaction_ids[::97] = pd.NA
+
+    def previous_path():
+        hex_ids = transaction_ids.apply(lambda x: hashlib.sha256(x.encode()).hexdigest() if isinstance(x, str) else x)
+        return pd.DataFrame({'transactionid': hex_ids}).drop_duplicates(subset=['transactionid'])
+
+    def batched_path():
+        hex_ids = hash_transaction_ids(transaction_ids, output='hex')
+        return first_occurrences(fixed_width_keys(hex_ids))
+
+    previous = best_time(previous_path, 1)
+    digests = best_time(lambda: sha256_digests(transaction_ids), 1)
+    batched = best_time(batched_path, 1)
+    print(f"hash_transaction_ids: {rows} rows, row-wise hex and drop_duplicates {previous:.2f}s, batched hex and fixed-width dedup {batched:.2f}s, "
+          f"raw digests alone {digests:.2f}s")
+
+
+def benchmark_date_parsing(rows: int = 1000000):
+    rng = np.random.default_rng(0)
+    dates = pd.Series(rng.choice(pd.date_range('2015-01-01', '2025-12-31').strftime('%Y-%m-%d'), size=rows), dtype=object)
+    times = pd.Series([f"{hour:02d}:{minute:02d}:{second:02d}" for hour, minute, second in rng.integers(0, [24, 60, 60], size=(rows, 3))], dtype=object)
+
+    def previous_parsing():
+        transactiontime = pd.to_datetime(times, format=TIME_FORMAT, errors='coerce')
+        pd.to_datetime(dates, errors='coerce') + pd.to_timedelta(transactiontime.dt.hour, unit='h') + pd.to_timedelta(transactiontime.dt.minute, unit='m')
+        return pd.to_datetime(dates, errors='coerce').dt.date
+
+    row_wise = best_time(previous_parsing, 1)
+    single_pass = best_time(lambda: (parse_dates(dates) + parse_times_of_day(times).dt.floor('min'), parse_dates(dates).dt.normalize()), 1)
+    print(f"parse_dates: {rows} rows, previous parsing {row_wise:.3f}s, single pass {single_pass:.3f}s")
+
+
+if __name__ == "__main__":
+    phone_corpus = generate_phone_corpus(200000)
+    benchmark(transform_phone_number, normalize_phone_numbers, phone_corpus)
+    address_corpus = generate_address_corpus(200000)
+    benchmark(transform_address, classify_regions, address_corpus)
+
+    # Repeated values are what the memoized path is for: 1M rows drawn from a few thousand distinct phones and addresses
+    for reference, vectorized, corpus in [(transform_phone_number, normalize_phone_numbers, phone_corpus[:5000]),
+                                          (transform_address, classify_regions, address_corpus[:5000])]:
+        repeated = corpus.sample(1000000, replace=True, random_state=0).reset_index(drop=True)
+        benchmark(reference, Memoized_Normalizer(vectorized), repeated, repeat=1)
+
+    benchmark_transaction_hashing()
+    benchmark_date_parsing()
@@ -0,0 +1,57 @@
+"""
+Time of the profile feature kernels against the pandas code they replace, at 200k and 1M transactions. Their
+equivalence is checked in tests/test_profile_features.py, which also holds the pandas versions timed here.
+
+Run from the repository root: python -m benchmarks.profile_features
+"""
+import time
+from profile_features import (aggregate_features, category_counts, new_beneficiary_ratio, night_time_flags, rolling_window_maxima,
+                              synthetic_transactions)
+from tests.test_profile_features import (ROLLING_WINDOWS, SENDER_FEATURES, event_features, pandas_event_features, pandas_night_and_new_beneficiary,
+                                         pandas_rolling_maxima, pandas_sender_features)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def pandas_category_blobs(df_transactions, column):
+    # The '{"<key>": <count>, ...}' strings the profiles stored before the breakdowns table
+    return df_transactions.groupby(['fromentity', column]).size().reset_index().rename(columns={0: "count"})\
+        .assign(blob=lambda x: '"' + x[column].astype(str) + '": ' + x['count'].astype(int).astype(str))\
+        .groupby('fromentity')['blob'].agg(lambda x: '{' + ', '.join(x) + '}')
+
+
+def benchmark(rows: int, entities: int):
+    df_transactions = synthetic_transactions(rows, entities)
+
+    _, pandas_seconds = timed(lambda: pandas_sender_features(df_transactions))
+    _, kernel_seconds = timed(lambda: aggregate_features(df_transactions, 'fromentity', SENDER_FEATURES))
+    print(f"aggregate_features: {rows} transactions, {len(SENDER_FEATURES)} features, pandas {pandas_seconds:.2f}s, one groupby {kernel_seconds:.2f}s")
+
+    _, pandas_seconds = timed(lambda: pandas_night_and_new_beneficiary(df_transactions))
+    _, kernel_seconds = timed(lambda: (night_time_flags(df_transactions['transactiondatetime']),
+                                       new_beneficiary_ratio(df_transactions['fromentity'], df_transactions['toentity'])))
+    print(f"night_time_flags / new_beneficiary_ratio: {rows} transactions, pandas {pandas_seconds:.2f}s, vectorized {kernel_seconds:.3f}s")
+
+    blobs, pandas_seconds = timed(lambda: pandas_category_blobs(df_transactions, 'toentity'))
+    result, kernel_seconds = timed(lambda: category_counts(df_transactions['fromentity'], df_transactions['toentity']))
+    top_3 = category_counts(df_transactions['fromentity'], df_transactions['toentity'], top_k=3)
+    print(f"category_counts: {rows} transactions, string blobs {pandas_seconds:.2f}s / {blobs.str.len().sum() / 2 ** 20:.1f} MiB, "
+          f"long rows {kernel_seconds:.3f}s / {len(result)} rows, top 3 {len(top_3)} rows")
+
+    _, pandas_seconds = timed(lambda: pandas_rolling_maxima(df_transactions))
+    result, kernel_seconds = timed(lambda: rolling_window_maxima(df_transactions['fromentity'], df_transactions['transactiondatetime'],
+                                                                 df_transactions['amountinbirr'], ROLLING_WINDOWS))
+    print(f"rolling_window_maxima: {rows} transactions, {len(result)} entities, pandas {pandas_seconds:.2f}s, kernel {kernel_seconds:.3f}s")
+
+    expected, pandas_seconds = timed(lambda: pandas_event_features(df_transactions))
+    _, kernel_seconds = timed(lambda: event_features(df_transactions))
+    print(f"entity_events: {rows} transactions, {len(expected)} entities, pandas {pandas_seconds:.2f}s, event table {kernel_seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    for rows, entities in [(200000, 20000), (1000000, 100000)]:
+        benchmark(rows, entities)
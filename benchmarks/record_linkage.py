@@ -0,0 +1,49 @@
+"""
+Time of the union-find clustering and of blocked record linkage on synthetic persons, with the share of matched pairs
+that are the same person, and of the sharded linkage on 1, 2 and all CPUs. Their results are checked in
+tests/test_record_linkage.py and tests/test_sharded_linkage.py.
+
+Run from the repository root: python -m benchmarks.record_linkage
+"""
+import os
+import time
+import numpy as np
+from record_linkage import connected_components, generate_person_corpus, link_records
+from sharded_linkage import link_records_sharded
+
+
+def benchmark_connected_components():
+    rng = np.random.default_rng(0)
+    for rows, pairs in [(100000, 90000), (1000000, 2000000)]:
+        left, right = rng.integers(0, rows, pairs), rng.integers(0, rows, pairs)
+        start = time.perf_counter()
+        cluster_ids = connected_components(left, right, rows)
+        print(f"connected_components: {rows} rows, {pairs} pairs, {cluster_ids.max() + 1} clusters in {time.perf_counter() - start:.3f}s")
+
+
+def benchmark_link_records():
+    for persons in [10000, 100000]:
+        df_person = generate_person_corpus(persons)
+        left, right, stats = link_records(df_person.drop(columns=['person']))
+        true_pairs = (df_person['person'].to_numpy()[left] == df_person['person'].to_numpy()[right]).sum()
+        print(f"{len(df_person)} records: {stats}, {true_pairs} of the matched pairs are the same person")
+
+
+def benchmark_sharded_linkage():
+    for persons in [10000, 50000]:
+        df_person = generate_person_corpus(persons).drop(columns=['person'])
+        start = time.perf_counter()
+        link_records(df_person)
+        serial_seconds = time.perf_counter() - start
+        for workers in sorted({1, 2, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            _, _, sharded_stats = link_records_sharded(df_person, workers=workers)
+            sharded_seconds = time.perf_counter() - start
+            print(f"{len(df_person)} records: link_records {serial_seconds:.2f}s, sharded on {workers} workers {sharded_seconds:.2f}s "
+                  f"({sharded_stats['shards']} shards, {sharded_stats['matched_pairs']} matched pairs)")
+
+
+if __name__ == "__main__":
+    benchmark_connected_components()
+    benchmark_link_records()
+    benchmark_sharded_linkage()
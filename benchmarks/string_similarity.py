@@ -0,0 +1,31 @@
+"""
+Pairs per second of the batched string similarities against their scalar references, on 200k realistic name pairs. Their
+equivalence is checked in tests/test_string_similarity.py.
+
+Run from the repository root: python -m benchmarks.string_similarity
+"""
+import time
+from string_similarity import (jaro_winkler, jaro_winkler_pairs, levenshtein_similarity, levenshtein_similarity_pairs, name_variant_pairs, ngram_jaccard,
+                               ngram_jaccard_pairs, njit)
+
+
+def benchmark_pairs(reference, batched_version, first, second, **options):
+    start = time.perf_counter()
+    for a, b in zip(first, second):
+        reference(a, b)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    batched_version(first, second, **options)
+    batched_seconds = time.perf_counter() - start
+    print(f"{batched_version.__name__}{options or ''}: {len(first) / reference_seconds:,.0f} pairs/s reference, "
+          f"{len(first) / batched_seconds:,.0f} pairs/s batched ({reference_seconds / batched_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    first, second = name_variant_pairs(200000)
+    compiled_options = [{'compiled': False}] + ([{'compiled': True}] if njit is not None else [])
+    for reference, batched_version, variants in [(jaro_winkler, jaro_winkler_pairs, compiled_options),
+                                                 (levenshtein_similarity, levenshtein_similarity_pairs, compiled_options),
+                                                 (ngram_jaccard, ngram_jaccard_pairs, [{}])]:
+        for options in variants:
+            benchmark_pairs(reference, batched_version, first, second, **options)
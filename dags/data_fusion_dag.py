@@ -6,18 +6,22 @@ with DAG(
     "Data_Fusion_Pipeline",
     start_date=datetime(2026, 1, 1),
     schedule="@daily",
+    # Stages run incrementally from their watermarks; trigger with {"full_rebuild": true} to reprocess the whole history
+    params={"full_rebuild": False},
 ) as dag:
     
+    full_rebuild_flag = "{{ '--full-rebuild' if params.full_rebuild else '' }}"
+    
     data_cleaning = BashOperator(
         task_id="data_cleaning",
-        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_data_cleaning.py'",
+        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_data_cleaning.py' " + full_rebuild_flag,
         dag = dag
     )
 
 
     identity_resolution = BashOperator(
         task_id="identity_resolution",
-        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_identity_resolution.py'",
+        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_identity_resolution.py' " + full_rebuild_flag,
         dag = dag
     )
 
@@ -25,7 +29,7 @@ with DAG(
 
     user_profile = BashOperator(
         task_id="user_profile",
-        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_user_profiles.py'",
+        bash_command="'/home/fusion/airflow_jobs/.venv/bin/python3' '/home/fusion/airflow_jobs/spark_job_user_profiles.py' " + full_rebuild_flag,
         dag = dag
     )
 
@@ -0,0 +1,53 @@
+"""
+Persisted entity index for incremental identity resolution.
+
+The index maps every blocking key of every resolved person to its personid, as one text key per row
+("<key type>:<value>"), so an incremental run only has to load the entities that share a key with its new records:
+
+    - phonetic_alias / phone_suffix: the keyed blocking passes of record_linkage
+    - alias / phonenumber: exact lookups, so an already known name or phone always finds its entity
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+from record_linkage import blocking_key_values, cluster_content_ids
+
+
+INDEX_KEY_TYPES = ['phonetic_alias', 'phone_suffix', 'alias', 'phonenumber']
+
+
+def index_keys(df_person: pd.DataFrame):
+    # One Series of index keys per key type, aligned to df_person, NA where the row has no such key
+    values = blocking_key_values(df_person)
+    values['alias'] = df_person['alias']
+    values['phonenumber'] = df_person['phonenumber']
+    return {key_type: (key_type + ':' + values[key_type].astype('string')) for key_type in INDEX_KEY_TYPES}
+
+
+def index_entries(df_person: pd.DataFrame):
+    # The (indexkey, personid) rows of the index for the given resolved persons
+    entries = pd.concat([pd.DataFrame({'indexkey': keys, 'personid': df_person['personid']}) for keys in index_keys(df_person).values()],
+                        ignore_index=True)
+    return entries.dropna(subset=['indexkey']).drop_duplicates(ignore_index=True)
+
+
+def lookup_keys(df_person: pd.DataFrame):
+    return pd.unique(pd.concat(list(index_keys(df_person).values()), ignore_index=True).dropna())
+
+
+def assign_personids(cluster_ids: np.ndarray, existing_personids: pd.Series, keys: pd.Series, prefix: str = 'ENTITY_'):
+    """
+    personid for every row of a resolved batch. Clusters that contain indexed rows keep their (smallest) existing personid,
+    so entities merged by the new records collapse into one of the ids already in use. New clusters get a content id.
+    """
+    existing_personids = pd.Series(existing_personids.astype('string').to_numpy(), dtype='string')
+    inherited = existing_personids.groupby(cluster_ids).min().reindex(range(cluster_ids.max() + 1)).to_numpy()[cluster_ids]
+    fresh = cluster_content_ids(cluster_ids, keys, prefix=prefix)
+    return np.where(pd.isna(inherited), fresh, inherited).astype(object)
+
+
+def merged_personids(existing_personids: pd.Series, personids: np.ndarray):
+    # Existing personid -> the personid it was merged into, for ids that changed in this run
+    existing_personids = existing_personids.astype('string').reset_index(drop=True)
+    changed = (existing_personids.notna() & (existing_personids != personids)).to_numpy(dtype=bool, na_value=False)
+    return pd.Series(personids[changed], index=existing_personids[changed].to_numpy(), dtype=object).groupby(level=0).first()
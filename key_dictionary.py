@@ -0,0 +1,46 @@
+"""
+Integer key dictionaries for the joins of identity resolution.
+
+A Key_Dictionary holds the distinct values of one kind of key (aliases, account numbers, entity ids). Every column holding that
+kind of key is encoded against the same dictionary, so joins between them run on integer codes instead of string hash joins:
+
+    - codes / encode: one hash lookup per value, -1 for missing or unknown keys. The column the dictionary is built from gets
+      its codes from the same pass.
+    - first_value_table / lookup: the left merge onto a drop_duplicates(keep='first') right side, as a take on a code-indexed array
+    - decode: a Categorical over the dictionary, the strings are only materialized when the column is written out
+
+tests/test_key_dictionary.py checks the lookups against the pandas merges they replace, benchmarks/key_dictionary.py compares
+their time and peak memory.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+
+
+class Key_Dictionary:
+    def __init__(self, values):
+        codes, keys = pd.factorize(pd.Series(values, dtype=object))
+        self.codes = codes.astype(np.int64)
+        self.keys = pd.Index(keys, dtype=object)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def encode(self, values):
+        return self.keys.get_indexer(pd.Series(values, dtype=object)).astype(np.int64)
+
+    def decode(self, codes: np.ndarray):
+        return pd.Categorical.from_codes(codes, categories=self.keys)
+
+
+def first_value_table(key_codes: np.ndarray, value_codes: np.ndarray, size: int):
+    # key code -> value code of the first row holding that key, -1 for keys no row holds
+    table = np.full(size, -1, dtype=np.int64)
+    valid = key_codes >= 0
+    keys, first = np.unique(key_codes[valid], return_index=True)
+    table[keys] = value_codes[valid][first]
+    return table
+
+
+def lookup(table: np.ndarray, codes: np.ndarray):
+    return np.where(codes >= 0, table[codes], -1)
@@ -0,0 +1,396 @@
+"""
+Shared normalization rules for the data fusion stages.
+
+    - Phone numbers are normalized to the 251********* format
+    - Free-text addresses are classified into region codes by an ordered rule table
+    - Memoized_Normalizer runs any of these only once per distinct value
+    - Transaction ids are hashed with SHA-256 in batches, optionally across worker processes
+    - Date and time columns are parsed with known formats, once per distinct value, into datetime64
+
+Every vectorized rule keeps its scalar reference implementation next to it, tests/test_normalization.py checks that both
+agree and benchmarks/normalization.py reports their throughput.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+from collections import OrderedDict
+import hashlib
+import string
+
+
+# Phone numbers
+
+def transform_phone_number(phone):
+    if "." in str(phone):
+        phone = str(phone).split('.')[0]
+
+    delete_chars = string.ascii_letters + string.punctuation + " "
+    table = str.maketrans('', '', delete_chars)
+    phone = str(phone).translate(table)
+
+    if isinstance(phone, str):
+        phone = phone.strip()
+        if len(phone) < 7:
+            return pd.NA
+        elif phone.startswith("0"):
+            return f"251{phone[1:]}"
+        elif phone.startswith("9"):
+            return f"251{phone}"
+        elif phone.startswith("+251"):
+            return phone[1:]
+        elif phone.startswith("251"):
+            return phone
+        elif phone.startswith("+9"):
+            return f"251{phone[2:]}"
+        elif len(phone) == 8:
+            return f"2519{phone}"
+        elif len(phone) == 10 and not phone.startswith("09"):
+            return f"251{phone[2:]}"
+    else:
+        try:
+            phone = str(int(phone))
+            transform_phone_number(phone)
+        except:
+            return pd.NA
+    return phone
+
+
+# ascii_letters + punctuation + " " is every printable ASCII character except the digits. The first alternative drops
+# everything from the first "." on, which is why "." is left out of the deleted run in the second one.
+PHONE_CLEAN_PATTERN = r'\.[\s\S]*|[\x20-\x2d\x2f\x3a-\x7e]+'
+
+
+def normalize_phone_numbers(phones: pd.Series):
+    # Vectorized transform_phone_number. The "+251" and "+9" branches of the scalar version can never
+    # match because "+" is deleted before the prefix checks, so they are not reproduced here.
+    result = np.full(len(phones), pd.NA, dtype=object)
+    present = phones.notna().to_numpy()
+    if not present.any():
+        return pd.Series(result, index=phones.index, dtype=object)
+
+    phone = phones[present].astype(str).astype(object).str.replace(PHONE_CLEAN_PATTERN, '', regex=True).str.strip()
+    values = phone.to_numpy()
+    length = phone.str.len().to_numpy()
+    first_digit = phone.str[:1].to_numpy()
+
+    # Branches are checked in the same order as the scalar version, only the rows of each branch are rewritten
+    keep, drop_zero, add_prefix, add_prefix_nine, drop_two = range(5)
+    branch = np.select(
+        [length < 7, first_digit == '0', first_digit == '9', phone.str.startswith('251').to_numpy(), length == 8, length == 10],
+        [-1, drop_zero, add_prefix, keep, add_prefix_nine, drop_two],
+        default=keep)
+
+    normalized = values.copy()
+    normalized[branch == -1] = pd.NA
+    for code, prefix, offset in [(drop_zero, '251', 1), (add_prefix, '251', 0), (add_prefix_nine, '2519', 0), (drop_two, '251', 2)]:
+        rows = branch == code
+        if rows.any():
+            normalized[rows] = (prefix + phone[rows].str[offset:]).to_numpy()
+
+    result[present] = normalized
+    return pd.Series(result, index=phones.index, dtype=object)
+
+
+# Addresses
+
+def transform_address(address):
+    address = str(address).strip().lower()
+    remove_chars = string.punctuation + string.digits + " "
+    table = str.maketrans('', '', remove_chars)
+    address = address.translate(table)
+
+    if address in ['nan', 'none', '', 'na']:
+        return pd.NA
+    elif "not" in address.split():
+        return pd.NA
+    elif len(address) > 3:
+        if ('aa' in address or "ad" in address or "add" in address or "aba" in address):
+            return "aa"
+        elif ('ti' in address or 'mk' in address or 'tig' in address or 'shire' in address or 'adw' in address or 'ax' in address or 'adi' in address):
+            return "tg"
+        elif ('or' in address):
+            return 'or'
+        elif ('snn' in address):
+            return 'snnp'
+        elif ('af' in address):
+            return 'af'
+        elif ('sid' in address):
+            return 'sid'
+        elif ('am' in address or 'amh' in address):
+            return 'am'
+        elif ('gam' in address):
+            return 'gamb'
+        elif ('so' in address):
+            return 'som'
+        elif ('ben' in address):
+            return 'bgum'
+        elif ('har' in address):
+            return 'har'
+        elif ('dd' in address or 'dire' in address or 'dre' in address):
+            return 'ddw'
+        else:
+            return pd.NA
+    else:
+        return address
+
+
+# Ordered region rules: the first region with a matching substring wins, so the order is part of the definition
+REGION_RULES = [
+    ('aa', ['aa', 'ad', 'add', 'aba']),
+    ('tg', ['ti', 'mk', 'tig', 'shire', 'adw', 'ax', 'adi']),
+    ('or', ['or']),
+    ('snnp', ['snn']),
+    ('af', ['af']),
+    ('sid', ['sid']),
+    ('am', ['am', 'amh']),
+    ('gamb', ['gam']),
+    ('som', ['so']),
+    ('bgum', ['ben']),
+    ('har', ['har']),
+    ('ddw', ['dd', 'dire', 'dre']),
+]
+
+# Every region code an address can be classified into
+LOCAL_ADDRESSES = [region for region, _ in REGION_RULES]
+
+ADDRESS_DELETE_TABLE = str.maketrans('', '', string.punctuation + string.digits + " ")
+MISSING_ADDRESSES = ['nan', 'none', '', 'na']
+
+
+def classify_regions(addresses: pd.Series):
+    # Vectorized transform_address: addresses longer than three characters go through the region rules,
+    # shorter ones are kept as they are
+    result = np.full(len(addresses), pd.NA, dtype=object)
+    present = addresses.notna().to_numpy()
+    if not present.any():
+        return pd.Series(result, index=addresses.index, dtype=object)
+
+    address = addresses[present].astype(str).astype(object).str.strip().str.lower().str.translate(ADDRESS_DELETE_TABLE)
+    values = address.to_numpy()
+    length = address.str.len().to_numpy()
+
+    # "not" as a whitespace-separated word, the regex only runs on the few rows that contain the substring at all
+    missing = address.isin(MISSING_ADDRESSES).to_numpy().copy()
+    contains_not = address.str.contains('not', regex=False).to_numpy()
+    if contains_not.any():
+        missing[contains_not] |= address[contains_not].str.contains(r'(?:^|\s)not(?:\s|$)', regex=True).to_numpy()
+
+    classified = np.where(length > 3, pd.NA, values)
+    unmatched = np.flatnonzero(~missing & (length > 3))
+    # Fixed-width unicode arrays let np.char run the substring checks in C, each rule only sees the rows no earlier rule took
+    candidates = values[unmatched].astype(str)
+    for region, keywords in REGION_RULES:
+        if len(unmatched) == 0:
+            break
+        matched = np.zeros(len(unmatched), dtype=bool)
+        for keyword in keywords:
+            matched |= np.char.find(candidates, keyword) >= 0
+        classified[unmatched[matched]] = region
+        unmatched, candidates = unmatched[~matched], candidates[~matched]
+
+    classified[missing] = pd.NA
+    result[present] = classified
+    return pd.Series(result, index=addresses.index, dtype=object)
+
+
+# Transaction ids
+
+def sha256_batch(values: list):
+    sha256 = hashlib.sha256
+    # Non-string ids get a digest of their repr behind a NUL prefix, so equal values (including NA) still share a key
+    return [sha256(value.encode()).digest() if isinstance(value, str) else sha256(b'\x00' + repr(value).encode()).digest() for value in values]
+
+
+def sha256_hex_batch(values: list):
+    # 64-character hex digests of string ids, anything else passes through unchanged like in the row-wise hashing
+    sha256 = hashlib.sha256
+    return [sha256(value.encode()).hexdigest() if isinstance(value, str) else value for value in values]
+
+
+def sha256_digests(values: pd.Series, executor=None, batch_rows: int = 100000):
+    # Returns the 32-byte digests as an (n, 32) uint8 array. hashlib only releases the GIL for buffers over 2 KiB, so
+    # short ids are hashed in batches on a process pool when an executor is given rather than on threads.
+    values = values.to_numpy(dtype=object)
+    batches = [values[start:start + batch_rows].tolist() for start in range(0, len(values), batch_rows)]
+    if executor is None:
+        digests = [sha256_batch(batch) for batch in batches]
+    else:
+        digests = list(executor.map(sha256_batch, batches))
+    return np.frombuffer(b''.join(digest for batch in digests for digest in batch), dtype=np.uint8).reshape(-1, 32)
+
+
+def hash_transaction_ids(transaction_ids: pd.Series, output: str = 'hex', digests=None, executor=None, batch_rows: int = 100000):
+    # output='hex' keeps the 64-character strings of the old row-wise hashing (non-string ids pass through unchanged),
+    # 'digest' gives the exact 32 raw bytes per id and 'int64' the first 8 bytes as a signed integer, which can collide
+    if output not in ('hex', 'digest', 'int64'):
+        raise ValueError(f"Unsupported hash output: {output}")
+    if output == 'hex' and digests is None:
+        # hexdigest per id is quicker than hex-encoding the raw digests afterwards
+        values = transaction_ids.to_numpy(dtype=object)
+        batches = [values[start:start + batch_rows].tolist() for start in range(0, len(values), batch_rows)]
+        hashed = [sha256_hex_batch(batch) for batch in batches] if executor is None else list(executor.map(sha256_hex_batch, batches))
+        return pd.Series([value for batch in hashed for value in batch], index=transaction_ids.index, dtype=object)
+    if digests is None:
+        digests = sha256_digests(transaction_ids, executor=executor)
+
+    if output == 'int64':
+        return pd.Series(np.ascontiguousarray(digests[:, :8]).view('<i8')[:, 0], index=transaction_ids.index)
+    if output == 'digest':
+        raw = np.ascontiguousarray(digests).tobytes()
+        return pd.Series([raw[start:start + 32] for start in range(0, len(raw), 32)], index=transaction_ids.index, dtype=object)
+
+    if pd.api.types.is_string_dtype(transaction_ids.dtype) and transaction_ids.dtype != object:
+        is_string = transaction_ids.notna().to_numpy()
+    else:
+        is_string = np.fromiter((isinstance(value, str) for value in transaction_ids.to_numpy(dtype=object)), dtype=bool, count=len(transaction_ids))
+    hex_digests = np.ascontiguousarray(digests[is_string]).tobytes().hex()
+    hashed = transaction_ids.to_numpy(dtype=object).copy()
+    hashed[is_string] = [hex_digests[start:start + 64] for start in range(0, len(hex_digests), 64)]
+    return pd.Series(hashed, index=transaction_ids.index, dtype=object)
+
+
+def fixed_width_keys(values: pd.Series):
+    # (n, width) uint8 array of the values as fixed-width byte strings, missing values become empty keys (so they share a key with '')
+    keys = np.asarray(values.fillna('').to_numpy(dtype=object), dtype=bytes)
+    return keys.view(np.uint8).reshape(len(keys), keys.dtype.itemsize)
+
+
+def first_occurrences(keys: np.ndarray):
+    """
+    Positions of the first row of every distinct row of an (n, width) uint8 key array (digests or fixed_width_keys), in
+    row order. Rows are deduplicated on their first 8 bytes as int64 keys, and only rows whose prefix repeats are compared
+    on the full width, through np.unique over a void view, so the result stays exact.
+    """
+    keys = np.ascontiguousarray(keys)
+    if keys.shape[1] < 8:
+        keys = np.pad(keys, ((0, 0), (0, 8 - keys.shape[1])))
+    prefixes = pd.Series(keys[:, :8].copy().view('<i8')[:, 0])
+    duplicate = prefixes.duplicated().to_numpy(copy=True)
+    if duplicate.any():
+        candidates = np.flatnonzero(prefixes.duplicated(keep=False).to_numpy())
+        _, first = np.unique(keys[candidates].view(np.dtype((np.void, keys.shape[1])))[:, 0], return_index=True)
+        duplicate[candidates] = True
+        duplicate[candidates[first]] = False
+    return np.flatnonzero(~duplicate)
+
+
+# Dates and times
+
+# None parses strings like pd.to_datetime always did: the format is inferred from the first value and applied to the rest,
+# so ambiguous slash dates are month-first ('03/04/2024' is 4 March) and values that don't fit become NaT. Set a format
+# (DATA_FUSION_DATE_FORMAT in the cleaning stage) when the source is known to write dates another way.
+DATE_FORMAT = None
+TIME_FORMAT = '%H:%M:%S'
+
+
+def parse_dates(values: pd.Series, date_format: str = DATE_FORMAT):
+    # Returns tz-naive datetime64[us] (never object dates). Only the distinct values are parsed and mapped back by code,
+    # date/datetime objects from DATE or TIMESTAMP source columns need no format at all.
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        parsed = pd.Series(values, copy=True)
+        return parsed.dt.tz_localize(None) if parsed.dt.tz is not None else parsed
+
+    codes, uniques = pd.factorize(values.to_numpy(dtype=object), use_na_sentinel=True)
+    parsed = np.full(len(uniques) + 1, np.datetime64('NaT', 'us'), dtype='datetime64[us]')
+    is_string = np.fromiter((isinstance(value, str) for value in uniques), dtype=bool, count=len(uniques))
+
+    if (~is_string).any():
+        parsed[:-1][~is_string] = to_naive_datetimes(pd.to_datetime(pd.Series(uniques[~is_string], dtype=object), errors='coerce'))
+    if is_string.any():
+        # Uniques keep the order of first appearance, so format inference sees the same first value as on the full column
+        parsed[:-1][is_string] = to_naive_datetimes(pd.to_datetime(pd.Series(uniques[is_string], dtype=object), format=date_format, errors='coerce'))
+
+    # The NA sentinel (-1) picks the trailing NaT
+    return pd.Series(parsed[codes], index=values.index)
+
+
+def parse_times_of_day(values: pd.Series, time_format: str = TIME_FORMAT):
+    # Time of day as timedelta64[us] since midnight, parsed once per distinct value; time objects from TIME columns
+    # are formatted back to text first
+    codes, uniques = pd.factorize(values.to_numpy(dtype=object), use_na_sentinel=True)
+    times = pd.to_datetime(pd.Series(uniques, dtype=object).map(str), format=time_format, errors='coerce')
+    offsets = np.append((times - times.dt.normalize()).to_numpy(dtype='timedelta64[us]'), np.timedelta64('NaT', 'us'))
+    return pd.Series(offsets[codes], index=values.index)
+
+
+def to_naive_datetimes(parsed: pd.Series):
+    if parsed.dt.tz is not None:
+        parsed = parsed.dt.tz_localize(None)
+    return parsed.to_numpy(dtype='datetime64[us]')
+
+
+# Memoization
+
+class Memoized_Normalizer:
+    # Wraps a vectorized Series -> Series transform. Each call factorizes the column, transforms only the distinct values
+    # that are not cached yet and maps the results back by code. The LRU cache is bounded and outlives the call, so
+    # values repeated across chunks are transformed once.
+    def __init__(self, transform, max_size: int = 200000):
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self.transform = transform
+        self.__name__ = f"memoized {getattr(transform, '__name__', 'transform')}"
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.missing_value = transform(pd.Series([pd.NA], dtype=object)).iloc[0]
+
+    def __call__(self, values: pd.Series):
+        codes, uniques = pd.factorize(values.to_numpy(dtype=object), use_na_sentinel=True)
+        transformed = np.empty(len(uniques) + 1, dtype=object)
+        transformed[-1] = self.missing_value
+
+        new_positions = []
+        for position, value in enumerate(uniques):
+            if value in self.cache:
+                self.cache.move_to_end(value)
+                transformed[position] = self.cache[value]
+            else:
+                new_positions.append(position)
+        self.hits += len(uniques) - len(new_positions)
+        self.misses += len(new_positions)
+
+        if new_positions:
+            new_values = uniques[new_positions]
+            new_results = self.transform(pd.Series(new_values, dtype=object)).to_numpy(dtype=object)
+            transformed[new_positions] = new_results
+            # Only the most recent max_size values are kept, the current call already has every result it needs
+            for value, result in zip(new_values[-self.max_size:], new_results[-self.max_size:]):
+                self.cache[value] = result
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        # The NA sentinel (-1) picks the trailing missing_value slot
+        return pd.Series(transformed[codes], index=values.index, dtype=object)
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache), 'max_size': self.max_size}
+
+
+# Synthetic corpora for the tests and benchmarks
+
+def generate_phone_corpus(rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    digits = rng.integers(0, 10, size=(rows, 12)).astype(str)
+    bodies = np.array([''.join(row) for row in digits], dtype=object)
+    lengths = rng.integers(3, 13, size=rows)
+    prefixes = rng.choice(['', '0', '9', '+251', '251', '+9', '09', 'tel: ', '+251 ', '0 91', '(09)'], size=rows)
+    suffixes = rng.choice(['', '', '', '.0', '.5', ' ext 2', '\t', '-'], size=rows)
+    corpus = [prefix + body[:length] + suffix for prefix, body, length, suffix in zip(prefixes, bodies, lengths, suffixes)]
+
+    values = pd.Series(corpus, dtype=object)
+    values[rng.random(rows) < 0.05] = None
+    values[rng.random(rows) < 0.02] = 'not available'
+    return values
+
+
+def generate_address_corpus(rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    places = ['Addis Ababa', 'A.A', 'bole', 'Mekelle', 'tigray', 'adwa', 'axum', 'shire', 'Adigrat', 'oromia', 'adama', 'snnpr', 'hawassa',
+              'afar', 'semera', 'sidama', 'amhara', 'bahir dar', 'gambela', 'somali', 'jigjiga', 'benishangul', 'harar', 'dire dawa', 'dredawa',
+              'kirkos', 'yeka', 'gulele', 'lideta', 'kolfe', 'akaki', 'xyz', 'n/a', 'NA', 'none', 'not known', 'not\tknown', '', '12', 'w 03']
+    numbers = rng.choice(['', '', ' 01', ' 12', '/14', ' kebele 05', '-3'], size=rows)
+    values = pd.Series([place + number for place, number in zip(rng.choice(places, size=rows), numbers)], dtype=object)
+    values[rng.random(rows) < 0.05] = None
+    return values
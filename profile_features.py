@@ -0,0 +1,222 @@
+"""
+Vectorized feature kernels for the user profiles stage.
+
+    - rolling_window_maxima: the highest transaction count and amount any entity reached inside each time window, for all
+      windows from one sort by (entity, time). Window starts come from searchsorted over integer keys, counts and sums from
+      prefix sums, and the per-entity maxima from reduceat over the contiguous entity segments.
+    - night_time_flags / new_beneficiary_ratio: a boolean mask over the hours and bincounts over (sender, beneficiary) pair
+      codes in place of a lambda per row and a Python function per sender
+    - category_counts: how often every entity used every value of a column (branches, transaction types, beneficiaries) as
+      long (entity, key, count, rank) rows from np.unique over pair codes, optionally cut to each entity's top k. The stage
+      writes them to a side table instead of text blobs on the profile rows.
+    - recent_events: the latest events of every entity from the entity_events table, so the stored event times stay bounded
+      however long an entity's history gets
+
+The kernels are checked against the pandas code they replace in tests/test_profile_features.py, and timed against it in
+benchmarks/profile_features.py.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+import operator
+
+
+FILTER_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    'in': lambda column, value: column.isin(list(value)),
+    'not in': lambda column, value: ~column.isin(list(value)),
+}
+
+
+def rolling_window_maxima(entities: pd.Series, times: pd.Series, values: pd.Series, windows: dict):
+    """
+    max_freq_<name> and max_volume_<name> per entity for every {name: offset} of windows, the maxima over all rows of
+    rolling(offset).count() and rolling(offset).sum() of values in time order. Windows are (t - offset, t] like pandas
+    time-based rolling, rows without entity or time are left out.
+    """
+    keep = (entities.notna() & times.notna()).to_numpy()
+    entity_codes, entity_index = pd.factorize(entities[keep], sort=True)
+    timestamps = times[keep].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    amounts = values[keep].to_numpy(dtype=np.float64)
+
+    order = np.lexsort((timestamps, entity_codes))
+    entity_codes, timestamps, amounts = entity_codes[order], timestamps[order], amounts[order]
+
+    # Times are replaced by their rank among the distinct times, so (entity, time rank) packs into one sorted int64 key
+    distinct_times = np.unique(timestamps)
+    stride = len(distinct_times) + 1
+    keys = entity_codes.astype(np.int64) * stride + np.searchsorted(distinct_times, timestamps)
+
+    valid = ~np.isnan(amounts)
+    count_prefix = np.concatenate([[0], np.cumsum(valid)])
+    sum_prefix = np.concatenate([[0], np.cumsum(np.where(valid, amounts, 0), dtype=np.longdouble)])
+    segment_starts = np.flatnonzero(np.diff(entity_codes, prepend=-1)) if len(entity_codes) else np.empty(0, dtype=np.int64)
+    rows = np.arange(1, len(entity_codes) + 1)
+
+    counts, sums = {}, {}
+    for name, offset in windows.items():
+        first_time = np.searchsorted(distinct_times, timestamps - pd.Timedelta(offset).value, side='right')
+        window_starts = np.searchsorted(keys, entity_codes.astype(np.int64) * stride + first_time, side='left')
+        window_counts = (count_prefix[rows] - count_prefix[window_starts]).astype(np.float64)
+        window_sums = (sum_prefix[rows] - sum_prefix[window_starts]).astype(np.float64)
+        window_sums[window_counts == 0] = np.nan
+        counts[f"max_freq_{name}"] = np.maximum.reduceat(window_counts, segment_starts) if len(rows) else window_counts
+        sums[f"max_volume_{name}"] = np.fmax.reduceat(window_sums, segment_starts) if len(rows) else window_sums
+
+    return pd.DataFrame({**counts, **sums}, index=entity_index)
+
+
+def aggregate_features(df: pd.DataFrame, key_column: str, specs: list):
+    """
+    One groupby(key_column).agg() for every (feature, column, filter, aggregation) of specs. A filtered spec aggregates
+    column only over the rows matching its filter, and keys without matching rows get NaN, as if the rows had been
+    filtered before grouping. 'size' counts rows, every other aggregation is a pandas aggregation of the column.
+    """
+    frame = {key_column: df[key_column]}
+    aggregations = {}
+    filter_rows = {}
+    for feature, column, row_filter, aggregation in specs:
+        mask = None
+        if row_filter is not None:
+            filter_column, operator_name, value = row_filter
+            rows_column = filter_rows.setdefault(repr(row_filter), f"rows_{len(filter_rows)}")
+            # Comparisons on nullable columns give NA for missing values, which count as not matching like in boolean indexing
+            mask = FILTER_OPERATORS[operator_name](df[filter_column], value).to_numpy(dtype=bool, na_value=False)
+            if rows_column not in frame:
+                frame[rows_column] = pd.Series(mask.astype(np.int64), index=df.index)
+                aggregations[rows_column] = (rows_column, 'sum')
+
+        if aggregation == 'size' and mask is not None:
+            aggregations[feature] = (rows_column, 'sum')
+        elif aggregation == 'size':
+            aggregations[feature] = (key_column, 'size')
+        else:
+            frame[feature] = df[column] if mask is None else df[column].where(mask)
+            aggregations[feature] = (feature, aggregation)
+
+    result = pd.DataFrame(frame).groupby(key_column).agg(**aggregations)
+    for feature, column, row_filter, aggregation in specs:
+        if row_filter is not None:
+            result[feature] = result[feature].where(result[filter_rows[repr(row_filter)]] > 0)
+    return result[[feature for feature, *_ in specs]]
+
+
+def night_time_flags(times: pd.Series, night_start: int = 20, night_end: int = 6):
+    # 1 for transactions from night_start to before night_end o'clock, 0 otherwise and for missing times
+    hours = times.dt.hour
+    return ((hours >= night_start) | (hours < night_end)).astype(np.int64)
+
+
+def new_beneficiary_ratio(senders: pd.Series, beneficiaries: pd.Series):
+    """
+    Per sender, the share of its beneficiaries it paid only once times its number of transactions. Only transactions with
+    both a sender and a beneficiary count, like in a groupby over the pair.
+    """
+    keep = (senders.notna() & beneficiaries.notna()).to_numpy()
+    sender_codes, sender_index = pd.factorize(senders[keep], sort=True)
+    beneficiary_codes, beneficiary_index = pd.factorize(beneficiaries[keep])
+
+    pair_keys, pair_counts = np.unique(sender_codes.astype(np.int64) * len(beneficiary_index) + beneficiary_codes, return_counts=True)
+    pair_senders = pair_keys // max(len(beneficiary_index), 1)
+    beneficiaries_paid = np.bincount(pair_senders, minlength=len(sender_index))
+    paid_once = np.bincount(pair_senders, weights=pair_counts == 1, minlength=len(sender_index))
+    transactions = np.bincount(pair_senders, weights=pair_counts, minlength=len(sender_index))
+    return pd.Series(paid_once / beneficiaries_paid * transactions, index=sender_index)
+
+
+def entity_events(df_transactions: pd.DataFrame):
+    """
+    (entity, role, transactiondatetime, amountinbirr, time_lapse) for the sender and the beneficiary of every transaction.
+    Rows are ordered by entity, then time with missing times last, then senders before beneficiaries in transaction order.
+    Times are parsed with pd.to_datetime, since databases without a timestamp type (SQLite) return them as text.
+    """
+    df_transactions = df_transactions.assign(transactiondatetime=pd.to_datetime(df_transactions['transactiondatetime'], errors='coerce'))
+    events = pd.concat([
+        df_transactions[['fromentity', 'transactiondatetime', 'amountinbirr']].rename(columns={'fromentity': 'entity'}).assign(role='sender'),
+        df_transactions[['toentity', 'transactiondatetime', 'amountinbirr']].rename(columns={'toentity': 'entity'}).assign(role='beneficiary'),
+    ], ignore_index=True)
+    events = events[events['entity'].notna().to_numpy()]
+
+    entity_codes = pd.factorize(events['entity'], sort=True)[0]
+    times = events['transactiondatetime']
+    order = np.lexsort((times.to_numpy(dtype='datetime64[ns]').astype(np.int64), times.isna().to_numpy(), entity_codes))
+    events = events.iloc[order].reset_index(drop=True)[['entity', 'role', 'transactiondatetime', 'amountinbirr']]
+
+    same_entity = np.r_[False, entity_codes[order][1:] == entity_codes[order][:-1]]
+    events['time_lapse'] = events['transactiondatetime'].diff().where(same_entity)
+    return events
+
+
+def time_lapse_minutes(events: pd.DataFrame):
+    # min/max/avg minutes between consecutive events of an entity, -1 for entities with a single event
+    return events.assign(time_lapse=events['time_lapse'].dt.total_seconds() / 60)\
+        .groupby('entity', sort=False)\
+        .agg(min_time_lapse_minutes=('time_lapse', 'min'), max_time_lapse_minutes=('time_lapse', 'max'), avg_time_lapse_minutes=('time_lapse', 'mean'))\
+        .fillna(-1)\
+        .round(2)
+
+
+def sorted_codes(values: pd.Series):
+    # pd.factorize(values, sort=True), with only the distinct values sorted
+    codes, uniques = pd.factorize(values)
+    order = uniques.argsort()
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return ranks[codes], uniques[order]
+
+
+def category_counts(entities: pd.Series, keys: pd.Series, top_k: int = None):
+    """
+    (entity, key, count, rank) for every value an entity has in keys, rows with either missing are left out. Keys are
+    compared as strings, ranks start at 1 and order the keys of an entity by count, most frequent first, then by key.
+    With top_k only the top_k ranks of every entity are kept. Rows are sorted by entity and rank, entity and key are
+    Categoricals.
+    """
+    keep = (entities.notna() & keys.notna()).to_numpy()
+    entity_codes, entity_index = sorted_codes(entities[keep])
+    key_codes, key_index = sorted_codes(keys[keep].astype(str))
+
+    key_range = max(len(key_index), 1)
+    pairs, counts = np.unique(entity_codes * key_range + key_codes, return_counts=True)
+    pair_entities, pair_keys = pairs // key_range, pairs % key_range
+    order = np.lexsort((pair_keys, -counts, pair_entities))
+    pair_entities, pair_keys, counts = pair_entities[order], pair_keys[order], counts[order]
+    ranks = np.arange(len(pairs)) - np.searchsorted(pair_entities, pair_entities, side='left') + 1
+
+    selected = ranks <= top_k if top_k else slice(None)
+    return pd.DataFrame({
+        'entity': pd.Categorical.from_codes(pair_entities[selected], categories=entity_index),
+        'key': pd.Categorical.from_codes(pair_keys[selected], categories=key_index),
+        'count': counts[selected],
+        'rank': ranks[selected],
+    })
+
+
+def recent_events(events: pd.DataFrame, max_events: int = None):
+    # (entity, role, transactiondatetime, time_lapse) of the timed events of every entity, oldest first, time_lapse in minutes
+    # since the previous event of the entity. With max_events only the last max_events of every entity are kept.
+    timed = events[events['transactiondatetime'].notna().to_numpy()]
+    if max_events:
+        timed = timed[timed.groupby('entity', sort=False).cumcount(ascending=False).to_numpy() < max_events]
+    return timed[['entity', 'role', 'transactiondatetime']].assign(time_lapse=(timed['time_lapse'].dt.total_seconds() / 60).round(2)).reset_index(drop=True)
+
+
+# Synthetic transactions for the tests and benchmarks
+
+def synthetic_transactions(rows: int, entities: int, seed: int = 0):
+    # Zipf-distributed senders (a few very active entities), 2% without a sender and 1% without an amount
+    rng = np.random.default_rng(seed)
+    amounts = rng.gamma(2, 5000, rows).round(2)
+    amounts[rng.random(rows) < 0.01] = np.nan
+    return pd.DataFrame({
+        'fromentity': np.where(rng.random(rows) < 0.02, None, np.char.add('ENTITY_', rng.zipf(1.5, rows).clip(max=entities).astype(str))),
+        'toentity': np.char.add('ENTITY_', rng.integers(0, entities, rows).astype(str)),
+        'transactiondatetime': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 90 * 24 * 60, rows), unit='min'),
+        'amountinbirr': amounts,
+        'transactiontype': np.random.default_rng(seed + 1).choice(np.array(['cash', 'transfer', 'cheque', None], dtype=object), rows),
+    })
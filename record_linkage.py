@@ -0,0 +1,399 @@
+"""
+Blocked record linkage for identity resolution.
+
+Comparing every pair inside a sex/location block is quadratic, so candidate pairs come from several cheap blocking passes instead:
+
+    - phonetic_alias: Soundex codes of the first two name tokens, so spelling variants of the same name share a block
+    - phone_suffix: the last digits of the normalized phone number
+    - sorted_neighbourhood: every record against its neighbours when sorted by the letters of its alias
+
+Blocks larger than max_block_size are not expanded to all pairs, their records are only compared within a sorted window.
+The candidate pairs are compared column by column on integer codes, string similarities are computed once per distinct
+pair of values with the batched kernels of string_similarity, and the weighted scorer is the one the recordlinkage prototype
+used. Its weights and thresholds are calibrated on the labelled corpus of benchmarks/identity_resolution.py: a pair also needs
+MIN_MATCH_POINTS of agreement, so a similar name alone (or with the weak location and occupation agreements) never links two
+records, it takes a matching phone or birthdate as well. Without that rule, chains of name-only matches merged most of the
+corpus into a few clusters.
+Matched pairs are merged into clusters with an array-backed union-find, so overlapping match groups join the same entity,
+and every cluster is named by a content hash of its smallest member key so ids are the same from one run to the next.
+It is checked in tests/test_record_linkage.py and timed in benchmarks/record_linkage.py.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+import time
+from string_similarity import jaro_winkler_pairs
+from normalization import sha256_digests
+
+
+BLOCKING_PASSES = ['phonetic_alias', 'phone_suffix', 'sorted_neighbourhood']
+
+# (feature, column, method, threshold), missing values on either side give NaN and are left out of the score
+COMPARISONS = [
+    ('birthdate_match', 'birthdate', 'exact', None),
+    ('phone_match', 'phonenumber', 'exact', None),
+    ('phone_similarity', 'phonenumber', 'jarowinkler', 0.95),
+    ('alias_score', 'alias', 'jarowinkler', 0.9),
+    ('location_score', 'location', 'jarowinkler', 0.7),
+    ('job_score', 'occupation', 'jarowinkler', 0.8),
+]
+
+WEIGHTS = {
+    'birthdate_match': 0.5,
+    'phone_match': 0.05,
+    'phone_similarity': 0.35,
+    'alias_score': 0.45,
+    'location_score': 0.05,
+    'job_score': 0.05,
+}
+
+# Share of the possible points a pair needs, and the points it needs whatever was missing
+MATCH_THRESHOLD = 0.6
+MIN_MATCH_POINTS = 0.7
+
+
+# Blocking keys
+
+SOUNDEX_CODES = {character: code for characters, code in [('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'), ('l', '4'), ('mn', '5'), ('r', '6')]
+                 for character in characters}
+
+
+def soundex(token: str, length: int = 4):
+    letters = [character for character in token.lower() if 'a' <= character <= 'z']
+    if not letters:
+        return ''
+
+    code = letters[0].upper()
+    previous = SOUNDEX_CODES.get(letters[0], '')
+    for character in letters[1:]:
+        digit = SOUNDEX_CODES.get(character, '')
+        if digit and digit != previous:
+            code += digit
+            if len(code) == length:
+                break
+        # h and w do not separate two letters with the same code, vowels do
+        if character not in 'hw':
+            previous = digit
+    return code.ljust(length, '0')
+
+
+def phonetic_alias_key(alias: str):
+    tokens = [soundex(token) for token in alias.split()[:2]]
+    return ' '.join(token for token in tokens if token) or None
+
+
+def phonetic_alias_values(aliases: pd.Series):
+    # Soundex is computed once per distinct alias, aliases without a usable key get None
+    codes, uniques = pd.factorize(aliases)
+    keys = np.array([phonetic_alias_key(str(alias)) for alias in uniques] + [None], dtype=object)
+    return pd.Series(keys[codes], index=aliases.index, dtype=object)
+
+
+def phone_suffix_values(phones: pd.Series, digits: int = 6):
+    suffixes = phones.astype('string').str.strip().str[-digits:]
+    return suffixes.where(suffixes.str.len() == digits)
+
+
+def blocking_key_values(df: pd.DataFrame, phone_suffix_digits: int = 6):
+    # The keyed blocking passes as text, which is what gets persisted in the entity index
+    return {'phonetic_alias': phonetic_alias_values(df['alias']), 'phone_suffix': phone_suffix_values(df['phonenumber'], phone_suffix_digits)}
+
+
+def phonetic_alias_keys(aliases: pd.Series):
+    # Records without a usable key get -1 and are never blocked together
+    return pd.factorize(phonetic_alias_values(aliases))[0]
+
+
+def phone_suffix_keys(phones: pd.Series, digits: int = 6):
+    return pd.factorize(phone_suffix_values(phones, digits))[0]
+
+
+def sorted_alias_ranks(aliases: pd.Series):
+    # Rank of each alias in the sorted order of its letters, so close spellings end up next to each other
+    letters = aliases.astype('string').str.replace(r'[^a-z]+', '', regex=True)
+    return pd.factorize(letters.where(letters.str.len() > 0), sort=True)[0]
+
+
+# Candidate pairs
+
+def blocking_pass_codes(df: pd.DataFrame, blocking_pass: str, sort_ranks: np.ndarray, phone_suffix_digits: int = 6):
+    # Block code of every record for one blocking pass, the sorted neighbourhood is a single block compared only within the window
+    if blocking_pass == 'phonetic_alias':
+        return phonetic_alias_keys(df['alias'])
+    elif blocking_pass == 'phone_suffix':
+        return phone_suffix_keys(df['phonenumber'], phone_suffix_digits)
+    elif blocking_pass == 'sorted_neighbourhood':
+        return np.where(sort_ranks >= 0, 0, -1)
+    raise ValueError(f"Unknown blocking pass: {blocking_pass}")
+
+
+def pass_max_block_size(blocking_pass: str, max_block_size: int):
+    return 0 if blocking_pass == 'sorted_neighbourhood' else max_block_size
+
+
+def block_pairs(block_codes: np.ndarray, sort_ranks: np.ndarray, max_block_size: int, window: int):
+    """
+    All pairs inside each block of at most max_block_size records, and pairs within a window of the sorted
+    order inside larger blocks. Records with a negative code are not blocked.
+    """
+    valid = np.flatnonzero(block_codes >= 0)
+    if len(valid) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+
+    order = valid[np.lexsort((sort_ranks[valid], block_codes[valid]))]
+    sorted_codes = block_codes[order]
+    block_sizes = np.bincount(sorted_codes)
+    capped = block_sizes[sorted_codes] > max_block_size
+
+    max_offset = min(max(max_block_size, window), block_sizes.max()) - 1
+    left, right = [], []
+    for offset in range(1, max_offset + 1):
+        same_block = sorted_codes[:-offset] == sorted_codes[offset:]
+        if offset >= window:
+            same_block &= ~capped[:-offset]
+        positions = np.flatnonzero(same_block)
+        if len(positions) == 0 and offset >= window:
+            break
+        left.append(order[positions])
+        right.append(order[positions + offset])
+
+    capped_blocks = int((block_sizes > max_block_size).sum())
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), capped_blocks
+    return np.concatenate(left), np.concatenate(right), capped_blocks
+
+
+def unique_pairs(left: np.ndarray, right: np.ndarray, rows: int):
+    low, high = np.minimum(left, right).astype(np.int64), np.maximum(left, right).astype(np.int64)
+    keys = np.unique(low[low != high] * rows + high[low != high])
+    return keys // rows, keys % rows
+
+
+def generate_candidate_pairs(df: pd.DataFrame, passes: list = BLOCKING_PASSES, max_block_size: int = 50, window: int = 5,
+                             phone_suffix_digits: int = 6):
+    """
+    Candidate pairs of df row positions from all blocking passes, deduplicated, with per-pass pair counts.
+    """
+    sort_ranks = sorted_alias_ranks(df['alias'])
+    stats = {}
+    left, right = [], []
+    for blocking_pass in passes:
+        block_codes = blocking_pass_codes(df, blocking_pass, sort_ranks, phone_suffix_digits)
+        pass_left, pass_right, capped = block_pairs(block_codes, sort_ranks, pass_max_block_size(blocking_pass, max_block_size), window)
+        if blocking_pass == 'sorted_neighbourhood':
+            capped = 0
+        stats[f"{blocking_pass}_pairs"] = len(pass_left)
+        stats[f"{blocking_pass}_capped_blocks"] = capped
+        left.append(pass_left)
+        right.append(pass_right)
+
+    left, right = unique_pairs(np.concatenate(left), np.concatenate(right), len(df))
+    stats['candidate_pairs'] = len(left)
+    return left, right, stats
+
+
+# Comparison and scoring
+
+def compare_column(values: pd.Series, left: np.ndarray, right: np.ndarray, method: str, threshold: float = None):
+    codes, uniques = pd.factorize(values)
+    left_codes, right_codes = codes[left], codes[right]
+    result = (left_codes == right_codes).astype(np.float64)
+
+    if method == 'jarowinkler':
+        # Only pairs of different values need a similarity, and each distinct pair of values is scored once
+        different = np.flatnonzero((left_codes != right_codes) & (left_codes >= 0) & (right_codes >= 0))
+        pair_keys, inverse = np.unique(left_codes[different].astype(np.int64) * len(uniques) + right_codes[different], return_inverse=True)
+        strings = np.asarray(uniques.astype(str), dtype=object)
+        similarities = jaro_winkler_pairs(strings[pair_keys // len(uniques)], strings[pair_keys % len(uniques)])
+        result[different] = similarities[inverse]
+        result = (result >= threshold).astype(np.float64)
+    elif method != 'exact':
+        raise ValueError(f"Unknown comparison method: {method}")
+
+    result[(left_codes < 0) | (right_codes < 0)] = np.nan
+    return result
+
+
+def compare_pairs(df: pd.DataFrame, left: np.ndarray, right: np.ndarray, comparisons: list = COMPARISONS):
+    return pd.DataFrame({feature: compare_column(df[column], left, right, method, threshold)
+                         for feature, column, method, threshold in comparisons})
+
+
+def score_pairs(features: pd.DataFrame, weights: dict = WEIGHTS):
+    # (weighted share of the points that were possible, points scored), features missing on either side are left out of both sums
+    feature_values = features[list(weights)].to_numpy()
+    feature_weights = np.array(list(weights.values()))
+    total_score = np.nansum(feature_values * feature_weights, axis=1)
+    possible_score = (~np.isnan(feature_values) * feature_weights).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total_score / possible_score, total_score
+
+
+def matched_pairs(features: pd.DataFrame, threshold: float = MATCH_THRESHOLD, min_points: float = MIN_MATCH_POINTS, weights: dict = WEIGHTS):
+    # Positions of the compared pairs that are matches
+    similarity_index, points = score_pairs(features, weights)
+    return np.flatnonzero((similarity_index > threshold) & (points >= min_points - 1e-9))
+
+
+def link_records(df: pd.DataFrame, threshold: float = MATCH_THRESHOLD, weights: dict = WEIGHTS, min_points: float = MIN_MATCH_POINTS,
+                 **blocking_options):
+    """
+    Matched pairs of df row positions (similarity_index above threshold with at least min_points of agreement) and a dict
+    of pair counts and timings.
+    """
+    start = time.perf_counter()
+    left, right, stats = generate_candidate_pairs(df, **blocking_options)
+    stats['blocking_seconds'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    features = compare_pairs(df, left, right)
+    stats['comparison_seconds'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    matched = matched_pairs(features, threshold, min_points, weights)
+    stats['scoring_seconds'] = round(time.perf_counter() - start, 3)
+    stats['matched_pairs'] = len(matched)
+    return left[matched], right[matched], stats
+
+
+# Clustering
+
+def exact_match_pairs(values: pd.Series):
+    # Every record is linked to the first record with the same value, which connects each group with one pair per member
+    # however common the value is. Missing values match nothing.
+    codes = pd.factorize(values)[0]
+    valid = np.flatnonzero(codes >= 0)
+    _, first = np.unique(codes[valid], return_index=True)
+    representatives = valid[first][codes[valid]]
+    linked = representatives != valid
+    return representatives[linked], valid[linked]
+
+
+def connected_components(left: np.ndarray, right: np.ndarray, rows: int):
+    """
+    Contiguous cluster ids (0..k-1, in order of first row) for rows 0..rows-1 linked by the pairs (left[i], right[i]).
+
+    Array-backed union-find: every round hooks the larger root of each unmerged pair onto the smaller one, then
+    compresses the parent array until every row points at its root. Rows end up labelled by the smallest row in their cluster.
+    """
+    parent = np.arange(rows, dtype=np.int64)
+    left, right = np.asarray(left, dtype=np.int64), np.asarray(right, dtype=np.int64)
+    while len(left):
+        left_roots, right_roots = parent[left], parent[right]
+        unmerged = left_roots != right_roots
+        if not unmerged.any():
+            break
+        left, right = left[unmerged], right[unmerged]
+        low_roots = np.minimum(left_roots[unmerged], right_roots[unmerged])
+        high_roots = np.maximum(left_roots[unmerged], right_roots[unmerged])
+        np.minimum.at(parent, high_roots, low_roots)
+
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    return pd.factorize(parent)[0]
+
+
+# Stable ids
+
+def member_keys(df: pd.DataFrame, columns: list):
+    # Canonical text of each row over the given columns, missing values as empty fields
+    parts = df[columns].astype('string').fillna('')
+    return parts[columns[0]].str.cat([parts[column] for column in columns[1:]], sep='\x1f')
+
+
+def content_ids(keys: pd.Series, prefix: str = '', digest_bytes: int = 16):
+    # The first digest_bytes of the SHA-256 of each key as hex, so the same key gets the same id in every run
+    digests = sha256_digests(keys.astype(object))
+    hex_digests = np.ascontiguousarray(digests[:, :digest_bytes]).tobytes().hex()
+    width = 2 * digest_bytes
+    return pd.Series([prefix + hex_digests[start:start + width] for start in range(0, len(hex_digests), width)], index=keys.index, dtype=object)
+
+
+def cluster_content_ids(cluster_ids: np.ndarray, keys: pd.Series, prefix: str = ''):
+    # Each cluster is named after its smallest member key, which does not depend on row order or on the run
+    canonical_keys = pd.Series(keys.to_numpy(), dtype=object).groupby(cluster_ids).min()
+    return content_ids(canonical_keys, prefix).to_numpy()[cluster_ids]
+
+
+# Evaluation
+
+def pairwise_scores(truth: np.ndarray, predicted: np.ndarray):
+    # Precision, recall and F1 over all pairs of items, from the contingency table of the true and predicted clusters
+    def pairs(counts):
+        counts = counts.astype(np.float64)
+        return float((counts * (counts - 1) / 2).sum())
+
+    truth_codes, predicted_codes = pd.factorize(truth)[0], pd.factorize(predicted)[0]
+    joint = pd.Series(truth_codes * (predicted_codes.max() + 1) + predicted_codes).value_counts().to_numpy()
+    true_positives = pairs(joint)
+    predicted_pairs, true_pairs = pairs(np.bincount(predicted_codes)), pairs(np.bincount(truth_codes))
+    precision = true_positives / predicted_pairs if predicted_pairs else 1.0
+    recall = true_positives / true_pairs if true_pairs else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'precision': round(precision, 4), 'recall': round(recall, 4), 'f1': round(f1, 4)}
+
+
+def linkage_scores(persons: int = 10000, seed: int = 0, **linkage_options):
+    """
+    Pairwise scores of the clusters from the exact alias matches plus link_records on generate_person_corpus, whose
+    records carry their true person. With 10000 persons the exact matches alone reach a precision of 0.80 (common names
+    collide) and the calibrated linkage 0.82.
+    """
+    df_person = generate_person_corpus(persons, seed=seed)
+    truth = df_person.pop('person').to_numpy()
+    match_left, match_right = exact_match_pairs(df_person['alias'])
+    linked_left, linked_right, _ = link_records(df_person, **linkage_options)
+    cluster_ids = connected_components(np.concatenate([match_left, linked_left]), np.concatenate([match_right, linked_right]), len(df_person))
+    return pairwise_scores(truth, cluster_ids)
+
+
+# Synthetic persons for the tests and benchmarks
+
+ETHIOPIAN_NAMES = ['abebe', 'kebede', 'tesfaye', 'mekonnen', 'haile', 'alemu', 'girma', 'bekele', 'tadesse', 'getachew', 'mulugeta',
+                   'desta', 'worku', 'yohannes', 'solomon', 'dawit', 'almaz', 'tigist', 'selam', 'hirut', 'meseret', 'aster', 'genet',
+                   'birtukan', 'lemlem', 'mesfin', 'negash', 'wondimu', 'tsegaye', 'asfaw', 'gebre', 'berhane', 'amare', 'kidane',
+                   'fikadu', 'yared', 'eyerusalem', 'mahlet', 'biniam', 'henok']
+
+
+def spelling_variant(name: str, rng: np.random.Generator):
+    # The kinds of variation seen between branches: doubled or dropped letters, vowel swaps and ie/ye
+    variant = rng.integers(5)
+    position = int(rng.integers(1, len(name)))
+    if variant == 0:
+        return name[:position] + name[position - 1] + name[position:]
+    elif variant == 1:
+        return name[:position] + name[position + 1:]
+    elif variant == 2:
+        return name.replace('e', 'a', 1)
+    elif variant == 3:
+        return name.replace('ye', 'ie') if 'ye' in name else name.replace('ie', 'ye')
+    return name[:position - 1] + name[position:position + 1] + name[position - 1] + name[position + 1:]
+
+
+def generate_person_corpus(persons: int, records_per_person: int = 3, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    given = rng.choice(ETHIOPIAN_NAMES, persons)
+    father = rng.choice(ETHIOPIAN_NAMES, persons)
+    grandfather = rng.choice(ETHIOPIAN_NAMES, persons)
+    phones = np.char.add('2519', rng.integers(10**7, 10**8, persons).astype(str))
+    locations = rng.choice(['aa', 'or', 'am', 'tg', 'sd', 'so'], persons)
+    occupations = rng.choice(['merchant', 'teacher', 'farmer', 'driver', 'engineer', None], persons)
+    sexes = rng.choice(['m', 'f'], persons)
+    birthdates = pd.Timestamp('1960-01-01') + pd.to_timedelta(rng.integers(0, 15000, persons), unit='D')
+
+    records = []
+    for person in range(persons):
+        for _ in range(int(rng.integers(1, records_per_person + 1))):
+            names = [given[person], father[person], grandfather[person]]
+            if rng.random() < 0.3:
+                token = int(rng.integers(3))
+                names[token] = spelling_variant(names[token], rng)
+            records.append({'alias': ' '.join(names), 'location': locations[person], 'sex': sexes[person],
+                            'phonenumber': phones[person] if rng.random() < 0.7 else None,
+                            'birthdate': birthdates[person] if rng.random() < 0.5 else pd.NaT,
+                            'occupation': occupations[person], 'person': person})
+    return pd.DataFrame(records)
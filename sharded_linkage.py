@@ -0,0 +1,124 @@
+"""
+Sharded, multi-process record linkage.
+
+link_records_sharded gives the same matched pairs as record_linkage.link_records, with the work spread over forked worker processes:
+
+    - every blocking pass splits the records into shards of whole blocks (block code modulo the shard count). The sorted
+      neighbourhood is split into contiguous ranges of the sorted order that overlap by window - 1 records, a pair belongs
+      to the range its first record is in.
+    - a worker builds the candidate pairs of its shard, drops the pairs an earlier pass already generates (from the block code,
+      capping and sorted position of each record in those passes), then compares and scores the rest
+    - the workers read the records from the parent's memory, inherited copy-on-write through fork, and only row positions
+      and block layouts are sent to them
+    - the matched pairs of all shards are deduplicated in the parent, and the cross-shard merges are left to connected_components
+
+tests/test_sharded_linkage.py checks the sharded matches against link_records, benchmarks/record_linkage.py times both.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+import time
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from record_linkage import (BLOCKING_PASSES, COMPARISONS, MATCH_THRESHOLD, MIN_MATCH_POINTS, WEIGHTS, block_pairs, blocking_pass_codes,
+                            compare_pairs, matched_pairs, pass_max_block_size, sorted_alias_ranks, unique_pairs)
+
+
+# Records being linked, set in the parent right before the pool forks so the workers inherit them without pickling
+shared_records = None
+
+
+def pass_layout(block_codes: np.ndarray, sort_ranks: np.ndarray, max_block_size: int):
+    # Per record: block code, whether its block is capped to the window, and its position in the sorted order of the pass
+    valid = np.flatnonzero(block_codes >= 0)
+    order = valid[np.lexsort((sort_ranks[valid], block_codes[valid]))]
+    positions = np.full(len(block_codes), -1, dtype=np.int64)
+    positions[order] = np.arange(len(order))
+    block_sizes = np.bincount(block_codes[valid], minlength=1)
+    capped = np.zeros(len(block_codes), dtype=bool)
+    capped[valid] = block_sizes[block_codes[valid]] > max_block_size
+    return block_codes, capped, positions
+
+
+def shard_rows(layout: tuple, shards: int, window: int, sorted_ranges: bool):
+    """
+    (row positions, end of the owned sorted range) of each shard of one pass. Shards of whole blocks own all their pairs,
+    shards with fewer than two records have no pairs and are left out.
+    """
+    block_codes, _, positions = layout
+    if sorted_ranges:
+        order = np.argsort(positions)[np.sort(positions) >= 0]
+        bounds = np.linspace(0, len(order), shards + 1).astype(np.int64)
+        parts = [(np.sort(order[start:min(end + window - 1, len(order))]), end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    else:
+        valid = block_codes >= 0
+        parts = [(np.flatnonzero(valid & (block_codes % shards == shard)), len(block_codes)) for shard in range(shards)]
+    return [(rows, owned_end) for rows, owned_end in parts if len(rows) > 1]
+
+
+def generated_by(layout: tuple, left: np.ndarray, right: np.ndarray, window: int):
+    # Whether the pass with this layout generates each pair: same block, and within the window if the block is capped
+    block_codes, capped, positions = layout
+    return ((block_codes[left] == block_codes[right]) & (block_codes[left] >= 0)
+            & (~capped[left] | (np.abs(positions[left] - positions[right]) < window)))
+
+
+def link_shard(rows: np.ndarray, layout: tuple, owned_end: int, earlier_layouts: list, sort_ranks: np.ndarray, max_block_size: int,
+               window: int, threshold: float, min_points: float, weights: dict):
+    left, right, _ = block_pairs(layout[0], sort_ranks, max_block_size, window)
+    owned = np.minimum(layout[2][left], layout[2][right]) < owned_end
+    for earlier_layout in earlier_layouts:
+        owned &= ~generated_by(earlier_layout, left, right, window)
+    left, right = left[owned], right[owned]
+
+    matched = matched_pairs(compare_pairs(shared_records.iloc[rows], left, right), threshold, min_points, weights)
+    return rows[left[matched]], rows[right[matched]], len(left)
+
+
+def link_records_sharded(df: pd.DataFrame, workers: int = None, shards_per_worker: int = 4, threshold: float = MATCH_THRESHOLD,
+                         weights: dict = WEIGHTS, min_points: float = MIN_MATCH_POINTS, passes: list = BLOCKING_PASSES, max_block_size: int = 50, window: int = 5,
+                         phone_suffix_digits: int = 6):
+    """
+    Matched pairs of df row positions and a dict of pair counts and timings, like link_records, resolved on worker processes.
+    """
+    global shared_records
+    workers = workers or os.cpu_count() or 1
+    shards = workers * shards_per_worker
+    stats = {'workers': workers}
+
+    start = time.perf_counter()
+    sort_ranks = sorted_alias_ranks(df['alias'])
+    tasks = []
+    layouts = []
+    for blocking_pass in passes:
+        pass_block_size = pass_max_block_size(blocking_pass, max_block_size)
+        layout = pass_layout(blocking_pass_codes(df, blocking_pass, sort_ranks, phone_suffix_digits), sort_ranks, pass_block_size)
+        for rows, owned_end in shard_rows(layout, shards, window, sorted_ranges=blocking_pass == 'sorted_neighbourhood'):
+            tasks.append((blocking_pass, rows, tuple(values[rows] for values in layout), owned_end,
+                          [tuple(values[rows] for values in earlier_layout) for earlier_layout in layouts],
+                          sort_ranks[rows], pass_block_size))
+        layouts.append(layout)
+    stats['shards'] = len(tasks)
+    stats['sharding_seconds'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    shared_records = df[list(dict.fromkeys(column for _, column, _, _ in COMPARISONS))]
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(link_shard, rows, layout, owned_end, earlier_layouts, ranks, pass_block_size, window, threshold, min_points, weights)
+                       for _, rows, layout, owned_end, earlier_layouts, ranks, pass_block_size in tasks]
+            results = [future.result() for future in futures]
+    finally:
+        shared_records = None
+    stats['linkage_seconds'] = round(time.perf_counter() - start, 3)
+
+    for blocking_pass in passes:
+        stats[f"{blocking_pass}_pairs"] = sum(result[2] for (task_pass, *_), result in zip(tasks, results) if task_pass == blocking_pass)
+    stats['candidate_pairs'] = sum(stats[f"{blocking_pass}_pairs"] for blocking_pass in passes)
+    if not results:
+        stats['matched_pairs'] = 0
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), stats
+    left, right = unique_pairs(np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results]), len(df))
+    stats['matched_pairs'] = len(left)
+    return left, right, stats
@@ -14,167 +14,136 @@ Final Output:
 """
 """------------------------------------------------------------------------------------------------------------------------------"""
 import pandas as pd
-from main import Database_Connector
-import string
+from main import Database_Connector, is_full_rebuild
+from normalization import (Memoized_Normalizer, classify_regions, first_occurrences, fixed_width_keys, hash_transaction_ids, normalize_phone_numbers,
+                           parse_dates, parse_times_of_day)
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
 
 db_connector = Database_Connector()
 
+stage_name = "data_cleaning"
 input_table_name = "test_transactions"
 output_table_name = "cleaned_transactions"
+chunk_rows = 200000
+# Format of the text date columns; unset, it is inferred per chunk from the first value like pd.to_datetime does
+date_format = os.environ.get('DATA_FUSION_DATE_FORMAT') or None
+
+# Incremental runs only read transactions that arrived after the last run, by the load timestamp column of the raw table
+# (DATA_FUSION_INGESTION_COLUMN); --full-rebuild reprocesses the whole history. transactiondate is free-form text in the raw
+# table (month-first slash dates among others), so it cannot bound the read, and without an ingestion column every run is a
+# full rebuild.
+ingestion_column = os.environ.get('DATA_FUSION_INGESTION_COLUMN')
+if not ingestion_column and not is_full_rebuild():
+    print("DATA_FUSION_INGESTION_COLUMN is not set, incremental runs need a load timestamp column on the raw table: running a full rebuild")
+watermark = None if is_full_rebuild() or not ingestion_column else db_connector.get_watermark(stage_name)
+input_filters = None if watermark is None else [(ingestion_column, '>', watermark)]
+
+# Every cleaned row carries the time of the run that wrote it, the later stages read their new rows by it
+loaded_at = pd.Timestamp.now().floor('us')
 
 selected_columns = ['transactionid', 'branchid', 'branchname', 'transactiondate', 'transactiontime', 'transactiontype', 
                     'conductingmanner', 'currencytype', 'amountinbirr', 'amountincurrency', 
                     'sex', 'birthdate', 'occupation', 'bussinesstelno', 'houseno',
                     'accountno', 'accownername', 'accounttype', 'openeddate', 'closeddate', 
-                    'benfullname', 'benaccountno', 'bentelno', 'benisentity', 'benworeda']
-
-df = db_connector.data_to_pandas_df(
-    db_connector.get_table_data_selected(table_name=input_table_name, selected_columns=selected_columns),
-    selected_columns)
-
-# 1. Convert all values in every column to lower case
-
-string_cols = df.select_dtypes(include=['object', 'string']).columns
-
-df[string_cols] = df[string_cols].apply(lambda x: x.str.lower().str.strip() if isinstance(x, pd.Series) else x)
-
-# 2. Convert data and time columns to appropirate format and also join transaction date and time columns (transactiondate, transactiontime, birthdate, openeddate, closeddate)
-
-df['transactiondate'] = pd.to_datetime(df['transactiondate'].fillna(pd.NaT), errors='coerce')
-df['transactiontime'] = pd.to_datetime(df['transactiontime'].fillna(pd.NaT), format='%H:%M:%S', errors='coerce')
-df['transactiondatetime'] = df['transactiondate'] + pd.to_timedelta(df['transactiontime'].dt.hour, unit='h') + pd.to_timedelta(df['transactiontime'].dt.minute, unit='m')
-df['transactiondatetime'] = df['transactiondatetime'].dt.tz_localize(None)
-df['birthdate'] = pd.to_datetime(df['birthdate'].fillna(pd.NaT), errors='coerce').dt.date
-df['openeddate'] = pd.to_datetime(df['openeddate'].fillna(pd.NaT), errors='coerce').dt.date
-df['closeddate'] = pd.to_datetime(df['closeddate'].fillna(pd.NaT), errors='coerce').dt.date
-
-# 3. Remove extreme dates
-
-#df = df[df['transactiondatetime'].notna() & (df['transactiondatetime'] >= '2000-01-01') & (df['transactiondatetime'] <= '2025-12-31')]
-#df = df[df['birthdate'].notna() & (df['birthdate'] >= '1900-01-01') & (df['birthdate'] <= '2025-12-31')]
-#df = df[df['openeddate'].notna() & (df['openeddate'] >= '2000-01-01') & (df['openeddate'] <= '2025-12-31')]
-#df = df[df['closeddate'].notna() & (df['closeddate'] >= '2000-01-01') & (df['closeddate'] <= '2025-12-31')]
-
-# 4. Hash the transactionid column
-import hashlib
-df['transactionid'] = df['transactionid'].apply(lambda x: hashlib.sha256(x.encode()).hexdigest() if isinstance(x, str) else x)
-
-
-# 5. Create a unified address field for the sender and beneficiary using multiple columns identified in the dataset
-def transform_address(address):
-    address = str(address).strip().lower()
-    remove_chars = string.punctuation + string.digits + " "
-    table = str.maketrans('', '', remove_chars)
-    address = address.translate(table)
-
-    if address in ['nan', 'none', '', 'na']:
-        return pd.NA
-    elif "not" in address.split():
-        return pd.NA
-    elif len(address) > 3:
-        if ('aa' in address or "ad" in address or "add" in address or "aba" in address):
-            return "aa"
-        elif ('ti' in address or 'mk' in address or 'tig' in address or 'shire' in address or 'adw' in address or 'ax' in address or 'adi' in address):
-            return "tg"
-        elif ('or' in address):
-            return 'or'
-        elif ('snn' in address):
-            return 'snnp'
-        elif ('af' in address):
-            return 'af'
-        elif ('sid' in address):
-            return 'sid'
-        elif ('am' in address or 'amh' in address):
-            return 'am'
-        elif ('gam' in address):
-            return 'gamb'
-        elif ('so' in address):
-            return 'som'
-        elif ('ben' in address):
-            return 'bgum'
-        elif ('har' in address):
-            return 'har'
-        elif ('dd' in address or 'dire' in address or 'dre' in address):
-            return 'ddw'
-        else:
-            return pd.NA
-    else:
-        return address
-    
-
-df['senderaddress'] = df['houseno'].apply(lambda x: transform_address(x))
-
-
-# 6. Create a unified address field for the beneficiary using multiple columns identified in the dataset
-df['beneficiaryaddress'] = df['benworeda'].apply(lambda x: transform_address(x))
-
-
-# 7. Create Unified phone number field and clean the phone number to appropirate format 251******* for every transaction (Phone numbers are found on different columns in our dataset)
-def transform_phone_number(phone):
-    if "." in str(phone):
-        phone = str(phone).split('.')[0]
-
-    delete_chars = string.ascii_letters + string.punctuation + " "
-    table = str.maketrans('', '', delete_chars)
-    phone = str(phone).translate(table)
-
-    if isinstance(phone, str):
-        phone = phone.strip()
-        if len(phone) < 7:
-            return pd.NA
-        elif phone.startswith("0"):
-            return f"251{phone[1:]}"
-        elif phone.startswith("9"):
-            return f"251{phone}"
-        elif phone.startswith("+251"):
-            return phone[1:]
-        elif phone.startswith("251"):
-            return phone
-        elif phone.startswith("+9"):
-            return f"251{phone[2:]}"
-        elif len(phone) == 8:
-            return f"2519{phone}"
-        elif len(phone) == 10 and not phone.startswith("09"):
-            return f"251{phone[2:]}"
-    else:
-        try:
-            phone = str(int(phone))
-            transform_phone_number(phone)
-        except:
-            return pd.NA
-    return phone
-
-df['senderphone'] = df['bussinesstelno'].apply(lambda x: transform_phone_number(x))
-
-
-
-# 8. Create Unified phone number field and clean the phone number to appropirate format 251******* for every transaction (Phone numbers are found on different columns in our dataset)
-df['beneficiaryphone'] = df['bentelno'].fillna(df['benisentity']).apply(lambda x: transform_phone_number(x))
-
-
-# 9. Remove duplicates if any
-df = df.drop_duplicates(subset=['transactionid'], keep='first')
-
-# 10. Handle missing values if any
-df = df.dropna(subset=['transactionid', 'amountinbirr', 'transactiondatetime'])
+                    'benfullname', 'benaccountno', 'bentelno', 'benisentity', 'benworeda'] + ([ingestion_column] if ingestion_column else [])
+
+# Address and phone values repeat heavily, so each distinct value is normalized once and cached across chunks
+address_normalizer = Memoized_Normalizer(classify_regions)
+phone_normalizer = Memoized_Normalizer(normalize_phone_numbers)
+
+# transactionid hashing runs on forked worker processes when DATA_FUSION_HASH_WORKERS > 1
+# (spawned workers would re-import this script and rerun the whole stage)
+hash_workers = int(os.environ.get('DATA_FUSION_HASH_WORKERS', 1))
+hash_executor = ProcessPoolExecutor(max_workers=hash_workers, mp_context=multiprocessing.get_context('fork')) if hash_workers > 1 else None
+
+
+def clean_chunk(df):
+    # 1. Convert all values in every column to lower case
+
+    string_cols = df.select_dtypes(include=['object', 'string']).columns
+
+    df[string_cols] = df[string_cols].apply(lambda x: x.str.lower().str.strip() if isinstance(x, pd.Series) else x)
+
+    # 2. Convert data and time columns to appropirate format and also join transaction date and time columns (transactiondate, transactiontime, birthdate, openeddate, closeddate)
+    #    Each distinct value is parsed once, everything stays datetime64 and the date and time (to the minute) are joined in one addition
+
+    df['transactiondatetime'] = parse_dates(df['transactiondate'], date_format) + parse_times_of_day(df['transactiontime']).dt.floor('min')
+    df['birthdate'] = parse_dates(df['birthdate'], date_format).dt.normalize()
+    df['openeddate'] = parse_dates(df['openeddate'], date_format).dt.normalize()
+    df['closeddate'] = parse_dates(df['closeddate'], date_format).dt.normalize()
+
+    # 3. Remove extreme dates
+
+    #df = df[df['transactiondatetime'].notna() & (df['transactiondatetime'] >= '2000-01-01') & (df['transactiondatetime'] <= '2025-12-31')]
+    #df = df[df['birthdate'].notna() & (df['birthdate'] >= '1900-01-01') & (df['birthdate'] <= '2025-12-31')]
+    #df = df[df['openeddate'].notna() & (df['openeddate'] >= '2000-01-01') & (df['openeddate'] <= '2025-12-31')]
+    #df = df[df['closeddate'].notna() & (df['closeddate'] >= '2000-01-01') & (df['closeddate'] <= '2025-12-31')]
 
+    # 4. Hash the transactionid column
+    df['transactionid'] = hash_transaction_ids(df['transactionid'], output='hex', executor=hash_executor)
 
-# 11. Remove any decimal palces in account number columns if any and convert to string
-df['accountno'] = df['accountno'].apply(lambda x: str(x).split('.')[0] if isinstance(x, float) else str(x).split('.')[0])
-df['benaccountno'] = df['benaccountno'].apply(lambda x: str(x).split('.')[0] if isinstance(x, float) else str(x).split('.')[0])
+    # 5. Create a unified address field for the sender and beneficiary using multiple columns identified in the dataset
+    df['senderaddress'] = address_normalizer(df['houseno'])
 
+    # 6. Create a unified address field for the beneficiary using multiple columns identified in the dataset
+    df['beneficiaryaddress'] = address_normalizer(df['benworeda'])
 
-# 12. Final cleaned data output (23 columns)
+    # 7. Create Unified phone number field and clean the phone number to appropirate format 251******* for every transaction (Phone numbers are found on different columns in our dataset)
+    df['senderphone'] = phone_normalizer(df['bussinesstelno'])
+
+    # 8. Create Unified phone number field and clean the phone number to appropirate format 251******* for every transaction (Phone numbers are found on different columns in our dataset)
+    df['beneficiaryphone'] = phone_normalizer(df['bentelno'].fillna(df['benisentity']))
+
+    # 9. Remove any decimal palces in account number columns if any and convert to string
+    df['accountno'] = df['accountno'].apply(lambda x: str(x).split('.')[0] if isinstance(x, float) else str(x).split('.')[0])
+    df['benaccountno'] = df['benaccountno'].apply(lambda x: str(x).split('.')[0] if isinstance(x, float) else str(x).split('.')[0])
+
+    df['loadedat'] = loaded_at
+
+    # 10. Keep only the final cleaned columns (23 columns plus the load time)
+    return df[['transactionid', 'branchid', 'branchname', 'transactiondatetime', 'transactiontype', 'conductingmanner', 
+               'currencytype', 'amountinbirr', 'amountincurrency', 
+               'sex', 'birthdate', 'occupation', 'senderaddress', 'senderphone',
+               'accountno', 'accownername', 'accounttype', 'openeddate', 'closeddate', 
+               'benfullname', 'benaccountno', 'beneficiaryaddress', 'beneficiaryphone', 'loadedat']]
+
+
+# 11. Stream the raw table chunk by chunk so only one chunk of raw rows is ever held in memory
+cleaned_chunks = []
+ingested_until = []
+for chunk in db_connector.iter_table_chunks(table_name=input_table_name, selected_columns=selected_columns, chunk_rows=chunk_rows, filters=input_filters):
+    if ingestion_column:
+        ingested_until.append(pd.to_datetime(chunk[ingestion_column]).max())
+    cleaned_chunks.append(clean_chunk(chunk))
+if hash_executor is not None:
+    hash_executor.shutdown()
+
+if not cleaned_chunks:
+    db_connector.close()
+    print("Done! No new transactions since", watermark)
+    sys.exit(0)
+
+df = pd.concat(cleaned_chunks, ignore_index=True)
+
+# 12. Remove duplicates if any (on a fixed-width byte array of the hex ids rather than hashing the strings again)
+df = df.iloc[first_occurrences(fixed_width_keys(df['transactionid']))]
+
+# 13. Handle missing values if any
+df = df.dropna(subset=['transactionid', 'amountinbirr', 'transactiondatetime'])
 
-df = df[['transactionid', 'branchid', 'branchname', 'transactiondatetime', 'transactiontype', 'conductingmanner', 
-         'currencytype', 'amountinbirr', 'amountincurrency', 
-         'sex', 'birthdate', 'occupation', 'senderaddress', 'senderphone',
-         'accountno', 'accownername', 'accounttype', 'openeddate', 'closeddate', 
-         'benfullname', 'benaccountno', 'beneficiaryaddress', 'beneficiaryphone']]
+# 14. Save the cleaned data to the database with the output table name (incremental runs upsert on transactionid, so re-read rows are not duplicated)
+if watermark is None:
+    db_connector.bulk_write(df, output_table_name, mode='replace')
+else:
+    db_connector.bulk_write(df, output_table_name, mode='upsert', key_columns=['transactionid'])
 
-# 13. Save the cleaned data to the database with the output table name
-df.to_sql(output_table_name, db_connector.get_engine(), if_exists='replace', index=False)
+if ingestion_column:
+    db_connector.set_watermark(stage_name, max(ingested_until))
 
+db_connector.close()
 
 print("Done! Cleaned data saved to the database. Table name:", output_table_name)
 
@@ -57,27 +57,60 @@ Note:
 """------------------------------------------------------------------------------------------------------------------------------"""
 import pandas as pd
 import numpy as np
-import uuid
-import recordlinkage as rl
-import networkx as nx
-from main import Database_Connector
+import sys
+import os
+import time
+from main import Database_Connector, is_full_rebuild
+from entity_index import assign_personids, index_entries, lookup_keys, merged_personids
+from alias_index import write_alias_index
+from key_dictionary import Key_Dictionary, first_value_table, lookup
+from record_linkage import cluster_content_ids, connected_components, content_ids, exact_match_pairs, link_records, member_keys
+from sharded_linkage import link_records_sharded
 
 db_connector = Database_Connector()
 
+stage_name = "identity_resolution"
 input_table_name = "cleaned_transactions"
 output_table_name = "identity_resolved_transactions"
 person_entity_table_name = "person_entity_table"
 account_entity_table_name = "account_entity_table"
+entity_index_table_name = "person_entity_index"
+alias_index_table_name = "person_alias_trigrams"
+alias_index_counts_table_name = "person_alias_trigram_counts"
+# personids merged into another entity by incremental runs, so the later stages can drop the rows they keep for them
+merges_table_name = "person_entity_merges"
+# Fuzzy matching (blocked record linkage on top of the exact alias matches) is off unless DATA_FUSION_FUZZY_MATCHING is set.
+# Its precision on the labelled person corpus is checked in tests/test_record_linkage.py.
+use_fuzzy_matching = os.environ.get('DATA_FUSION_FUZZY_MATCHING', '').lower() in ('1', 'true', 'yes', 'on')
+# Fuzzy matching is sharded by blocking key over forked worker processes when DATA_FUSION_RESOLUTION_WORKERS > 1
+resolution_workers = int(os.environ.get('DATA_FUSION_RESOLUTION_WORKERS', 1))
+
+# Incremental runs only resolve transactions cleaned since the watermark, by load time rather than transaction time so late
+# transactions are not skipped; --full-rebuild re-derives everything
+watermark = None if is_full_rebuild() else db_connector.get_watermark(stage_name)
+input_filters = None if watermark is None else [('loadedat', '>', watermark)]
+loaded_at = pd.Timestamp.now().floor('us')
 
 column_names = db_connector.get_table_columns(table_name=input_table_name)
 
-df = db_connector.data_to_pandas_df(
-    db_connector.get_table_data_selected(table_name=input_table_name, selected_columns=column_names),
-    column_names)
+df = db_connector.query_table(table_name=input_table_name, selected_columns=column_names, filters=input_filters)
+
+if df.empty:
+    db_connector.close()
+    print("Done! No new transactions since", watermark)
+    sys.exit(0)
+
+def select_new_rows(df_new, df_existing, key_columns):
+    # Rows of df_new whose key_columns combination is not already stored in df_existing
+    if df_existing.empty:
+        return df_new
+    new_keys = pd.util.hash_pandas_object(df_new[key_columns].astype('string'), index=False)
+    existing_keys = pd.util.hash_pandas_object(df_existing[key_columns].astype('string'), index=False)
+    return df_new[~new_keys.isin(existing_keys).to_numpy()]
 
 
 transaction_columns = ['accountno', 'fromentity', 'benaccountno', 'toentity', 'transactionid', 'transactiondatetime', 'transactiontype', 'conductingmanner', 
-                       'currencytype', 'amountinbirr', 'amountincurrency', 'branchid', 'branchname', 'beneficiaryaddress']
+                       'currencytype', 'amountinbirr', 'amountincurrency', 'branchid', 'branchname', 'beneficiaryaddress', 'loadedat']
 account_columns = ['ownerentity', 'accountno', 'ownername', 'accounttype', 'openeddate', 'closeddate']
 person_columns = ['personid', 'aliases', 'sex', 'birthdate', 'occupation', 'location', 'phonenumbers']
 
@@ -97,7 +130,6 @@ df_beneficiaries = df[[x for x in ben_info_columns if x in df.columns]].drop_dup
 df_beneficiaries.rename(columns={'benfullname': 'alias', 'beneficiaryaddress': 'location', 'beneficiaryphone': 'phonenumber'}, inplace=True)
 
 df_person = pd.concat([df_senders, df_beneficiaries], ignore_index=True).drop_duplicates().reset_index(drop=True)
-"""df_person['personid'] = df_person.apply(lambda row: str(uuid.uuid4()) + f"_{row.name}", axis=1)"""
 
 
 
@@ -110,146 +142,55 @@ df_person = pd.concat([df_senders, df_beneficiaries], ignore_index=True).drop_du
 # - Probablistic Way:
 #     - Name similarity + DOB similarity + Address similarity + Phone similarity → confidence score
 
-"""
-indexer = rl.Index()
-indexer.block(['sex', 'location']) 
-candidate_links = indexer.index(df_person)
-
-compare = rl.Compare()
-
-compare.exact('birthdate', 'birthdate', label='birthdate_match', missing_value=np.nan)
-compare.exact('phonenumber', 'phonenumber', label='phone_match', missing_value=np.nan)
-
-compare.string('phonenumber', 'phonenumber', method='jarowinkler', threshold=0.95, label='phone_similarity', missing_value=np.nan)
-compare.string('alias', 'alias', method='jarowinkler', threshold=0.9, label='alias_score', missing_value=np.nan)
-compare.string('location', 'location', method='jarowinkler', threshold=0.7, label='location_score', missing_value=np.nan)
-compare.string('occupation', 'occupation', method='jarowinkler', threshold=0.8, label='job_score', missing_value=np.nan)
-
-features = compare.compute(candidate_links, df_person)
-
-features['total_points'] = features.sum(axis=1, skipna=True)
-features['possible_points'] = features.notna().sum(axis=1)
-features['normalized_score'] = features['total_points'] / features['possible_points']
-features['normalized_score'] = features['normalized_score'].fillna(0)
-
-#features.sort_values(by='normalized_score', ascending=False).to_csv("identity_resolution_scores.csv", index=True)
-
-weights = {
-    'birthdate_match': 0.05,
-    'phone_match': 0.05,
-    'phone_similarity': 0.35,
-    'alias_score': 0.45,
-    'location_score': 0.05,
-    'job_score': 0.05,
-}
-
-features_weighted = features
-features_weighted = features_weighted\
-.assign(weighted_birthday_match = lambda x: x['birthdate_match'] * weights['birthdate_match'])\
-.assign(weighted_phone_match = lambda x: x['phone_match'] * weights['phone_match'])\
-.assign(weighted_phone_similarity = lambda x: x['phone_similarity'] * weights['phone_similarity'])\
-.assign(weighted_alias_score = lambda x: x['alias_score'] * weights['alias_score'])\
-.assign(weighted_location_score = lambda x: x['location_score'] * weights['location_score'])\
-.assign(weighted_job_score = lambda x: x['job_score'] * weights['job_score'])
-
-
-features_weighted['total_possible_score'] = features.notna()\
-    .assign(possible_birthdate_match = lambda x: x["birthdate_match"] * weights['birthdate_match'])\
-    .assign(possible_phone_match = lambda x: x["phone_match"] * weights['phone_match'])\
-    .assign(possible_phone_similarity = lambda x: x["phone_similarity"] * weights['phone_similarity'])\
-    .assign(possible_alias_score = lambda x: x["alias_score"] * weights['alias_score'])\
-    .assign(possible_location_score = lambda x: x["location_score"] * weights['location_score'])\
-    .assign(possible_job_score = lambda x: x["job_score"] * weights['job_score'])\
-    .assign(total_score = lambda x: x[[
-        "possible_birthdate_match", 
-        "possible_phone_match", 
-        "possible_phone_similarity", 
-        "possible_alias_score", 
-        "possible_location_score", 
-        "possible_job_score"
-    ]].sum(axis=1))['total_score']
-
-
-features_weighted['total_score'] = features_weighted[[
-    "weighted_birthday_match", 
-    "weighted_phone_match", 
-    "weighted_phone_similarity",
-    "weighted_alias_score", 
-    "weighted_location_score", 
-    "weighted_job_score"
-]].sum(axis=1)
-
-features_weighted["similarity_index"] = features_weighted["total_score"] / features_weighted["total_possible_score"]
-
-features_weighted.sort_values(by='similarity_index', ascending=False).to_csv("identity_resolution_scores.csv", index=True)
-
-
-matches_df = features_weighted.loc[features_weighted['similarity_index'] > 0.4, ['similarity_index']].sort_values(by='similarity_index', ascending=False).index
-matches = list(matches_df)
-"""
-#
-matches = []
-
-def indexes_to_tuple(group_series):
-    return tuple(group_series.tolist())
-
-matches += (
-    df_person
-    .reset_index()
-    .groupby("alias")
-    .agg(
-        sum_count=('index', 'count'),
-        matches=('index', indexes_to_tuple)
-    )
-    .query("sum_count > 1")
-    ['matches'].tolist()
-)
-
-
-"""
-def clean_matches(matches):
-    cleaned = []
-
-    for match in matches:
-        if len(match) <= 1:
-            continue
-        elif len(match) == 2:
-            cleaned.append(match)
-            continue
-        for i in range(len(match)):
-            for j in range(i + 1, len(match)):
-                pair = (match[i], match[j])
-                if pair not in cleaned and (pair[1], pair[0]) not in cleaned:
-                    cleaned.append(pair)
-
-    return cleaned
-
-matches = clean_matches(matches)
-
-G = nx.Graph()
-G.add_edges_from(matches)
-
-clusters = list(nx.connected_components(G))
-
-entity_map = {}
-for cluster_id, nodes in enumerate(clusters):
-    p_id = uuid.uuid4()
-    for node in nodes:
-        entity_map[node] = f"ENTITY_{cluster_id}_{p_id}"
-"""
-entity_id = 0
-used_ids = []
-
-for match in matches:
-    ids = list(match)
-    df_person.iloc[ids, df_person.columns.get_loc('personid')] = f"ENTITY_{entity_id}_{str(uuid.uuid4())}"
-    entity_id += 1
-    used_ids += ids
-
-df_person.iloc[~df_person.index.isin(used_ids), df_person.columns.get_loc('personid')] = df_person.iloc[~df_person.index.isin(used_ids)].apply(lambda row: f"ENTITY_{entity_id}_{str(uuid.uuid4())}", axis=1)
-
-#personid_list = [str(uuid.uuid4()) + f"_{i}" if i not in entity_map.keys() else entity_map[i] for i in range(len(df_person))]
-#df_person['personid'] = personid_list
+# Probabilistic matching: candidate pairs from the blocking passes in record_linkage, scored with the prototype's weights.
+# Together with the exact alias matches (each record linked to the first with its alias), the pairs are merged into one cluster per person.
+# The blocking, comparison, scoring and clustering times are printed apart from the writes as "Record linkage: {...}".
+def resolve_clusters(df_person):
+    linkage_stats = {'records': len(df_person)}
+    start = time.perf_counter()
+    match_left, match_right = exact_match_pairs(df_person['alias'])
+    linkage_stats['exact_match_seconds'] = round(time.perf_counter() - start, 3)
+
+    if use_fuzzy_matching:
+        if resolution_workers > 1:
+            linked_left, linked_right, fuzzy_stats = link_records_sharded(df_person, workers=resolution_workers)
+        else:
+            linked_left, linked_right, fuzzy_stats = link_records(df_person)
+        linkage_stats.update(fuzzy_stats)
+        match_left, match_right = np.concatenate([match_left, linked_left]), np.concatenate([match_right, linked_right])
+
+    start = time.perf_counter()
+    cluster_ids = connected_components(match_left, match_right, len(df_person))
+    linkage_stats['clustering_seconds'] = round(time.perf_counter() - start, 3)
+    print("Record linkage:", linkage_stats)
+    return cluster_ids
+
+
+person_info_columns = ['alias', 'location', 'phonenumber', 'sex', 'birthdate', 'occupation']
+df_person_new = df_person
+merged_entities = pd.Series(dtype=object)
+
+if watermark is None:
+    # Each cluster's personid is a hash of its smallest member, so unchanged clusters keep their id from run to run
+    cluster_ids = resolve_clusters(df_person)
+    df_person['personid'] = cluster_content_ids(cluster_ids, member_keys(df_person, person_info_columns), prefix='ENTITY_')
+else:
+    # Incremental runs resolve the new persons together with the indexed entities that share a blocking key, alias or phone with them,
+    # so the cost follows the new records rather than the whole history. Entities joined by a new record keep one of their ids.
+    df_existing_person = pd.DataFrame(columns=person_info_columns + ['personid'])
+    if db_connector.get_table_columns(table_name=entity_index_table_name):
+        df_index = db_connector.query_table_by_keys(table_name=entity_index_table_name, selected_columns=['indexkey', 'personid'],
+                                                    key_column='indexkey', keys=lookup_keys(df_person))
+        if not df_index.empty:
+            df_existing_person = db_connector.query_table_by_keys(table_name=person_entity_table_name, selected_columns=person_info_columns + ['personid'],
+                                                                  key_column='personid', keys=df_index['personid'].unique())
+
+    df_person = pd.concat([df_existing_person, df_person], ignore_index=True).drop_duplicates(subset=person_info_columns).reset_index(drop=True)
+    existing_personids = df_person['personid']
+    cluster_ids = resolve_clusters(df_person)
+    df_person['personid'] = assign_personids(cluster_ids, existing_personids, member_keys(df_person, person_info_columns))
+    merged_entities = merged_personids(existing_personids, df_person['personid'].to_numpy())
+    df_person_new = select_new_rows(df_person, df_existing_person, person_info_columns + ['personid'])
 
 
 # 3. Create Account Entity Table
@@ -260,49 +201,92 @@ df_beneficiaries_account = df[[x for x in ben_account_columns if x in df.columns
 df_beneficiaries_account.rename(columns={'benfullname': 'ownername', 'benaccountno': 'accountno'}, inplace=True)
 
 df_accounts = pd.concat([df_senders_account, df_beneficiaries_account], ignore_index=True).drop_duplicates().reset_index(drop=True)
-df_accounts['accountid'] = df_accounts.apply(lambda row: str(uuid.uuid4()) + f"_{row.name}", axis=1)
+# Accounts are identified by their account number, rows without one by their content
+account_info_columns = ['accountno', 'ownername', 'accounttype', 'openeddate', 'closeddate']
+df_accounts['accountid'] = content_ids(df_accounts['accountno'].astype('string').fillna(member_keys(df_accounts, account_info_columns)))
 
 #print(df_person)
 
-df_person_unique = df_person[['alias', 'personid']].drop_duplicates(subset=['alias'])
+# Aliases, account numbers and personids are joined as integer codes of shared key dictionaries, an account's owner is the
+# (first) person holding its ownername as alias. The entity columns stay categorical until they are written.
+alias_keys = Key_Dictionary(df_person['alias'])
+entity_keys = Key_Dictionary(df_person['personid'])
+account_keys = Key_Dictionary(df_accounts['accountno'])
 
-df_accounts = df_accounts.merge(
-    df_person_unique, 
-    left_on='ownername', 
-    right_on='alias', 
-    how='left'
-).drop(columns=['alias']).rename(columns={'personid': 'ownerentity'})
+owner_codes = lookup(first_value_table(alias_keys.codes, entity_keys.codes, len(alias_keys)), alias_keys.encode(df_accounts['ownername']))
+df_accounts['ownerentity'] = entity_keys.decode(owner_codes)
 
 
 
-# 4. Create Final Identity Resolved Transaction Table
-df_transaction = df[[x for x in transaction_columns if x in df.columns]].copy()
-df_accounts_unique = df_accounts[['accountno', 'ownerentity']].drop_duplicates(subset=['accountno'])
+df_accounts_new = df_accounts
 
-df_transaction = df_transaction.merge(
-    df_accounts_unique, 
-    left_on='accountno', 
-    right_on='accountno', 
-    how='left'
-).drop(columns=['accountno']).rename(columns={'ownerentity': 'fromentity'})
+if watermark is not None:
+    df_existing_accounts = db_connector.query_table_by_keys(table_name=account_entity_table_name, selected_columns=account_info_columns + ['ownerentity'],
+                                                            key_column='accountno', keys=df_accounts['accountno'])
+    df_accounts_new = select_new_rows(df_accounts, df_existing_accounts, account_info_columns + ['ownerentity'])
 
-df_transaction = df_transaction.merge(
-    df_accounts_unique, 
-    left_on='benaccountno', 
-    right_on='accountno', 
-    how='left'
-).rename(columns={'ownerentity': 'toentity'})
+    # Accounts of entities merged into another one move to the surviving personid
+    if len(merged_entities):
+        df_merged_accounts = db_connector.query_table_by_keys(table_name=account_entity_table_name, selected_columns=list(df_accounts.columns),
+                                                              key_column='ownerentity', keys=merged_entities.index)
+        df_merged_accounts['ownerentity'] = df_merged_accounts['ownerentity'].map(merged_entities)
+        df_accounts_new = pd.concat([df_merged_accounts, df_accounts_new], ignore_index=True)
 
 
-df_transaction = df_transaction[transaction_columns]
 
+# 4. Create Final Identity Resolved Transaction Table
+df_transaction = df[[x for x in transaction_columns if x in df.columns]].copy()
+account_owner_table = first_value_table(account_keys.codes, owner_codes, len(account_keys))
+df_transaction['fromentity'] = entity_keys.decode(lookup(account_owner_table, account_keys.encode(df_transaction['accountno'])))
+df_transaction['toentity'] = entity_keys.decode(lookup(account_owner_table, account_keys.encode(df_transaction['benaccountno'])))
 
-# 5. Save the final tables to the database
-df_person.to_sql(person_entity_table_name, db_connector.get_engine(), if_exists='replace', index=False)
-df_accounts.to_sql(account_entity_table_name, db_connector.get_engine(), if_exists='replace', index=False)
-df_transaction.to_sql(output_table_name, db_connector.get_engine(), if_exists='replace', index=False)
+df_transaction = df_transaction[transaction_columns]
 
-print("Done! Identity resolved data saved to the database. Table names:", person_entity_table_name, ",", account_entity_table_name, ",", output_table_name)
+# Earlier transactions of merged entities are re-pointed to the surviving personid
+if len(merged_entities):
+    df_merged_transactions = pd.concat([
+        db_connector.query_table_by_keys(table_name=output_table_name, selected_columns=transaction_columns, key_column=key_column, keys=merged_entities.index)
+        for key_column in ['fromentity', 'toentity']
+    ], ignore_index=True).drop_duplicates(subset=['transactionid'])
+    for entity_column in ['fromentity', 'toentity']:
+        df_merged_transactions[entity_column] = df_merged_transactions[entity_column].map(merged_entities).fillna(df_merged_transactions[entity_column])
+    df_transaction = pd.concat([df_merged_transactions, df_transaction], ignore_index=True)
+
+# Written transactions, re-pointed ones included, carry this run's load time for the stages reading them incrementally
+df_transaction['loadedat'] = loaded_at
+df_merges = pd.DataFrame({'personid': merged_entities.index.astype(object), 'mergedinto': merged_entities.to_numpy(dtype=object), 'loadedat': loaded_at})
+
+
+# 5. Save the final tables to the database (incremental runs upsert new or re-assigned entity rows and transactions)
+write_start = time.perf_counter()
+if watermark is None:
+    db_connector.bulk_write(df_person, person_entity_table_name, mode='replace')
+    db_connector.bulk_write(index_entries(df_person), entity_index_table_name, mode='replace')
+    db_connector.bulk_write(df_accounts, account_entity_table_name, mode='replace')
+    db_connector.bulk_write(df_transaction, output_table_name, mode='replace')
+    db_connector.bulk_write(df_merges, merges_table_name, mode='replace')
+else:
+    # Index entries of merged-away personids are dropped, their keys are written again under the surviving personid
+    db_connector.delete_by_keys(table_name=entity_index_table_name, key_column='personid', keys=merged_entities.index)
+    db_connector.bulk_write(df_person_new, person_entity_table_name, mode='upsert', key_columns=person_info_columns)
+    db_connector.bulk_write(index_entries(df_person_new), entity_index_table_name, mode='upsert', key_columns=['indexkey', 'personid'])
+    db_connector.bulk_write(df_accounts_new, account_entity_table_name, mode='upsert', key_columns=account_info_columns)
+    db_connector.bulk_write(df_transaction, output_table_name, mode='upsert', key_columns=['transactionid'])
+    db_connector.bulk_write(df_merges, merges_table_name, mode='append')
+db_connector.create_index(entity_index_table_name, ['indexkey'])
+# The alias trigram index starts out from every stored alias when an incremental run does not find it yet
+if watermark is None or db_connector.get_table_columns(table_name=alias_index_table_name):
+    indexed_aliases = df_person['alias']
+else:
+    indexed_aliases = db_connector.query_table(table_name=person_entity_table_name, selected_columns=['alias'])['alias']
+write_alias_index(db_connector, alias_index_table_name, alias_index_counts_table_name, indexed_aliases, rebuild=watermark is None)
+print("Writes:", {'write_seconds': round(time.perf_counter() - write_start, 3)})
+
+db_connector.set_watermark(stage_name, pd.to_datetime(df['loadedat']).max())
+
+db_connector.close()
+
+print("Done! Identity resolved data saved to the database. Table names:", person_entity_table_name, ",", account_entity_table_name, ",", output_table_name, ",", entity_index_table_name, ",", alias_index_table_name)
 
 """
 print(df_person)
@@ -32,30 +32,90 @@ Key: Person ID
 """------------------------------------------------------------------------------------------------------------------------------"""
 import pandas as pd
 import numpy as np
-from main import Database_Connector
+import sys
+import os
+from main import Database_Connector, is_full_rebuild
+from normalization import LOCAL_ADDRESSES
+from profile_features import (aggregate_features, category_counts, entity_events, new_beneficiary_ratio, night_time_flags, recent_events,
+                              rolling_window_maxima, time_lapse_minutes)
 
 db_connector = Database_Connector()
-engine = db_connector.get_engine()
 
 
+stage_name = "user_profiles"
 input_table_name_1 = "identity_resolved_transactions"
 input_table_name_2 = "person_entity_table"
 input_table_name_3 = "account_entity_table"
+input_table_name_4 = "person_entity_merges"
 output_table_name = "user_profiles_v2"
+breakdowns_table_name = "user_profile_breakdowns"
+transaction_times_table_name = "user_profile_transaction_times"
+rolling_windows = {'1hr': '1h', '24hr': '24h', '7d': '7D', '1m': '30D'}
+
+# (feature, column, filter, aggregation) of the sender (fromentity) and receiver (toentity) statistics
+sender_feature_specs = [
+    ('no_of_transactions_sent', 'amountinbirr', None, 'size'),
+    ('avg_transaction_amount_sent', 'amountinbirr', None, 'mean'),
+    ('std_transaction_amount_sent', 'amountinbirr', None, 'std'),
+    ('total_amount_sent', 'amountinbirr', None, 'sum'),
+    ('cash_transactions', 'amountinbirr', ('transactiontype', '=', 'cash'), 'sum'),
+    ('non_cash_transactions', 'amountinbirr', ('transactiontype', '!=', 'cash'), 'sum'),
+    ('cross_border_risk', 'is_cross_border', None, 'sum'),
+    ('night_time_transaction_ratio', 'is_night', None, 'mean'),
+]
+receiver_feature_specs = [
+    ('no_of_transactions_received', 'amountinbirr', None, 'size'),
+    ('avg_transaction_amount_received', 'amountinbirr', None, 'mean'),
+    ('std_transaction_amount_received', 'amountinbirr', None, 'std'),
+    ('total_amount_received', 'amountinbirr', None, 'sum'),
+]
+# Per-sender usage counts, written to the breakdowns table as (entity, feature, key, count, rank) rows. A top k > 0 keeps
+# each sender's k most used keys.
+breakdown_columns = {
+    'prefered_branches': 'branchid',
+    'used_transaction_types': 'transactiontype',
+    'frequent_destinations': 'beneficiaryaddress',
+    'top_beneficiaries': 'toentity',
+}
+breakdown_top_k = int(os.environ.get('DATA_FUSION_PROFILE_TOP_K', 0))
+# Transaction times kept per entity in the transaction times table, the most recent ones, 0 keeps them all
+recent_transaction_times = int(os.environ.get('DATA_FUSION_PROFILE_RECENT_TIMES', 0))
 
 transactions_column_names = db_connector.get_table_columns(table_name=input_table_name_1)
 person_column_names = db_connector.get_table_columns(table_name=input_table_name_2)
 account_column_names = db_connector.get_table_columns(table_name=input_table_name_3)
 
-df_transactions = db_connector.data_to_pandas_df(
-    db_connector.get_table_data_selected(table_name=input_table_name_1, selected_columns=transactions_column_names),
-    transactions_column_names)
-df_person = db_connector.data_to_pandas_df(
-    db_connector.get_table_data_selected(table_name=input_table_name_2, selected_columns=person_column_names),
-    person_column_names)
-df_account = db_connector.data_to_pandas_df(
-    db_connector.get_table_data_selected(table_name=input_table_name_3, selected_columns=account_column_names),
-    account_column_names)
+# Incremental runs only re-profile entities of transactions loaded since the watermark (using their full history); --full-rebuild profiles everyone
+watermark = None if is_full_rebuild() else db_connector.get_watermark(stage_name)
+
+if watermark is None:
+    df_transactions = pd.concat(db_connector.iter_table_chunks(table_name=input_table_name_1, selected_columns=transactions_column_names), ignore_index=True)
+    df_person = pd.concat(db_connector.iter_table_chunks(table_name=input_table_name_2, selected_columns=person_column_names), ignore_index=True)
+    df_account = pd.concat(db_connector.iter_table_chunks(table_name=input_table_name_3, selected_columns=account_column_names), ignore_index=True)
+    new_watermark = pd.to_datetime(df_transactions['loadedat']).max()
+else:
+    df_new_transactions = db_connector.query_table(table_name=input_table_name_1, selected_columns=['fromentity', 'toentity', 'loadedat'],
+                                                   filters=[('loadedat', '>', watermark)])
+    touched_entities = pd.unique(pd.concat([df_new_transactions['fromentity'], df_new_transactions['toentity']]).dropna())
+
+    if len(touched_entities) == 0:
+        db_connector.close()
+        print("Done! No new transactions since", watermark)
+        sys.exit(0)
+
+    transaction_chunks = [
+        db_connector.query_table_by_keys(table_name=input_table_name_1, selected_columns=transactions_column_names, key_column=key_column, keys=touched_entities)
+        for key_column in ['fromentity', 'toentity']
+    ]
+    df_transactions = pd.concat([chunk for chunk in transaction_chunks if len(chunk)], ignore_index=True).drop_duplicates(subset=['transactionid'])
+    df_person = db_connector.query_table_by_keys(table_name=input_table_name_2, selected_columns=person_column_names, key_column='personid', keys=touched_entities)
+    df_account = db_connector.query_table_by_keys(table_name=input_table_name_3, selected_columns=account_column_names, key_column='ownerentity', keys=touched_entities)
+    new_watermark = pd.to_datetime(df_new_transactions['loadedat']).max()
+
+    # personids identity resolution merged into another entity since the watermark, their stored rows are dropped when writing
+    retired_entities = pd.Series(dtype=object)
+    if db_connector.get_table_columns(table_name=input_table_name_4):
+        retired_entities = db_connector.query_table(table_name=input_table_name_4, selected_columns=['personid'], filters=[('loadedat', '>', watermark)])['personid']
 
 
 """
@@ -76,6 +136,8 @@ print(df_account.dtypes)
 
 
 df_account['openeddate'] = pd.to_datetime(df_account['openeddate'], errors='coerce')
+# Timestamps come back as text from databases without a timestamp type (SQLite)
+df_transactions['transactiondatetime'] = pd.to_datetime(df_transactions['transactiondatetime'], errors='coerce')
 
 df_user_risk = pd.DataFrame(index=df_person['personid'].unique())
 
@@ -136,204 +198,110 @@ df_user_risk[['account_age_days', 'account_age_years', 'account_age_bucket']] =
 
 # 2. Behavioral Feature (for Person ID)
 
+# Sender and beneficiary side of every transaction in one table sorted by (entity, time), shared by the sent-and-received features
+df_events = entity_events(df_transactions)
+
+# Per-transaction indicators aggregated by the feature specs
+df_transactions['is_night'] = night_time_flags(df_transactions['transactiondatetime'])
+df_transactions['is_cross_border'] = np.where(df_transactions['beneficiaryaddress'].isna() | df_transactions['beneficiaryaddress'].isin(LOCAL_ADDRESSES), 0, 1)
+
+# All sender and all receiver statistics come from one groupby each
+df_sent = aggregate_features(df_transactions, 'fromentity', sender_feature_specs)
+df_received = aggregate_features(df_transactions, 'toentity', receiver_feature_specs)
 
 ##     No of transactions sent/received
 
-df_user_risk['no_of_transactions_sent'] = df_transactions.groupby('fromentity').size()
-df_user_risk['no_of_transactions_received'] = df_transactions.groupby('toentity').size()
+df_user_risk['no_of_transactions_sent'] = df_sent['no_of_transactions_sent']
+df_user_risk['no_of_transactions_received'] = df_received['no_of_transactions_received']
 
 ##     Avg transaction amount
 
-df_user_risk['avg_transaction_amount_sent'] = df_transactions.groupby('fromentity')['amountinbirr'].mean()
-df_user_risk['avg_transaction_amount_received'] = df_transactions.groupby('toentity')['amountinbirr'].mean()
+df_user_risk['avg_transaction_amount_sent'] = df_sent['avg_transaction_amount_sent']
+df_user_risk['avg_transaction_amount_received'] = df_received['avg_transaction_amount_received']
 
 ##     Std deviation of amounts
 
-df_user_risk['std_transaction_amount_sent'] = df_transactions.groupby('fromentity')['amountinbirr'].std()
-df_user_risk['std_transaction_amount_received'] = df_transactions.groupby('toentity')['amountinbirr'].std()
-df_user_risk['std_transaction_amount_sent_and_received'] = pd.concat([
-    df_transactions[['fromentity', 'amountinbirr']].rename(columns={'fromentity': 'entity'}),
-    df_transactions[['toentity', 'amountinbirr']].rename(columns={'toentity': 'entity'})
-]).groupby('entity')['amountinbirr'].std()
-
-
-##     Tx frequency/hour/day/week/month
-
-df_user_risk['max_freq_1hr'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('1h').count().groupby('fromentity').max()
-
-df_user_risk['max_freq_24hr'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('24h').count().groupby('fromentity').max()
+df_user_risk['std_transaction_amount_sent'] = df_sent['std_transaction_amount_sent']
+df_user_risk['std_transaction_amount_received'] = df_received['std_transaction_amount_received']
+df_user_risk['std_transaction_amount_sent_and_received'] = df_events.groupby('entity', sort=False)['amountinbirr'].std()
 
-df_user_risk['max_freq_7d'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('7D').count().groupby('fromentity').max()
 
-df_user_risk['max_freq_1m'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('30D').count().groupby('fromentity').max()
+##     Tx frequency/hour/day/week/month and Tx volume/hour/day/week/month (highest count and amount sent inside any window)
 
-##     Tx volume/hour/day/week/month
-
-df_user_risk['max_volume_1hr'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('1h').sum().groupby('fromentity').max()
-
-df_user_risk['max_volume_24hr'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('24h').sum().groupby('fromentity').max()
-
-df_user_risk['max_volume_7d'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('7D').sum().groupby('fromentity').max()
-
-df_user_risk['max_volume_1m'] = df_transactions.set_index('transactiondatetime')\
-    .sort_index().groupby('fromentity')['amountinbirr'].rolling('30D').sum().groupby('fromentity').max()
+df_user_risk[[f"max_{feature}_{name}" for feature in ['freq', 'volume'] for name in rolling_windows]] = \
+    rolling_window_maxima(df_transactions['fromentity'], df_transactions['transactiondatetime'], df_transactions['amountinbirr'], rolling_windows)
 
 
 ##     Total Amount recieved
-df_user_risk['total_amount_received'] = df_transactions.groupby('toentity')['amountinbirr'].sum()
+df_user_risk['total_amount_received'] = df_received['total_amount_received']
 
 
 ##     Amount recieved vs sent ratio
 
-df_user_risk['total_amount_sent'] = df_transactions.groupby('fromentity')['amountinbirr'].sum()
+df_user_risk['total_amount_sent'] = df_sent['total_amount_sent']
 df_user_risk['amount_received_vs_sent_ratio'] = df_user_risk['total_amount_received'] / (df_user_risk['total_amount_sent'] + 1)  # Adding 1 to avoid division by zero
 
 ##     Cash vs non-cash ratio
 
-df_user_risk['cash_transactions'] = df_transactions[df_transactions['transactiontype'] == 'cash'].groupby('fromentity')['amountinbirr'].sum()
-df_user_risk['non_cash_transactions'] = df_transactions[df_transactions['transactiontype'] != 'cash'].groupby('fromentity')['amountinbirr'].sum()
+df_user_risk['cash_transactions'] = df_sent['cash_transactions']
+df_user_risk['non_cash_transactions'] = df_sent['non_cash_transactions']
 df_user_risk['cash_vs_non_cash_ratio'] = df_user_risk['cash_transactions'] / (df_user_risk['non_cash_transactions'] + 1)
 
 #     Cross-border ratio
-local_addresses = ['aa', 'tg', 'or', 'snnp', 'af', 'sid', 'am', 'gamb', 'som', 'bgum', 'har', 'ddw']
 
-df_user_risk["cross_border_risk"] = df_transactions[['fromentity','beneficiaryaddress']]\
-                                        .assign(cross_risk = np.where(df_transactions['beneficiaryaddress'].isna() | df_transactions['beneficiaryaddress'].isin(local_addresses), 0, 1))\
-                                        .groupby('fromentity')\
-                                        .agg(cross_border_risk=('cross_risk', 'sum'))\
-                                        ['cross_border_risk']
+df_user_risk["cross_border_risk"] = df_sent['cross_border_risk']
 
 
 #     Night-time transaction ratio
-df_transactions['transaction_hour'] = df_transactions['transactiondatetime'].dt.hour
-df_user_risk['night_time_transaction_ratio'] = df_transactions.assign(is_night=lambda x: x['transaction_hour'].apply(lambda h: 1 if (h >= 20 or h < 6) else 0))\
-                                        .groupby('fromentity')\
-                                        .agg(total_transactions=('is_night', 'count'),
-                                             night_transactions=('is_night', 'sum'))\
-                                        .assign(night_time_transaction_ratio=lambda x: x['night_transactions'] / x['total_transactions'])\
-                                        ['night_time_transaction_ratio']
 
+df_user_risk['night_time_transaction_ratio'] = df_sent['night_time_transaction_ratio']
 
 
 
-#     New/unique beneficiary ratio
 
-def get_single_ratio(group):
-    total_volume = group[0].count()
-    single_volume = group.loc[group[0] == 1, 0].count()
-    return (single_volume / total_volume) * group[0].sum()
+#     New/unique beneficiary ratio
 
-df_user_risk['new_beneficiary_ratio'] = df_transactions\
-        .groupby(['fromentity', 'toentity'])\
-        .size()\
-        .reset_index()\
-        .sort_values(by=['fromentity', 0], ascending=[True, False])\
-        .groupby(['fromentity'])\
-        .apply(get_single_ratio)\
-        .rename("unknown_beneficiary_risk_score")
+df_user_risk['new_beneficiary_ratio'] = new_beneficiary_ratio(df_transactions['fromentity'], df_transactions['toentity'])
 
 
 #     Dormant → active pattern
 
-df_user_risk["all_transaction_times"] = pd.concat([
-            df_transactions[['fromentity', 'transactiondatetime']].rename(columns={'fromentity': 'entity'}).assign(role=lambda x: "sender"),
-            df_transactions[['toentity', 'transactiondatetime']].rename(columns={'toentity': 'entity'}).assign(role=lambda x: "beneficiary")
-        ])\
-        .sort_values(by=['entity', 'transactiondatetime'])\
-        .assign(time_lapse = lambda x: x.groupby('entity')['transactiondatetime'].diff())\
-        .reset_index(drop=True)\
-        .assign(transactiondatetime = lambda x: x['transactiondatetime'].astype(str))\
-        .assign(time_lapse = lambda x: x['time_lapse'].astype(str))\
-        [['entity', 'transactiondatetime', 'time_lapse', 'role']]\
-        .assign(
-            time_lapse = lambda x: x['time_lapse'].fillna(pd.Timedelta(seconds=0)).astype(str),
-            transactiondatetime = lambda x: x['transactiondatetime'].astype(str)
-        )\
-        .assign(transaction_timedelta_all=lambda x: '"' + x['transactiondatetime'].astype(str) + '": ' + "[\"" + x['time_lapse'].astype(str) + "\",\"" + x['role'].astype(str) + "\"]")\
-        .groupby('entity')['transaction_timedelta_all']\
-        .agg(lambda x: '{' + ', '.join(x) + '}')
-
-
-
-df_user_risk[["min_time_lapse_minutes", "max_time_lapse_minutes", "avg_time_lapse_minutes"]] = pd.concat([
-            df_transactions[['fromentity', 'transactiondatetime']].rename(columns={'fromentity': 'entity'}).assign(role=lambda x: "sender"),
-            df_transactions[['toentity', 'transactiondatetime']].rename(columns={'toentity': 'entity'}).assign(role=lambda x: "beneficiary")
-        ])\
-        .sort_values(by=['entity', 'transactiondatetime'])\
-        .assign(time_lapse = lambda x: x.groupby('entity')['transactiondatetime'].diff().dt.total_seconds() / 60)\
-        .reset_index(drop=True)\
-        .groupby("entity")\
-        .agg(min_time_lapse_minutes=('time_lapse', 'min'), max_time_lapse_minutes=('time_lapse', 'max'), avg_time_lapse_minutes=('time_lapse', 'mean'))\
-        .fillna(-1)\
-        .apply(lambda x: round(x, 2))
-
-df_user_risk["last_transaction_time"] = pd.concat([
-            df_transactions[['fromentity', 'transactiondatetime']].rename(columns={'fromentity': 'entity'}).assign(role=lambda x: "sender"),
-            df_transactions[['toentity', 'transactiondatetime']].rename(columns={'toentity': 'entity'}).assign(role=lambda x: "beneficiary")
-        ])\
-        .sort_values(by=['entity', 'transactiondatetime'])\
-        .groupby('entity')\
-        .last()['transactiondatetime']\
-        .rename("last_transaction_time")
-
-
-
-#     Prefered Branches
-
-df_user_risk['prefered_branches'] = df_transactions[df_transactions['fromentity'].isin(df_user_risk.index)]\
-                                        .groupby(['fromentity', 'branchid'])\
-                                        .size()\
-                                        .reset_index()\
-                                        .rename(columns={0: "count"})\
-                                        .assign(prefered_branches=lambda x: '"' + x['branchid'].astype(str) + '": ' + x['count'].astype(int).astype(str))\
-                                        .groupby('fromentity')['prefered_branches']\
-                                        .agg(lambda x: '{' + ', '.join(x) + '}')
-
-
-#      Typical Transaction Types
-
-df_user_risk['used_transaction_types'] = df_transactions[df_transactions['fromentity'].isin(df_user_risk.index)]\
-                                        .groupby(['fromentity', 'transactiontype'])\
-                                        .size()\
-                                        .reset_index()\
-                                        .rename(columns={0: "count"})\
-                                        .assign(used_transaction_types=lambda x: '"' + x['transactiontype'].astype(str) + '": ' + x['count'].astype(int).astype(str))\
-                                        .groupby('fromentity')['used_transaction_types']\
-                                        .agg(lambda x: '{' + ', '.join(x) + '}')
-
-
-#       Frequent Destinations
-
-df_user_risk['frequent_destinations'] = df_transactions[df_transactions['fromentity'].isin(df_user_risk.index)]\
-                                        .groupby(['fromentity', 'beneficiaryaddress'])\
-                                        .size()\
-                                        .reset_index()\
-                                        .rename(columns={0: "count"})\
-                                        .assign(frequent_destinations=lambda x: '"' + x['beneficiaryaddress'].astype(str) + '": ' + x['count'].astype(int).astype(str))\
-                                        .groupby('fromentity')['frequent_destinations']\
-                                        .agg(lambda x: '{' + ', '.join(x) + '}')
-
-#       Top Beneficiaries
-
-df_user_risk['top_beneficiaries'] = df_transactions[df_transactions['fromentity'].isin(df_user_risk.index)]\
-                                        .groupby(['fromentity', 'toentity'])\
-                                        .size()\
-                                        .reset_index()\
-                                        .rename(columns={0: "count"})\
-                                        .sort_values(by=['fromentity', 'count'], ascending=[True, False])\
-                                        .assign(top_beneficiaries=lambda x: '"' + x['toentity'].astype(str) + '": ' + x['count'].astype(int).astype(str))\
-                                        .groupby('fromentity')['top_beneficiaries']\
-                                        .agg(lambda x: '{' + ', '.join(x) + '}')
-
-
-df_user_risk.reset_index().to_sql(output_table_name, con=engine, if_exists='replace', index=False)
+df_transaction_times = recent_events(df_events[df_events['entity'].isin(df_user_risk.index).to_numpy()], recent_transaction_times)
+
+df_user_risk[["min_time_lapse_minutes", "max_time_lapse_minutes", "avg_time_lapse_minutes"]] = time_lapse_minutes(df_events)
+
+df_user_risk["last_transaction_time"] = df_events.groupby('entity', sort=False)['transactiondatetime'].last()
+
+
+
+#     Prefered Branches, Typical Transaction Types, Frequent Destinations, Top Beneficiaries
+
+df_profiled_transactions = df_transactions[df_transactions['fromentity'].isin(df_user_risk.index)]
+
+df_breakdowns = pd.concat([
+    category_counts(df_profiled_transactions['fromentity'], df_profiled_transactions[column], top_k=breakdown_top_k).assign(feature=feature)
+    for feature, column in breakdown_columns.items()
+], ignore_index=True)[['entity', 'feature', 'key', 'count', 'rank']]
+
+
+# Incremental runs replace every stored breakdown and time row of the re-profiled entities, and drop the rows of merged-away ones
+if watermark is None:
+    db_connector.bulk_write(df_user_risk.reset_index(), output_table_name, mode='replace')
+    db_connector.bulk_write(df_breakdowns, breakdowns_table_name, mode='replace')
+    db_connector.bulk_write(df_transaction_times, transaction_times_table_name, mode='replace')
+else:
+    retired_entities = retired_entities[~retired_entities.isin(df_user_risk.index)]
+    for table_name, key_column in [(output_table_name, 'index'), (breakdowns_table_name, 'entity'), (transaction_times_table_name, 'entity')]:
+        db_connector.delete_by_keys(table_name=table_name, key_column=key_column, keys=retired_entities)
+    db_connector.bulk_write(df_user_risk.reset_index(), output_table_name, mode='upsert', key_columns=['index'])
+    db_connector.bulk_write(df_breakdowns, breakdowns_table_name, mode='replace_keys', key_columns=['entity'])
+    db_connector.bulk_write(df_transaction_times, transaction_times_table_name, mode='replace_keys', key_columns=['entity'])
+db_connector.create_index(breakdowns_table_name, ['entity'])
+db_connector.create_index(transaction_times_table_name, ['entity'])
+
+db_connector.set_watermark(stage_name, new_watermark)
+
+db_connector.close()
 
 print(df_user_risk.head())
 print(len(df_user_risk))
@@ -0,0 +1,341 @@
+"""
+String similarity measures used by record linkage.
+
+    - jaro_winkler: Jaro-Winkler similarity (prefix scale 0.1, prefix up to 4 characters, boost only above 0.7),
+      the same definition recordlinkage uses through jellyfish
+    - levenshtein_similarity: 1 - edit distance / length of the longer string
+    - ngram_jaccard: Jaccard similarity of the sets of character n-grams (a string shorter than n is its own single gram)
+
+Each measure has a scalar reference and a batched *_pairs version that scores arrays of candidate pairs at once. The batched
+versions encode the strings as fixed-width arrays of code points and run every step over all pairs of a batch. When numba is
+installed, Jaro-Winkler and Levenshtein run compiled loops over the same arrays instead.
+tests/test_string_similarity.py checks that both agree on realistic name variants, benchmarks/string_similarity.py reports pairs per second.
+"""
+"""------------------------------------------------------------------------------------------------------------------------------"""
+import pandas as pd
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# Reference implementations
+
+def jaro_similarity(first: str, second: str):
+    if first == second:
+        return 1.0
+    first_length, second_length = len(first), len(second)
+    if first_length == 0 or second_length == 0:
+        return 0.0
+
+    search_range = max(max(first_length, second_length) // 2 - 1, 0)
+    first_flags = [False] * first_length
+    second_flags = [False] * second_length
+
+    common = 0
+    for i, character in enumerate(first):
+        low, high = max(0, i - search_range), min(i + search_range + 1, second_length)
+        for j in range(low, high):
+            if not second_flags[j] and second[j] == character:
+                first_flags[i] = second_flags[j] = True
+                common += 1
+                break
+    if common == 0:
+        return 0.0
+
+    transpositions = 0
+    j = 0
+    for i in range(first_length):
+        if first_flags[i]:
+            while not second_flags[j]:
+                j += 1
+            if first[i] != second[j]:
+                transpositions += 1
+            j += 1
+    transpositions //= 2
+
+    return (common / first_length + common / second_length + (common - transpositions) / common) / 3
+
+
+def jaro_winkler(first: str, second: str, prefix_scale: float = 0.1, max_prefix: int = 4):
+    similarity = jaro_similarity(first, second)
+    if similarity <= 0.7:
+        return similarity
+
+    prefix = 0
+    for first_character, second_character in zip(first[:max_prefix], second[:max_prefix]):
+        if first_character != second_character:
+            break
+        prefix += 1
+    return similarity + prefix * prefix_scale * (1 - similarity)
+
+
+def levenshtein_similarity(first: str, second: str):
+    if not first and not second:
+        return 1.0
+    previous = list(range(len(second) + 1))
+    for i, first_character in enumerate(first, 1):
+        current = [i]
+        for j, second_character in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_character != second_character)))
+        previous = current
+    return 1 - previous[-1] / max(len(first), len(second))
+
+
+def ngrams(value: str, n: int = 3):
+    return {value[i:i + n] for i in range(len(value) - n + 1)} or {value}
+
+
+def ngram_jaccard(first: str, second: str, n: int = 3):
+    first_grams, second_grams = ngrams(first, n), ngrams(second, n)
+    return len(first_grams & second_grams) / len(first_grams | second_grams)
+
+
+# Encoding
+
+def encode_strings(values):
+    # Fixed-width array of code points (zero padded) and the length of every string
+    values = np.asarray(values, dtype=str)
+    width = max(int(np.char.str_len(values).max()) if len(values) else 0, 1)
+    codes = np.ascontiguousarray(values.astype(f'U{width}')).view(np.uint32).reshape(len(values), width)
+    return codes, np.char.str_len(values).astype(np.int64)
+
+
+def encode_pairs(first, second):
+    # Both sides share one encoding of their distinct strings, pairs then index into it
+    codes, uniques = pd.factorize(pd.Series(np.concatenate([np.asarray(first, dtype=object), np.asarray(second, dtype=object)]), dtype=object))
+    encoded, lengths = encode_strings(np.asarray(uniques, dtype=object))
+    return encoded, lengths, codes[:len(first)], codes[len(first):]
+
+
+def batched(kernel, first, second, batch_pairs: int, **options):
+    # Runs kernel(codes_a, lengths_a, codes_b, lengths_b) over slices of the pairs to bound the size of the temporary arrays
+    first, second = np.asarray(first, dtype=object), np.asarray(second, dtype=object)
+    result = np.empty(len(first), dtype=np.float64)
+    if len(first) == 0:
+        return result
+    encoded, lengths, first_codes, second_codes = encode_pairs(first, second)
+    for start in range(0, len(first), batch_pairs):
+        a, b = first_codes[start:start + batch_pairs], second_codes[start:start + batch_pairs]
+        a_lengths, b_lengths = lengths[a], lengths[b]
+        # Trim the padding to the longest string of the batch
+        a_width, b_width = max(int(a_lengths.max()), 1), max(int(b_lengths.max()), 1)
+        result[start:start + batch_pairs] = kernel(encoded[a, :a_width], a_lengths, encoded[b, :b_width], b_lengths, **options)
+    return result
+
+
+# Jaro-Winkler
+
+def matched_in_order(codes, flags):
+    # The flagged characters of every row moved to the front, in their original order
+    rows, positions = np.nonzero(flags)
+    ranks = (np.cumsum(flags, axis=1) - 1)[rows, positions]
+    matched = np.zeros_like(codes)
+    matched[rows, ranks] = codes[rows, positions]
+    return matched
+
+
+def jaro_winkler_kernel(a, a_lengths, b, b_lengths, prefix_scale: float = 0.1, max_prefix: int = 4):
+    # Code points that no name contains mark the padding of a and b and the characters of b already matched,
+    # so one comparison per window position also checks the lengths and the matched flags
+    dtype = np.uint16 if max(int(a.max()), int(b.max())) < 0xFFFD else np.uint32
+    a_padding, b_padding, b_taken = np.iinfo(dtype).max, np.iinfo(dtype).max - 1, np.iinfo(dtype).max - 2
+    a_work = np.where(np.arange(a.shape[1]) < a_lengths[:, None], a, a_padding).astype(dtype)
+    b_work = np.where(np.arange(b.shape[1]) < b_lengths[:, None], b, b_padding).astype(dtype)
+
+    search_range = np.maximum(np.maximum(a_lengths, b_lengths) // 2 - 1, 0)
+    max_range = int(search_range.max())
+    # allowed[:, max_range + d] tells whether position i + d of b is inside the window of position i of a
+    allowed = np.abs(np.arange(-max_range, max_range + 1)) <= search_range[:, None]
+    a_flags = np.zeros(a.shape, dtype=bool)
+    rows = np.arange(len(a))
+
+    # Same greedy matching as the reference: every character of a takes the first unmatched equal character of b in its window
+    for i in range(a.shape[1]):
+        low, high = max(0, i - max_range), min(b.shape[1], i + max_range + 1)
+        if low >= high:
+            break
+        candidates = (b_work[:, low:high] == a_work[:, i, None]) & allowed[:, low - i + max_range:high - i + max_range]
+        first_match = candidates.argmax(axis=1)
+        matched = np.flatnonzero(candidates[rows, first_match])
+        b_work[matched, low + first_match[matched]] = b_taken
+        a_flags[matched, i] = True
+
+    b_flags = b_work == b_taken
+    common = a_flags.sum(axis=1)
+    # The k-th matched character of a against the k-th matched character of b
+    width = min(a.shape[1], b.shape[1])
+    a_matched, b_matched = matched_in_order(a, a_flags)[:, :width], matched_in_order(b, b_flags)[:, :width]
+    transpositions = ((a_matched != b_matched) & (np.arange(width) < common[:, None])).sum(axis=1) // 2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarity = (common / a_lengths + common / b_lengths + (common - transpositions) / common) / 3
+    similarity[common == 0] = 0.0
+    similarity[(a_lengths == b_lengths) & (common == a_lengths) & (transpositions == 0) & (a_matched == b_matched).all(axis=1)] = 1.0
+
+    prefix_width = min(max_prefix, width)
+    same_prefix = (a[:, :prefix_width] == b[:, :prefix_width]) & (np.arange(prefix_width) < np.minimum(a_lengths, b_lengths)[:, None])
+    prefix = np.cumprod(same_prefix, axis=1).sum(axis=1)
+    boosted = similarity + prefix * prefix_scale * (1 - similarity)
+    return np.where(similarity > 0.7, boosted, similarity)
+
+
+def jaro_winkler_loops(a, a_lengths, b, b_lengths, prefix_scale: float = 0.1, max_prefix: int = 4):
+    result = np.empty(len(a), dtype=np.float64)
+    b_flags = np.zeros(b.shape[1], dtype=np.bool_)
+    a_flags = np.zeros(a.shape[1], dtype=np.bool_)
+    for row in range(len(a)):
+        a_length, b_length = a_lengths[row], b_lengths[row]
+        equal = a_length == b_length
+        for k in range(min(a_length, b_length)):
+            if a[row, k] != b[row, k]:
+                equal = False
+                break
+        if equal:
+            result[row] = 1.0
+            continue
+        if a_length == 0 or b_length == 0:
+            result[row] = 0.0
+            continue
+
+        search_range = max(max(a_length, b_length) // 2 - 1, 0)
+        a_flags[:a_length] = False
+        b_flags[:b_length] = False
+        common = 0
+        for i in range(a_length):
+            for j in range(max(0, i - search_range), min(i + search_range + 1, b_length)):
+                if not b_flags[j] and b[row, j] == a[row, i]:
+                    a_flags[i] = True
+                    b_flags[j] = True
+                    common += 1
+                    break
+        if common == 0:
+            result[row] = 0.0
+            continue
+
+        transpositions = 0
+        j = 0
+        for i in range(a_length):
+            if a_flags[i]:
+                while not b_flags[j]:
+                    j += 1
+                if a[row, i] != b[row, j]:
+                    transpositions += 1
+                j += 1
+        transpositions //= 2
+
+        similarity = (common / a_length + common / b_length + (common - transpositions) / common) / 3
+        if similarity > 0.7:
+            prefix = 0
+            for k in range(min(max_prefix, a_length, b_length)):
+                if a[row, k] != b[row, k]:
+                    break
+                prefix += 1
+            similarity = similarity + prefix * prefix_scale * (1 - similarity)
+        result[row] = similarity
+    return result
+
+
+# Levenshtein
+
+def levenshtein_kernel(a, a_lengths, b, b_lengths):
+    # Row by row over the characters of a, every row of the edit-distance table computed for all pairs at once.
+    # Insertions chain along the row, which is a running minimum of (cell - column) shifted back by the column.
+    pairs, b_width = len(a), b.shape[1]
+    columns = np.arange(b_width + 1)
+    previous = np.broadcast_to(columns, (pairs, b_width + 1)).astype(np.int64)
+    distance = b_lengths.copy()
+    for i in range(1, a.shape[1] + 1):
+        substitution = previous[:, :-1] + (b != a[:, i - 1, None])
+        best = np.minimum(substitution, previous[:, 1:] + 1)
+        shifted = np.empty_like(previous)
+        shifted[:, 0] = i
+        shifted[:, 1:] = best - columns[1:]
+        current = np.minimum.accumulate(shifted, axis=1) + columns
+        finished = np.flatnonzero(a_lengths == i)
+        distance[finished] = current[finished, b_lengths[finished]]
+        previous = current
+
+    longest = np.maximum(a_lengths, b_lengths)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(longest == 0, 1.0, 1 - distance / longest)
+
+
+def levenshtein_loops(a, a_lengths, b, b_lengths):
+    result = np.empty(len(a), dtype=np.float64)
+    previous = np.empty(b.shape[1] + 1, dtype=np.int64)
+    current = np.empty(b.shape[1] + 1, dtype=np.int64)
+    for row in range(len(a)):
+        a_length, b_length = a_lengths[row], b_lengths[row]
+        if a_length == 0 and b_length == 0:
+            result[row] = 1.0
+            continue
+        for j in range(b_length + 1):
+            previous[j] = j
+        for i in range(1, a_length + 1):
+            current[0] = i
+            for j in range(1, b_length + 1):
+                cost = previous[j - 1] + (1 if a[row, i - 1] != b[row, j - 1] else 0)
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, cost)
+            previous, current = current, previous
+        result[row] = 1 - previous[b_length] / max(a_length, b_length)
+    return result
+
+
+# Character n-grams
+
+def ngram_kernel(a, a_lengths, b, b_lengths, n: int = 3):
+    # A gram is its n code points packed 21 bits each into one integer, strings shorter than n are a single (zero padded) gram
+    if n > 3:
+        raise ValueError("n-grams longer than 3 characters do not fit in one integer")
+    def grams(codes, lengths):
+        width = max(codes.shape[1] - n + 1, 1)
+        codes = np.pad(codes, ((0, 0), (0, max(n - codes.shape[1], 0)))).astype(np.int64)
+        packed = np.zeros((len(codes), width), dtype=np.int64)
+        for k in range(n):
+            packed = (packed << 21) | codes[:, k:k + width]
+        valid = np.arange(width) < np.maximum(lengths - n + 1, 1)[:, None]
+        # Repeated grams of one string count once, as in a set
+        packed = np.sort(np.where(valid, packed, -1), axis=1)
+        valid = packed >= 0
+        valid[:, 1:] &= packed[:, 1:] != packed[:, :-1]
+        return packed, valid
+
+    a_grams, a_valid = grams(a, a_lengths)
+    b_grams, b_valid = grams(b, b_lengths)
+    shared = ((a_grams[:, :, None] == b_grams[:, None, :]) & a_valid[:, :, None] & b_valid[:, None, :]).sum(axis=(1, 2))
+    return shared / (a_valid.sum(axis=1) + b_valid.sum(axis=1) - shared)
+
+
+if njit is not None:
+    jaro_winkler_loops = njit(cache=True)(jaro_winkler_loops)
+    levenshtein_loops = njit(cache=True)(levenshtein_loops)
+
+
+def jaro_winkler_pairs(first, second, prefix_scale: float = 0.1, max_prefix: int = 4, batch_pairs: int = 10000, compiled: bool = None):
+    compiled = njit is not None if compiled is None else compiled
+    kernel = jaro_winkler_loops if compiled else jaro_winkler_kernel
+    return batched(kernel, first, second, batch_pairs, prefix_scale=prefix_scale, max_prefix=max_prefix)
+
+
+def levenshtein_similarity_pairs(first, second, batch_pairs: int = 50000, compiled: bool = None):
+    compiled = njit is not None if compiled is None else compiled
+    return batched(levenshtein_loops if compiled else levenshtein_kernel, first, second, batch_pairs)
+
+
+def ngram_jaccard_pairs(first, second, n: int = 3, batch_pairs: int = 20000):
+    return batched(ngram_kernel, first, second, batch_pairs, n=n)
+
+
+# Synthetic name pairs for the tests and benchmarks
+
+def name_variant_pairs(pairs: int, seed: int = 0):
+    # Alias pairs as the blocking passes produce them: spelling variants of the same person next to near-miss different persons
+    from record_linkage import generate_candidate_pairs, generate_person_corpus
+    df_person = generate_person_corpus(max(pairs // 8, 100), seed=seed)
+    left, right, _ = generate_candidate_pairs(df_person)
+    aliases = df_person['alias'].to_numpy(dtype=object)
+    sample = np.random.default_rng(seed).choice(len(left), min(pairs, len(left)), replace=False)
+    return aliases[left[sample]], aliases[right[sample]]
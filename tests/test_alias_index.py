@@ -0,0 +1,19 @@
+"""
+The trigram alias index against the reference trigram Jaccard similarity.
+"""
+import numpy as np
+from alias_index import similar_aliases, write_alias_index
+from main import Database_Connector
+from record_linkage import generate_person_corpus
+from string_similarity import ngram_jaccard
+
+
+def test_similar_aliases_are_scored_like_ngram_jaccard():
+    aliases = generate_person_corpus(2000, records_per_person=1)['alias']
+    with Database_Connector(database_url='sqlite://') as db_connector:
+        write_alias_index(db_connector, 'person_alias_trigrams', 'person_alias_trigram_counts', aliases, rebuild=True)
+        for query in aliases.sample(50, random_state=0).tolist():
+            result = similar_aliases(db_connector, 'person_alias_trigrams', 'person_alias_trigram_counts', query, k=10, min_similarity=0.6)
+            # The query's own alias is among the best and the scores are the reference similarities
+            assert query in set(result.loc[result['similarity'] == 1.0, 'alias'])
+            assert np.allclose(result['similarity'], [ngram_jaccard(query, alias) for alias in result['alias']])
@@ -0,0 +1,43 @@
+"""
+The key dictionary lookups against the pandas merges they replace.
+"""
+import numpy as np
+import pandas as pd
+from key_dictionary import Key_Dictionary, first_value_table, lookup
+
+
+def synthetic_owners(rows: int, seed: int = 0):
+    # (people with an alias and a personid, accounts with an owner name, account numbers to resolve with 2% missing)
+    rng = np.random.default_rng(seed)
+    owners = pd.Series([f"owner {value} of the bank" for value in rng.integers(0, rows // 4, rows // 2)], dtype=object)
+    entities = pd.Series([f"ENTITY_{value:032x}" for value in rng.integers(0, 2 ** 62, len(owners))], dtype=object)
+    accounts = pd.Series([f"1000{value:012d}" if value % 50 else None for value in rng.integers(0, rows // 2, rows)], dtype=object)
+    df_people = pd.DataFrame({'alias': owners, 'personid': entities})
+    df_accounts = pd.DataFrame({'accountno': accounts[:len(owners)], 'ownername': owners.sample(frac=1, random_state=0).to_numpy()})
+    return df_people, df_accounts, accounts
+
+
+def merged_owners(df_people, df_accounts, accounts):
+    expected = df_accounts.merge(df_people.drop_duplicates(subset=['alias']), left_on='ownername', right_on='alias', how='left')['personid']
+    return pd.DataFrame({'accountno': accounts}).merge(
+        pd.DataFrame({'accountno': df_accounts['accountno'], 'ownerentity': expected}).drop_duplicates(subset=['accountno']), on='accountno', how='left'
+    )['ownerentity']
+
+
+def looked_up_owners(df_people, df_accounts, accounts):
+    names, entity_ids, account_numbers = Key_Dictionary(df_people['alias']), Key_Dictionary(df_people['personid']), Key_Dictionary(df_accounts['accountno'])
+    owner_table = first_value_table(names.codes, entity_ids.codes, len(names))
+    owner_codes = lookup(owner_table, names.encode(df_accounts['ownername']))
+    account_table = first_value_table(account_numbers.codes, owner_codes, len(account_numbers))
+    return entity_ids.decode(lookup(account_table, account_numbers.encode(accounts)))
+
+
+def test_lookups_match_merges():
+    df_people, df_accounts, accounts = synthetic_owners(20000)
+    expected = merged_owners(df_people, df_accounts, accounts)
+    result = looked_up_owners(df_people, df_accounts, accounts)
+
+    # A left merge on a missing accountno matches the first account row without one, the code lookup leaves it unmatched
+    matched = accounts.notna().to_numpy()
+    assert pd.Series(result)[matched].astype(object).equals(expected[matched].astype(object))
+    assert pd.Series(result)[~matched].isna().all()
@@ -0,0 +1,176 @@
+"""
+Database_Connector on a temporary SQLite database: the bulk_write modes and their staging-table swap, the compiled SELECT
+queries, the shared engines and the stage watermarks.
+"""
+import datetime
+import pandas as pd
+import pytest
+from sqlalchemy import inspect
+from main import Database_Connector, is_full_rebuild
+
+
+@pytest.fixture
+def db_connector(tmp_path):
+    connector = Database_Connector(database_url=f"sqlite:///{tmp_path / 'test.db'}")
+    yield connector
+    connector.close(dispose=True)
+
+
+def stored_rows(db_connector, table_name, order_by):
+    return db_connector.query_table(table_name=table_name, order_by=order_by).astype(object).where(lambda x: x.notna(), None)
+
+
+def table_names(db_connector):
+    return set(inspect(db_connector.engine).get_table_names())
+
+
+def test_replace_writes_the_frame_and_drops_the_staging_table(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a', 'b'], 'amount': [1.0, 2.0]}), 'profiles')
+    assert db_connector.bulk_write(pd.DataFrame({'personid': ['c'], 'amount': [3.0]}), 'profiles', mode='replace') == 1
+    assert stored_rows(db_connector, 'profiles', ['personid']).to_dict('records') == [{'personid': 'c', 'amount': 3.0}]
+    assert table_names(db_connector) == {'profiles'}
+
+
+def test_append_keeps_the_stored_rows(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a'], 'amount': [1.0]}), 'profiles')
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a', 'b'], 'amount': [2.0, 3.0]}), 'profiles', mode='append')
+    assert stored_rows(db_connector, 'profiles', ['personid', 'amount'])['amount'].tolist() == [1.0, 2.0, 3.0]
+    assert table_names(db_connector) == {'profiles'}
+
+
+def test_append_and_upsert_create_a_missing_table(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a']}), 'appended', mode='append')
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a']}), 'upserted', mode='upsert', key_columns=['personid'])
+    assert len(stored_rows(db_connector, 'appended', ['personid'])) == len(stored_rows(db_connector, 'upserted', ['personid'])) == 1
+    assert table_names(db_connector) == {'appended', 'upserted'}
+
+
+def test_upsert_replaces_stored_keys_and_keeps_the_last_duplicate(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'personid': ['a', 'b'], 'amount': [1.0, 2.0]}), 'profiles')
+    db_connector.bulk_write(pd.DataFrame({'personid': ['b', 'c', 'c'], 'amount': [20.0, 30.0, 31.0]}), 'profiles', mode='upsert', key_columns=['personid'])
+    assert stored_rows(db_connector, 'profiles', ['personid']).to_dict('records') == [
+        {'personid': 'a', 'amount': 1.0}, {'personid': 'b', 'amount': 20.0}, {'personid': 'c', 'amount': 31.0}]
+    assert table_names(db_connector) == {'profiles'}
+
+
+def test_upsert_matches_null_keys_with_each_other(db_connector):
+    key_columns = ['alias', 'phonenumber']
+    db_connector.bulk_write(pd.DataFrame({'alias': ['abebe', 'abebe', 'kebede'], 'phonenumber': [None, '251911', None], 'personid': ['1', '2', '3']}), 'persons')
+    db_connector.bulk_write(pd.DataFrame({'alias': ['abebe', 'almaz'], 'phonenumber': [None, None], 'personid': ['4', '5']}), 'persons',
+                            mode='upsert', key_columns=key_columns)
+    assert stored_rows(db_connector, 'persons', ['personid']).to_dict('records') == [
+        {'alias': 'abebe', 'phonenumber': '251911', 'personid': '2'}, {'alias': 'kebede', 'phonenumber': None, 'personid': '3'},
+        {'alias': 'abebe', 'phonenumber': None, 'personid': '4'}, {'alias': 'almaz', 'phonenumber': None, 'personid': '5'}]
+
+
+def test_replace_keys_swaps_every_row_of_the_written_keys(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'entity': ['a', 'a', 'a', 'b'], 'key': ['x', 'y', 'z', 'x'], 'count': [3, 2, 1, 5]}), 'breakdowns')
+    db_connector.bulk_write(pd.DataFrame({'entity': ['a', 'a', 'c'], 'key': ['x', 'w', 'x'], 'count': [4, 4, 1]}), 'breakdowns',
+                            mode='replace_keys', key_columns=['entity'])
+    assert stored_rows(db_connector, 'breakdowns', ['entity', 'key']).to_dict('records') == [
+        {'entity': 'a', 'key': 'w', 'count': 4}, {'entity': 'a', 'key': 'x', 'count': 4}, {'entity': 'b', 'key': 'x', 'count': 5},
+        {'entity': 'c', 'key': 'x', 'count': 1}]
+    assert table_names(db_connector) == {'breakdowns'}
+
+
+@pytest.mark.parametrize('mode, key_columns', [('merge', None), ('upsert', None), ('replace_keys', [])])
+def test_bulk_write_rejects_unknown_modes_and_missing_keys(db_connector, mode, key_columns):
+    with pytest.raises(ValueError):
+        db_connector.bulk_write(pd.DataFrame({'personid': ['a']}), 'profiles', mode=mode, key_columns=key_columns)
+
+
+def test_delete_by_keys_deletes_only_the_given_keys(db_connector):
+    db_connector.bulk_write(pd.DataFrame({'entity': ['a', 'b', 'c', None], 'count': [1, 2, 3, 4]}), 'breakdowns')
+    assert db_connector.delete_by_keys(table_name='breakdowns', key_column='entity', keys=['a', 'c', 'missing', None], batch_size=1) == 2
+    assert stored_rows(db_connector, 'breakdowns', ['count'])['entity'].tolist() == ['b', None]
+    assert db_connector.delete_by_keys(table_name='no_such_table', key_column='entity', keys=['a']) == 0
+
+
+def test_build_select_query_binds_filters_and_lower_cases_identifiers(db_connector):
+    query = db_connector.build_select_query(table_name='Test_Transactions', selected_columns=['TransactionID', 'amountinbirr'],
+                                            filters=[('AmountInBirr', '>=', 100), ('transactiontype', 'IN', ['cash', 'cheque']),
+                                                     ('loadedat', '>', pd.Timestamp('2024-01-01')), ('branchid', 'is null', None)],
+                                            order_by=[('amountinbirr', 'desc'), 'transactionid'], limit=5)
+    compiled = query.compile(dialect=db_connector.engine.dialect)
+    assert ' '.join(str(compiled).split()) == (
+        "SELECT transactionid, amountinbirr FROM test_transactions WHERE amountinbirr >= ? AND transactiontype IN (__[POSTCOMPILE_transactiontype_1]) "
+        "AND loadedat > ? AND branchid IS NULL ORDER BY amountinbirr DESC, transactionid ASC LIMIT ? OFFSET ?")
+    assert compiled.params['amountinbirr_1'] == 100 and compiled.params['transactiontype_1'] == ['cash', 'cheque']
+    assert compiled.params['loadedat_1'] == datetime.datetime(2024, 1, 1)
+
+
+def test_build_select_query_reads_equality_and_in_filters_from_a_dict(db_connector):
+    query = db_connector.build_select_query(table_name='t', filters={'a': [1, 2], 'B': 3})
+    assert ' '.join(str(query.compile(dialect=db_connector.engine.dialect)).split()) == "SELECT * FROM t WHERE a IN (__[POSTCOMPILE_a_1]) AND b = ?"
+
+
+@pytest.mark.parametrize('filters, order_by', [([('a', 'like', 'x')], None), (None, [('a', 'sideways')])])
+def test_build_select_query_rejects_unknown_operators_and_directions(db_connector, filters, order_by):
+    with pytest.raises(ValueError):
+        db_connector.build_select_query(table_name='t', filters=filters, order_by=order_by)
+
+
+def test_filtered_reads_run_in_sql_and_stream_in_chunks(db_connector):
+    df = pd.DataFrame({'transactionid': [f"t{i}" for i in range(10)], 'amountinbirr': [float(i) for i in range(10)]})
+    db_connector.bulk_write(df, 'transactions')
+    chunks = list(db_connector.iter_table_chunks(table_name='transactions', chunk_rows=3, filters=[('amountinbirr', '>=', 2)]))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 2]
+    assert db_connector.query_table_by_keys(table_name='transactions', selected_columns=['amountinbirr'], key_column='transactionid',
+                                            keys=['t1', 't8', 't8', None], batch_size=1)['amountinbirr'].tolist() == [1.0, 8.0]
+
+
+def test_connectors_share_an_engine_and_close_only_their_connection(tmp_path):
+    database_url = f"sqlite:///{tmp_path / 'shared.db'}"
+    first, second = Database_Connector(database_url=database_url), Database_Connector(database_url=database_url)
+    assert first.engine is second.engine
+    first.close()
+    assert first.connection is None and second.connection is not None and not second.connection.closed
+    assert Database_Connector(database_url=database_url).engine is second.engine
+
+    second.close(dispose=True)
+    assert all(engine is not second.engine for engine in Database_Connector.engines.values())
+    third = Database_Connector(database_url=database_url)
+    assert third.engine is not second.engine
+    third.close(dispose=True)
+
+
+def test_connector_is_a_context_manager(tmp_path):
+    with Database_Connector(database_url=f"sqlite:///{tmp_path / 'context.db'}") as db_connector:
+        assert db_connector.connection is not None
+    assert db_connector.connection is None
+    db_connector.close(dispose=True)
+
+
+def test_settings_come_from_the_environment_over_the_config_without_interpolation(tmp_path, monkeypatch):
+    database_url = f"sqlite:///{tmp_path / 'p%40ss.db'}"
+    config_path = tmp_path / 'data_fusion.cfg'
+    config_path.write_text(f"[database]\ndatabase_url = {database_url}\npool_size = 2\n")
+    monkeypatch.delenv('DATA_FUSION_DATABASE_URL', raising=False)
+    monkeypatch.delenv('DATA_FUSION_POOL_SIZE', raising=False)
+    with Database_Connector(config_path=str(config_path)) as db_connector:
+        assert db_connector.DATABASE_URL == database_url
+        assert db_connector.get_engine_options('postgresql://localhost/db')['pool_size'] == 2
+        assert 'pool_size' not in db_connector.get_engine_options(database_url)
+    db_connector.close(dispose=True)
+
+    monkeypatch.setenv('DATA_FUSION_DATABASE_URL', f"sqlite:///{tmp_path / 'environment.db'}")
+    with Database_Connector(config_path=str(config_path)) as db_connector:
+        assert db_connector.DATABASE_URL == f"sqlite:///{tmp_path / 'environment.db'}"
+    db_connector.close(dispose=True)
+
+
+def test_watermarks_round_trip_per_stage(db_connector):
+    assert db_connector.get_watermark('data_cleaning') is None
+    db_connector.set_watermark('data_cleaning', pd.Timestamp('2024-03-15 10:30:00.123456'))
+    db_connector.set_watermark('user_profiles', datetime.datetime(2024, 1, 1))
+    db_connector.set_watermark('data_cleaning', pd.Timestamp('2024-03-16 08:00:00'))
+    db_connector.set_watermark('user_profiles', pd.NaT)
+    assert db_connector.get_watermark('data_cleaning') == pd.Timestamp('2024-03-16 08:00:00')
+    assert db_connector.get_watermark('user_profiles') == pd.Timestamp('2024-01-01')
+
+
+def test_is_full_rebuild_reads_the_flag_and_the_environment(monkeypatch):
+    monkeypatch.delenv('DATA_FUSION_FULL_REBUILD', raising=False)
+    assert is_full_rebuild(['--full-rebuild']) and not is_full_rebuild([])
+    monkeypatch.setenv('DATA_FUSION_FULL_REBUILD', 'true')
+    assert is_full_rebuild([])
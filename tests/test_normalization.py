@@ -0,0 +1,126 @@
+"""
+The vectorized normalization rules against the scalar reference implementations and pandas code they replace.
+"""
+import hashlib
+import numpy as np
+import pandas as pd
+import pytest
+from normalization import (Memoized_Normalizer, TIME_FORMAT, classify_regions, first_occurrences, fixed_width_keys, generate_address_corpus, generate_phone_corpus,
+                           hash_transaction_ids, normalize_phone_numbers, parse_dates, parse_times_of_day, sha256_digests, transform_address,
+                           transform_phone_number)
+
+
+def assert_equivalent(reference, vectorized, values: pd.Series):
+    expected = values.apply(lambda x: reference(x))
+    actual = vectorized(values)
+    mismatches = ~((expected.isna() & actual.isna()) | (expected.astype(object) == actual.astype(object)).fillna(False).astype(bool))
+    sample = pd.DataFrame({'input': values, 'expected': expected, 'actual': actual})[mismatches].head(10)
+    assert not mismatches.any(), f"{mismatches.sum()} mismatches between {reference.__name__} and {vectorized.__name__}:\n{sample}"
+
+
+@pytest.mark.parametrize('values', [
+    generate_phone_corpus(20000),
+    generate_phone_corpus(20000).astype('string'),
+    pd.Series([911234567.0, 251911234567.0, 12345678.0, np.nan, 1e16, 123.0]),
+])
+def test_normalize_phone_numbers_matches_reference(values):
+    assert_equivalent(transform_phone_number, normalize_phone_numbers, values)
+
+
+@pytest.mark.parametrize('values', [
+    generate_address_corpus(20000),
+    generate_address_corpus(20000).astype('string'),
+    pd.Series([12.0, np.nan, 1001.0]),
+])
+def test_classify_regions_matches_reference(values):
+    assert_equivalent(transform_address, classify_regions, values)
+
+
+@pytest.mark.parametrize('reference, vectorized, corpus', [
+    (transform_phone_number, normalize_phone_numbers, generate_phone_corpus(2000)),
+    (transform_address, classify_regions, generate_address_corpus(2000)),
+])
+def test_memoized_normalizer_matches_reference(reference, vectorized, corpus):
+    # Chunks drawn from more distinct values than the cache holds, so entries are evicted and recomputed
+    repeated = corpus.sample(100000, replace=True, random_state=0).reset_index(drop=True)
+    max_size = corpus.nunique() // 2
+    normalizer = Memoized_Normalizer(vectorized, max_size=max_size)
+    for chunk_start in range(0, len(repeated), 20000):
+        assert_equivalent(reference, normalizer, repeated[chunk_start:chunk_start + 20000])
+    assert normalizer.cache_info()['hits'] > 0 and normalizer.cache_info()['size'] == max_size
+
+
+def test_transaction_hashing_matches_hexdigest():
+    transaction_ids = pd.Series([f"ft{number:012d}etb" for number in range(20000)] * 2, dtype='string')
+    transaction_ids[::97] = pd.NA
+    expected = transaction_ids.apply(lambda x: hashlib.sha256(x.encode()).hexdigest() if isinstance(x, str) else x)
+
+    for actual in [hash_transaction_ids(transaction_ids, output='hex'), hash_transaction_ids(transaction_ids, output='hex', digests=sha256_digests(transaction_ids))]:
+        assert expected.isna().equals(actual.isna())
+        assert (expected[expected.notna()].astype(object) == actual[actual.notna()]).all()
+
+    expected_rows = pd.DataFrame({'transactionid': expected}).drop_duplicates(subset=['transactionid']).index.to_numpy()
+    assert np.array_equal(first_occurrences(sha256_digests(transaction_ids)), expected_rows)
+    assert np.array_equal(first_occurrences(fixed_width_keys(actual)), expected_rows)
+
+
+def test_transaction_hashing_gives_exact_digests_and_their_int64_prefixes():
+    transaction_ids = pd.Series(['ft000000000001etb', 'ft000000000002etb', 'ft000000000001etb', None], dtype=object)
+    expected = [hashlib.sha256(b'ft000000000001etb').digest(), hashlib.sha256(b'ft000000000002etb').digest()]
+
+    digests = hash_transaction_ids(transaction_ids, output='digest')
+    assert digests[:3].tolist() == [expected[0], expected[1], expected[0]] and len(digests[3]) == 32
+    assert digests.index.equals(transaction_ids.index)
+    assert hash_transaction_ids(transaction_ids, output='digest', digests=sha256_digests(transaction_ids)).equals(digests)
+
+    prefixes = hash_transaction_ids(transaction_ids, output='int64')
+    assert prefixes[:3].tolist() == [int.from_bytes(digest[:8], 'little', signed=True) for digest in [expected[0], expected[1], expected[0]]]
+    with pytest.raises(ValueError):
+        hash_transaction_ids(transaction_ids, output='base64')
+
+
+def test_first_occurrences_resolves_shared_prefixes():
+    # Keys sharing their first 8 bytes are told apart on the full width, short keys are padded
+    values = pd.Series(['prefix00a', 'prefix00b', 'prefix00a', None, 'x', None, 'prefix00b', 'x'], dtype=object)
+    expected_rows = values.drop_duplicates().index.to_numpy()
+    assert np.array_equal(first_occurrences(fixed_width_keys(values)), expected_rows)
+    assert np.array_equal(first_occurrences(fixed_width_keys(values[:0])), np.empty(0, dtype=np.int64))
+
+
+def test_date_parsing_matches_previous_parsing():
+    rng = np.random.default_rng(0)
+    dates = pd.Series(rng.choice(pd.date_range('2015-01-01', '2025-12-31').strftime('%Y-%m-%d'), size=20000), dtype=object)
+    times = pd.Series([f"{hour:02d}:{minute:02d}:{second:02d}" for hour, minute, second in rng.integers(0, [24, 60, 60], size=(20000, 3))], dtype=object)
+    dates[::101] = None
+    times[::89] = 'n/a'
+
+    transactiondate = pd.to_datetime(dates.fillna(pd.NaT), errors='coerce')
+    transactiontime = pd.to_datetime(times.fillna(pd.NaT), format=TIME_FORMAT, errors='coerce')
+    expected = transactiondate + pd.to_timedelta(transactiontime.dt.hour, unit='h') + pd.to_timedelta(transactiontime.dt.minute, unit='m')
+    actual = parse_dates(dates) + parse_times_of_day(times).dt.floor('min')
+    assert expected.isna().equals(actual.isna())
+    assert (expected.dropna() == actual.dropna()).all()
+    assert (parse_dates(dates).dt.normalize().dropna().dt.date == transactiondate.dropna().dt.date).all()
+
+
+@pytest.mark.parametrize('dates', [
+    ['03/04/2024', '13/05/2024', None, '03/04/2024', '12/31/2023'],
+    ['03-04-2024', '13-05-2024', '03-04-2024'],
+    ['2024-03-04', '03/04/2024', None, '2024-13-01', '2024-03-04'],
+    # A first value that can't be month-first makes pandas infer day-first for the chunk (and warn), as it always did
+    pytest.param(['13/05/2024', '03/04/2024'], marks=pytest.mark.filterwarnings('ignore:Parsing dates in %d/%m/%Y format')),
+])
+def test_date_parsing_keeps_inferred_formats(dates):
+    # Ambiguous slash dates stay month-first and values that don't fit the inferred format stay NaT, as before
+    dates = pd.Series(dates, dtype=object)
+    expected = pd.to_datetime(dates.fillna(pd.NaT), errors='coerce')
+    actual = parse_dates(dates)
+    assert expected.isna().equals(actual.isna())
+    assert (expected.dropna() == actual.dropna()).all()
+
+
+def test_date_parsing_reads_ambiguous_dates_month_first():
+    parsed = parse_dates(pd.Series(['03/04/2024', '13/05/2024'], dtype=object))
+    assert parsed.iloc[0] == pd.Timestamp('2024-03-04')
+    assert pd.isna(parsed.iloc[1])
+    assert parse_dates(pd.Series(['03/04/2024'], dtype=object), date_format='%d/%m/%Y').iloc[0] == pd.Timestamp('2024-04-03')
@@ -0,0 +1,194 @@
+"""
+The profile feature kernels against the pandas code they replace. The pandas versions are also what
+benchmarks/profile_features.py times the kernels against.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from profile_features import (aggregate_features, category_counts, entity_events, new_beneficiary_ratio, night_time_flags, recent_events,
+                              rolling_window_maxima, synthetic_transactions, time_lapse_minutes)
+
+
+ROLLING_WINDOWS = {'1hr': '1h', '24hr': '24h', '7d': '7D', '1m': '30D'}
+
+SENDER_FEATURES = [
+    ('no_of_transactions_sent', 'amountinbirr', None, 'size'),
+    ('avg_transaction_amount_sent', 'amountinbirr', None, 'mean'),
+    ('std_transaction_amount_sent', 'amountinbirr', None, 'std'),
+    ('total_amount_sent', 'amountinbirr', None, 'sum'),
+    ('cash_transactions', 'amountinbirr', ('transactiontype', '=', 'cash'), 'sum'),
+    ('non_cash_transactions', 'amountinbirr', ('transactiontype', '!=', 'cash'), 'sum'),
+    ('cash_transactions_count', 'amountinbirr', ('transactiontype', '=', 'cash'), 'size'),
+    ('large_transactions_avg', 'amountinbirr', ('amountinbirr', '>=', 20000), 'mean'),
+]
+
+
+# The pandas code the kernels replace
+
+def pandas_rolling_maxima(df_transactions):
+    result = {}
+    for aggregation, prefix in [('count', 'max_freq'), ('sum', 'max_volume')]:
+        for name, offset in ROLLING_WINDOWS.items():
+            rolling = df_transactions.set_index('transactiondatetime').sort_index().groupby('fromentity')['amountinbirr'].rolling(offset)
+            result[f"{prefix}_{name}"] = getattr(rolling, aggregation)().groupby('fromentity').max()
+    return pd.DataFrame(result)
+
+
+def pandas_event_features(df_transactions):
+    def events():
+        return pd.concat([
+            df_transactions[['fromentity', 'transactiondatetime']].rename(columns={'fromentity': 'entity'}).assign(role=lambda x: "sender"),
+            df_transactions[['toentity', 'transactiondatetime']].rename(columns={'toentity': 'entity'}).assign(role=lambda x: "beneficiary")
+        ]).sort_values(by=['entity', 'transactiondatetime'])
+
+    result = pd.DataFrame({'std_transaction_amount_sent_and_received': pd.concat([
+        df_transactions[['fromentity', 'amountinbirr']].rename(columns={'fromentity': 'entity'}),
+        df_transactions[['toentity', 'amountinbirr']].rename(columns={'toentity': 'entity'})
+    ]).groupby('entity')['amountinbirr'].std()})
+    result[["min_time_lapse_minutes", "max_time_lapse_minutes", "avg_time_lapse_minutes"]] = events()\
+        .assign(time_lapse=lambda x: x.groupby('entity')['transactiondatetime'].diff().dt.total_seconds() / 60)\
+        .groupby("entity")\
+        .agg(min_time_lapse_minutes=('time_lapse', 'min'), max_time_lapse_minutes=('time_lapse', 'max'), avg_time_lapse_minutes=('time_lapse', 'mean'))\
+        .fillna(-1).apply(lambda x: round(x, 2))
+    result['last_transaction_time'] = events().groupby('entity').last()['transactiondatetime']
+    return result
+
+
+def pandas_sender_features(df_transactions):
+    grouped = df_transactions.groupby('fromentity')['amountinbirr']
+    cash = df_transactions[df_transactions['transactiontype'] == 'cash'].groupby('fromentity')['amountinbirr']
+    return pd.DataFrame({
+        'no_of_transactions_sent': df_transactions.groupby('fromentity').size(),
+        'avg_transaction_amount_sent': grouped.mean(),
+        'std_transaction_amount_sent': grouped.std(),
+        'total_amount_sent': grouped.sum(),
+        'cash_transactions': cash.sum(),
+        'non_cash_transactions': df_transactions[df_transactions['transactiontype'] != 'cash'].groupby('fromentity')['amountinbirr'].sum(),
+        'cash_transactions_count': cash.size(),
+        'large_transactions_avg': df_transactions[df_transactions['amountinbirr'] >= 20000].groupby('fromentity')['amountinbirr'].mean(),
+    })
+
+
+def pandas_night_and_new_beneficiary(df_transactions):
+    def get_single_ratio(group):
+        total_volume = group[0].count()
+        single_volume = group.loc[group[0] == 1, 0].count()
+        return (single_volume / total_volume) * group[0].sum()
+
+    is_night = df_transactions['transactiondatetime'].dt.hour.apply(lambda h: 1 if (h >= 20 or h < 6) else 0)
+    ratio = df_transactions.groupby(['fromentity', 'toentity']).size().reset_index()\
+        .sort_values(by=['fromentity', 0], ascending=[True, False]).groupby(['fromentity']).apply(get_single_ratio)
+    return is_night, ratio
+
+
+def pandas_category_counts(df_transactions, column, top_k=None):
+    counts = df_transactions.groupby(['fromentity', column]).size().rename('count').reset_index()\
+        .sort_values(by=['fromentity', 'count', column], ascending=[True, False, True])\
+        .assign(rank=lambda x: x.groupby('fromentity').cumcount() + 1)
+    if top_k:
+        counts = counts[counts['rank'] <= top_k]
+    return counts.rename(columns={'fromentity': 'entity', column: 'key'}).reset_index(drop=True)
+
+
+def event_features(df_transactions):
+    events = entity_events(df_transactions)
+    result = pd.DataFrame({'std_transaction_amount_sent_and_received': events.groupby('entity', sort=False)['amountinbirr'].std()})
+    result[["min_time_lapse_minutes", "max_time_lapse_minutes", "avg_time_lapse_minutes"]] = time_lapse_minutes(events)
+    result['last_transaction_time'] = events.groupby('entity', sort=False)['transactiondatetime'].last()
+    return result
+
+
+@pytest.fixture(scope='module')
+def df_transactions():
+    return synthetic_transactions(10000, 1000)
+
+
+def test_aggregate_features_matches_pandas(df_transactions):
+    expected = pandas_sender_features(df_transactions)
+    result = aggregate_features(df_transactions, 'fromentity', SENDER_FEATURES)
+    assert result.index.equals(expected.index)
+    for feature in result.columns:
+        assert np.array_equal(result[feature].to_numpy(dtype=np.float64), expected[feature].reindex(result.index).to_numpy(dtype=np.float64), equal_nan=True)
+
+
+def test_aggregate_features_treat_missing_filter_values_as_not_matching():
+    # The stages read tables through convert_dtypes, so transactiontype is a nullable string column and its comparisons give NA
+    df_transactions = synthetic_transactions(10000, 1000).convert_dtypes()
+    expected = pandas_sender_features(df_transactions)
+    result = aggregate_features(df_transactions, 'fromentity', SENDER_FEATURES)
+    assert result.index.equals(expected.index)
+    for feature in result.columns:
+        assert np.array_equal(result[feature].to_numpy(dtype=np.float64, na_value=np.nan),
+                              expected[feature].reindex(result.index).to_numpy(dtype=np.float64, na_value=np.nan), equal_nan=True)
+
+
+def test_night_time_flags_and_new_beneficiary_ratio_match_pandas(df_transactions):
+    expected_night, expected_ratio = pandas_night_and_new_beneficiary(df_transactions)
+    night = night_time_flags(df_transactions['transactiondatetime'])
+    ratio = new_beneficiary_ratio(df_transactions['fromentity'], df_transactions['toentity'])
+    assert np.array_equal(night.to_numpy(), expected_night.to_numpy())
+    assert ratio.index.equals(expected_ratio.index) and np.array_equal(ratio.to_numpy(), expected_ratio.to_numpy(dtype=np.float64))
+
+
+@pytest.mark.parametrize('column', ['toentity', 'transactiontype'])
+@pytest.mark.parametrize('top_k', [None, 3])
+def test_category_counts_match_pandas(df_transactions, column, top_k):
+    result = category_counts(df_transactions['fromentity'], df_transactions[column], top_k=top_k)
+    expected = pandas_category_counts(df_transactions, column, top_k=top_k)
+    pd.testing.assert_frame_equal(result.astype({'entity': object, 'key': object}), expected.astype({'entity': object, 'key': object}), check_dtype=False)
+
+
+def test_recent_events_keep_the_latest_times_of_every_entity(df_transactions):
+    events = entity_events(df_transactions)
+    result = recent_events(events, 5)
+    expected = events[events['transactiondatetime'].notna()].groupby('entity', sort=False).tail(5)[['entity', 'role', 'transactiondatetime']]
+    pd.testing.assert_frame_equal(result[['entity', 'role', 'transactiondatetime']], expected.reset_index(drop=True))
+    assert result.groupby('entity').size().max() == 5
+
+
+def test_recent_events_keep_every_time_and_its_lapse_without_a_limit(df_transactions):
+    events = pd.concat([
+        df_transactions[['fromentity', 'transactiondatetime']].rename(columns={'fromentity': 'entity'}).assign(role='sender'),
+        df_transactions[['toentity', 'transactiondatetime']].rename(columns={'toentity': 'entity'}).assign(role='beneficiary'),
+    ]).sort_values(by=['entity', 'transactiondatetime'], kind='stable')
+    expected = events[events['entity'].notna() & events['transactiondatetime'].notna()]\
+        .assign(time_lapse=lambda x: (x.groupby('entity')['transactiondatetime'].diff().dt.total_seconds() / 60).round(2))\
+        .reset_index(drop=True)[['entity', 'role', 'transactiondatetime', 'time_lapse']]
+
+    result = recent_events(entity_events(df_transactions))
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert recent_events(entity_events(df_transactions), 0).equals(result)
+
+
+def test_rolling_window_maxima_matches_pandas(df_transactions):
+    expected = pandas_rolling_maxima(df_transactions)
+    result = rolling_window_maxima(df_transactions['fromentity'], df_transactions['transactiondatetime'], df_transactions['amountinbirr'], ROLLING_WINDOWS)
+
+    # Counts are exact, sums agree up to the rounding of pandas' running sums
+    assert list(result.columns) == list(expected.columns) and result.index.equals(expected.index)
+    assert result.filter(like='max_freq').equals(expected.filter(like='max_freq'))
+    assert np.allclose(result.filter(like='max_volume'), expected.filter(like='max_volume'), rtol=1e-12, atol=1e-6, equal_nan=True)
+
+
+def test_event_features_match_pandas(df_transactions):
+    expected = pandas_event_features(df_transactions)
+    result = event_features(df_transactions).reindex(expected.index)
+
+    # The standard deviations sum the amounts in event order rather than concat order
+    assert result.drop(columns=['std_transaction_amount_sent_and_received']).equals(expected.drop(columns=['std_transaction_amount_sent_and_received']))
+    assert np.allclose(result['std_transaction_amount_sent_and_received'], expected['std_transaction_amount_sent_and_received'], rtol=1e-12, equal_nan=True)
+
+
+def test_entity_events_parses_text_times():
+    # SQLite returns transactiondatetime as text, the event table must come out the same as from timestamps
+    df_transactions = pd.DataFrame({
+        'fromentity': ['ENTITY_1', 'ENTITY_2', 'ENTITY_1', None],
+        'toentity': ['ENTITY_2', 'ENTITY_1', 'ENTITY_3', 'ENTITY_1'],
+        'transactiondatetime': ['2024-01-01 10:00:00.000000', '2024-01-01 09:30:00.000000', None, '2024-01-02 08:15:00.000000'],
+        'amountinbirr': [100.0, 250.0, 75.5, 10.0],
+    })
+    expected = entity_events(df_transactions.assign(transactiondatetime=pd.to_datetime(df_transactions['transactiondatetime'])))
+    actual = entity_events(df_transactions)
+    assert pd.api.types.is_datetime64_any_dtype(actual['transactiondatetime'])
+    pd.testing.assert_frame_equal(actual, expected)
+    pd.testing.assert_frame_equal(time_lapse_minutes(actual), time_lapse_minutes(expected))
@@ -0,0 +1,39 @@
+"""
+Record linkage against the labelled person corpus, and its union-find against a reference implementation.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from record_linkage import connected_components, linkage_scores
+
+
+def reference_components(left: np.ndarray, right: np.ndarray, rows: int):
+    parent = list(range(rows))
+
+    def find(row):
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    return pd.factorize(np.array([find(row) for row in range(rows)]))[0]
+
+
+@pytest.mark.parametrize('rows, pairs', [(10, 0), (1000, 300), (100000, 90000)])
+def test_connected_components_matches_reference_union_find(rows, pairs):
+    rng = np.random.default_rng(0)
+    left, right = rng.integers(0, rows, pairs), rng.integers(0, rows, pairs)
+    assert np.array_equal(connected_components(left, right, rows), reference_components(left, right, rows))
+
+
+def test_calibrated_linkage_keeps_the_precision_of_exact_matches():
+    # No pair reaches infinite points, so this scores the exact alias matches alone
+    exact = linkage_scores(min_points=np.inf)
+    linked = linkage_scores()
+    assert linked['precision'] >= 0.8
+    assert linked['precision'] >= exact['precision']
+    assert linked['recall'] > exact['recall'] + 0.2
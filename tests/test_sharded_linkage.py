@@ -0,0 +1,15 @@
+"""
+Sharded record linkage against the single-process link_records.
+"""
+import pytest
+from record_linkage import generate_person_corpus, link_records, unique_pairs
+from sharded_linkage import link_records_sharded
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sharded_matches_equal_link_records(workers):
+    df_person = generate_person_corpus(5000).drop(columns=['person'])
+    left, right, stats = link_records(df_person)
+    sharded_left, sharded_right, sharded_stats = link_records_sharded(df_person, workers=workers)
+    assert set(zip(sharded_left, sharded_right)) == set(zip(*unique_pairs(left, right, len(df_person))))
+    assert sharded_stats['candidate_pairs'] == stats['candidate_pairs']
@@ -0,0 +1,30 @@
+"""
+The batched string similarities against their scalar references.
+"""
+import numpy as np
+import pytest
+from string_similarity import (jaro_winkler, jaro_winkler_pairs, levenshtein_similarity, levenshtein_similarity_pairs, name_variant_pairs, ngram_jaccard,
+                               ngram_jaccard_pairs, njit)
+
+
+EDGE_FIRST = np.array(['', '', 'a', 'abebe', 'martha', 'dixon', 'tesfaye', 'ab', 'aaaa', 'kebede kebede', 'ሰላም'], dtype=object)
+EDGE_SECOND = np.array(['', 'a', '', 'abebe', 'marhta', 'dicksonx', 'tesfaie', 'ba', 'aa', 'kebede', 'ሰላም ሃይሌ'], dtype=object)
+COMPILED_OPTIONS = [{'compiled': False}] + ([{'compiled': True}] if njit is not None else [])
+
+MEASURES = [(jaro_winkler, jaro_winkler_pairs, options) for options in COMPILED_OPTIONS]\
+    + [(levenshtein_similarity, levenshtein_similarity_pairs, options) for options in COMPILED_OPTIONS]\
+    + [(ngram_jaccard, ngram_jaccard_pairs, {})]
+
+
+def assert_same_scores(reference, batched_version, first, second, **options):
+    expected = np.array([reference(a, b) for a, b in zip(first, second)], dtype=np.float64)
+    result = batched_version(first, second, **options)
+    mismatches = np.flatnonzero(expected != result)
+    assert len(mismatches) == 0, f"{batched_version.__name__} differs from {reference.__name__} on {list(zip(first[mismatches[:5]], second[mismatches[:5]]))}"
+
+
+@pytest.mark.parametrize('reference, batched_version, options', MEASURES)
+def test_batched_similarities_match_references(reference, batched_version, options):
+    assert_same_scores(reference, batched_version, EDGE_FIRST, EDGE_SECOND, **options)
+    first, second = name_variant_pairs(20000)
+    assert_same_scores(reference, batched_version, first, second, **options)